@@ -0,0 +1,226 @@
+"""
+Token-bucket rate limiting for chat frames and REST endpoints.
+
+Every action in `RATE_LIMITS` has a bucket of `burst` tokens that refills
+completely over `period` seconds. Each REST request takes one token from the
+bucket of the client IP and, when known, of the user; chat frames only from
+the user's. An empty bucket means the request is rejected before it reaches
+the database or password hashing.
+Tokens are taken all or nothing: a request rejected by one bucket takes no
+token from the others.
+
+Buckets live in process memory by default. With `RATE_LIMIT_REDIS_URL` set
+they are kept in Redis and shared by every server process; if Redis is
+unreachable the in-process buckets are used instead.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = getattr(settings, 'RATE_LIMIT_ENABLED', True)
+RATE_LIMIT_REDIS_URL = getattr(settings, 'RATE_LIMIT_REDIS_URL', None)
+RATE_LIMITS = getattr(settings, 'RATE_LIMITS', {})
+# Idle buckets kept in memory before the least recently used are dropped
+RATE_LIMIT_MAX_KEYS = getattr(settings, 'RATE_LIMIT_MAX_KEYS', 100_000)
+
+
+class LocalBuckets:
+    """Token buckets in process memory, keyed by action and identity."""
+
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def take(self, keys, burst, rate):
+        """
+        Take a token from every bucket, or from none if one is empty.
+        Returns 0 if allowed, else seconds until all have a token.
+        """
+        with self._lock:
+            now = time.monotonic()
+            levels = {}
+            for key in keys:
+                tokens, updated_at = self._buckets.pop(key, (burst, now))
+                levels[key] = min(burst, tokens + (now - updated_at) * rate)
+            retry_after = max(((1 - tokens) / rate for tokens in levels.values() if tokens < 1), default=0.0)
+
+            for key, tokens in levels.items():
+                self._buckets[key] = (tokens if retry_after else tokens - 1, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return retry_after
+
+
+class RedisBuckets:
+    """Token buckets shared through Redis, updated atomically by a script."""
+
+    # Takes a token from every key, or from none if one is empty. Returns
+    # the milliseconds to wait, 0 when the tokens were taken.
+    TAKE_SCRIPT = """
+    local burst = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local levels = {}
+    local wait = 0
+    for i, key in ipairs(KEYS) do
+        local state = redis.call('HMGET', key, 'tokens', 'ts')
+        local tokens = tonumber(state[1]) or burst
+        local ts = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+        if tokens < 1 then
+            wait = math.max(wait, math.ceil((1 - tokens) / rate * 1000))
+        end
+        levels[i] = tokens
+    end
+    for i, key in ipairs(KEYS) do
+        local tokens = levels[i]
+        if wait == 0 then
+            tokens = tokens - 1
+        end
+        redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+        redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+    end
+    return wait
+    """
+
+    def __init__(self, url):
+        import redis
+        import redis.asyncio
+
+        self.client = redis.Redis.from_url(url)
+        self.async_client = redis.asyncio.Redis.from_url(url)
+        self.take_script = self.client.register_script(self.TAKE_SCRIPT)
+        self.async_take_script = self.async_client.register_script(self.TAKE_SCRIPT)
+
+    def take(self, keys, burst, rate):
+        return self.take_script(keys=[f"ratelimit:{key}" for key in keys], args=[burst, rate]) / 1000
+
+    async def atake(self, keys, burst, rate):
+        keys = [f"ratelimit:{key}" for key in keys]
+        return await self.async_take_script(keys=keys, args=[burst, rate]) / 1000
+
+
+class RateLimiter:
+    """Check actions against their configured token buckets."""
+
+    def __init__(self, limits=RATE_LIMITS, redis_url=RATE_LIMIT_REDIS_URL, enabled=RATE_LIMIT_ENABLED):
+        self.enabled = enabled
+        self.limits = {
+            action: (burst, burst / period)
+            for action, (burst, period) in limits.items()
+        }
+        self.local = LocalBuckets()
+        self.shared = RedisBuckets(redis_url) if redis_url else None
+        self.rejected = 0
+        self.errors = 0
+
+    def check(self, action, *idents):
+        """
+        Take a token for each identity (e.g. "ip:1.2.3.4", "user:42"), or
+        none if any of them is out of tokens. Returns 0 if the action is
+        allowed, else the seconds to wait.
+        """
+        limit = self.limits.get(action) if self.enabled else None
+        if limit is None or not idents:
+            return 0.0
+        keys = [f"{action}:{ident}" for ident in idents]
+        if self.shared is not None:
+            try:
+                retry_after = self.shared.take(keys, *limit)
+            except Exception:
+                logger.exception("Rate limit backend failed, using local buckets")
+                self.errors += 1
+                retry_after = self.local.take(keys, *limit)
+        else:
+            retry_after = self.local.take(keys, *limit)
+        if retry_after:
+            self.rejected += 1
+        return retry_after
+
+    async def acheck(self, action, *idents):
+        """Like check(), without blocking the event loop on Redis."""
+        limit = self.limits.get(action) if self.enabled else None
+        if limit is None or not idents:
+            return 0.0
+        if self.shared is None:
+            return self.check(action, *idents)
+        keys = [f"{action}:{ident}" for ident in idents]
+        try:
+            retry_after = await self.shared.atake(keys, *limit)
+        except Exception:
+            logger.exception("Rate limit backend failed, using local buckets")
+            self.errors += 1
+            retry_after = self.local.take(keys, *limit)
+        if retry_after:
+            self.rejected += 1
+        return retry_after
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "shared": self.shared is not None,
+            "rejected": self.rejected,
+            "errors": self.errors,
+        }
+
+
+rate_limiter = RateLimiter()
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    DRF throttle backed by `rate_limiter`. Subclasses set `action`.
+    Uses DRF's client IP detection, so `NUM_PROXIES` applies.
+    """
+    action = None
+
+    def get_idents(self, request):
+        idents = [f"ip:{self.get_ident(request)}"]
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            idents.append(f"user:{user.pk}")
+        return idents
+
+    def allow_request(self, request, view):
+        self.retry_after = rate_limiter.check(self.action, *self.get_idents(request))
+        return not self.retry_after
+
+    def wait(self):
+        return self.retry_after
+
+
+class LoginRateThrottle(TokenBucketThrottle):
+    action = 'login'
+
+    def get_idents(self, request):
+        # Also limit guesses against one account, per address: a bucket per
+        # account alone would let anyone lock its owner out
+        idents = super().get_idents(request)
+        email = request.data.get('email') if hasattr(request.data, 'get') else None
+        if isinstance(email, str) and email:
+            idents.append(f"email:{email.strip().lower()}:ip:{self.get_ident(request)}")
+        return idents
+
+
+class RegisterRateThrottle(TokenBucketThrottle):
+    action = 'register'
+
+
+class CreateRoomRateThrottle(TokenBucketThrottle):
+    action = 'create_room'
+
+
+class SearchRateThrottle(TokenBucketThrottle):
+    action = 'search'
+
+
+class ExportRateThrottle(TokenBucketThrottle):
+    action = 'export'
@@ -131,6 +131,125 @@ CHANNEL_LAYERS = {
 AUTH_USER_MODEL = 'userAuth.User'
 
 
+# Chat configuration
+
+# Number of messages sent on connect and per `load_more` page
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_PAGE_SIZE', 50))
+# Upper bound for a client-requested page size
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_MAX_PAGE_SIZE', 200))
+# Largest page of the streamed REST history (/rooms/<room_id>/messages/), and rows read per chunk
+CHAT_HISTORY_STREAM_MAX_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_STREAM_MAX_PAGE_SIZE', 10000))
+CHAT_HISTORY_STREAM_CHUNK_SIZE = int(os.getenv('CHAT_HISTORY_STREAM_CHUNK_SIZE', 500))
+
+# Write-behind message persistence: broadcast first, then bulk insert in batches.
+# Requires CHAT_SEQUENCE_REDIS_URL (the process refuses to start without it)
+CHAT_WRITE_BEHIND_ENABLED = os.getenv('CHAT_WRITE_BEHIND_ENABLED', 'False') == 'True'
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv('CHAT_WRITE_BEHIND_BATCH_SIZE', 100))
+CHAT_WRITE_BEHIND_FLUSH_MS = int(os.getenv('CHAT_WRITE_BEHIND_FLUSH_MS', 200))
+# Required with write-behind: 0-255, different for every server process (embedded in message ids)
+CHAT_WRITE_BEHIND_NODE_ID = int(os.getenv('CHAT_WRITE_BEHIND_NODE_ID')) if os.getenv('CHAT_WRITE_BEHIND_NODE_ID') else None
+
+# Typing indicators: one aggregated frame per room per interval, entries expire after the TTL
+CHAT_TYPING_INTERVAL_MS = int(os.getenv('CHAT_TYPING_INTERVAL_MS', 1000))
+CHAT_TYPING_TTL_MS = int(os.getenv('CHAT_TYPING_TTL_MS', 3000))
+
+# Room membership checks on connect/subscribe, cached per (user, room) for these many seconds
+CHAT_MEMBERSHIP_CACHE_TTL = int(os.getenv('CHAT_MEMBERSHIP_CACHE_TTL', 300))
+CHAT_MEMBERSHIP_NEGATIVE_TTL = int(os.getenv('CHAT_MEMBERSHIP_NEGATIVE_TTL', 5))
+# Optional Redis URL to share the cache, and its invalidations, between server processes
+CHAT_MEMBERSHIP_REDIS_URL = os.getenv('CHAT_MEMBERSHIP_REDIS_URL')
+
+# Read positions from mark_read frames are buffered and written at most this often
+CHAT_READ_FLUSH_MS = int(os.getenv('CHAT_READ_FLUSH_MS', 3000))
+
+# Hot cache of the newest messages per room, in process and optionally in Redis
+CHAT_HISTORY_CACHE_ENABLED = os.getenv('CHAT_HISTORY_CACHE_ENABLED', 'True') == 'True'
+CHAT_HISTORY_CACHE_SIZE = int(os.getenv('CHAT_HISTORY_CACHE_SIZE', 200))
+CHAT_HISTORY_CACHE_MAX_BYTES = int(os.getenv('CHAT_HISTORY_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+CHAT_HISTORY_CACHE_REDIS_URL = os.getenv('CHAT_HISTORY_CACHE_REDIS_URL')
+CHAT_HISTORY_CACHE_REDIS_TTL = int(os.getenv('CHAT_HISTORY_CACHE_REDIS_TTL', 3600))
+
+# Reconnects with ?last_seq=N replay at most this many missed messages
+CHAT_RESUME_MAX_GAP = int(os.getenv('CHAT_RESUME_MAX_GAP', 500))
+# Optional Redis URL for allocating per-room sequence numbers (required by write-behind)
+CHAT_SEQUENCE_REDIS_URL = os.getenv('CHAT_SEQUENCE_REDIS_URL')
+# Rooms one multiplexed connection (ws/chat/) may subscribe to
+CHAT_MULTIPLEX_MAX_ROOMS = int(os.getenv('CHAT_MULTIPLEX_MAX_ROOMS', 100))
+# Frames queued per connection before the slow-consumer policy applies
+CHAT_OUTBOUND_QUEUE_SIZE = int(os.getenv('CHAT_OUTBOUND_QUEUE_SIZE', 256))
+# "drop_typing", "coalesce" or "disconnect"
+CHAT_OUTBOUND_POLICY = os.getenv('CHAT_OUTBOUND_POLICY', 'drop_typing')
+# Presence: heartbeat interval, expiry of members whose server stopped heartbeating,
+# and the window in which join/leave changes are batched into one delta
+CHAT_PRESENCE_HEARTBEAT_MS = int(os.getenv('CHAT_PRESENCE_HEARTBEAT_MS', 5000))
+CHAT_PRESENCE_TTL_MS = int(os.getenv('CHAT_PRESENCE_TTL_MS', 15000))
+CHAT_PRESENCE_DEBOUNCE_MS = int(os.getenv('CHAT_PRESENCE_DEBOUNCE_MS', 500))
+# Optional Redis URL (Redis 6.2+) to share presence between server processes
+CHAT_PRESENCE_REDIS_URL = os.getenv('CHAT_PRESENCE_REDIS_URL')
+
+# Deleted rooms are purged in the background, this many rows per batch with a pause in between
+CHAT_PURGE_BATCH_SIZE = int(os.getenv('CHAT_PURGE_BATCH_SIZE', 1000))
+CHAT_PURGE_SLEEP_MS = int(os.getenv('CHAT_PURGE_SLEEP_MS', 50))
+
+# Messages older than this many days are moved to the archive by `manage.py archive_messages`
+# (unset keeps everything in the database); rooms can override it with Rooms.retention_days
+CHAT_RETENTION_DAYS = int(os.getenv('CHAT_RETENTION_DAYS')) if os.getenv('CHAT_RETENTION_DAYS') else None
+CHAT_ARCHIVE_DIR = os.getenv('CHAT_ARCHIVE_DIR', str(BASE_DIR / 'archive'))
+# "zstd" (needs the zstandard package) or "gzip"; defaults to zstd when available
+CHAT_ARCHIVE_COMPRESSION = os.getenv('CHAT_ARCHIVE_COMPRESSION')
+
+# Full-text message search results per page
+CHAT_SEARCH_PAGE_SIZE = int(os.getenv('CHAT_SEARCH_PAGE_SIZE', 20))
+CHAT_SEARCH_MAX_PAGE_SIZE = int(os.getenv('CHAT_SEARCH_MAX_PAGE_SIZE', 100))
+
+# Rows fetched and written per batch by room exports (/rooms/<room_id>/export/, export_room)
+CHAT_EXPORT_BATCH_SIZE = int(os.getenv('CHAT_EXPORT_BATCH_SIZE', 2000))
+
+# User directory (/api/users/) page size, by default and at most
+USER_DIRECTORY_PAGE_SIZE = int(os.getenv('USER_DIRECTORY_PAGE_SIZE', 50))
+USER_DIRECTORY_MAX_PAGE_SIZE = int(os.getenv('USER_DIRECTORY_MAX_PAGE_SIZE', 200))
+
+# Cache of verified access tokens (capped by their exp) and of user snapshots, in seconds
+AUTH_CACHE_ENABLED = os.getenv('AUTH_CACHE_ENABLED', 'True') == 'True'
+AUTH_CACHE_TTL = int(os.getenv('AUTH_CACHE_TTL', 300))
+AUTH_CACHE_USER_TTL = int(os.getenv('AUTH_CACHE_USER_TTL', 60))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv('AUTH_CACHE_MAX_ENTRIES', 10000))
+
+# Fraction (0-1) of authentications traced per stage to the userAuth.trace logger
+AUTH_TRACE_SAMPLE_RATE = float(os.getenv('AUTH_TRACE_SAMPLE_RATE', 0))
+
+# Password hashing (login, register, refresh) runs on this many dedicated threads;
+# past AUTH_HASH_MAX_QUEUE waiting requests, or AUTH_HASH_TIMEOUT seconds of waiting, they get 503
+AUTH_HASH_WORKERS = int(os.getenv('AUTH_HASH_WORKERS', min(4, os.cpu_count() or 1)))
+AUTH_HASH_MAX_QUEUE = int(os.getenv('AUTH_HASH_MAX_QUEUE', 32))
+AUTH_HASH_TIMEOUT = float(os.getenv('AUTH_HASH_TIMEOUT', 10))
+
+# Revoked token ids (rotated refresh tokens, logouts). Optional Redis URL (Redis 6.2+)
+# to share them between server processes, which pick up each other's every AUTH_REVOCATION_SYNC_MS
+AUTH_REVOCATION_REDIS_URL = os.getenv('AUTH_REVOCATION_REDIS_URL')
+AUTH_REVOCATION_SYNC_MS = int(os.getenv('AUTH_REVOCATION_SYNC_MS', 1000))
+# Revocations expected per refresh token lifetime, to size the bloom filter
+AUTH_REVOCATION_CAPACITY = int(os.getenv('AUTH_REVOCATION_CAPACITY', 100000))
+# Seconds during which a rotated refresh token still gets the pair it was
+# exchanged for, so concurrent refreshes (several tabs) don't log users out
+AUTH_REFRESH_REUSE_SECONDS = int(os.getenv('AUTH_REFRESH_REUSE_SECONDS', 10))
+
+# Rate limiting: token buckets per user and per client IP (chat frames per user only)
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'True') == 'True'
+# Optional Redis URL to share buckets between server processes
+RATE_LIMIT_REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL')
+# action: (burst, seconds to refill the whole burst)
+RATE_LIMITS = {
+    'message': (20, 10),
+    'typing': (10, 5),
+    'login': (5, 60),
+    'register': (5, 600),
+    'create_room': (10, 600),
+    'search': (30, 60),
+    'export': (5, 600),
+}
+
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'userAuth.tokenAuth.JWTAuthentication', 
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.urls import path
-from chat.views import get_user_list, get_user_rooms, create_room, join_room,delete_room
+from chat.views import get_user_list, get_user_rooms, create_room, join_room,delete_room, get_chat_stats, get_room_online, get_room_purge_status, search_room_messages, get_messages, export_room
 from userAuth.views import register_user, login_user, refresh_token, logout_user
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 
@@ -17,9 +17,16 @@ urlpatterns = [
  
     path('rooms/', get_user_rooms, name='get_user_rooms'),
     path('rooms/create/', create_room, name='create_room'),
+    path('rooms/<str:room_id>/messages/', get_messages, name='get_messages'),
+    path('rooms/<str:room_id>/search/', search_room_messages, name='search_room_messages'),
+    path('rooms/<str:room_id>/export/', export_room, name='export_room'),
 
     path('room/join/', join_room, name='join_room'),
-    path('room/delete/<str:room_id>/', delete_room, name="delete_room")
+    path('room/delete/<str:room_id>/', delete_room, name="delete_room"),
+    path('room/delete/<str:room_id>/status/', get_room_purge_status, name="room_purge_status"),
+    path('room/<str:room_id>/online/', get_room_online, name="room_online"),
+
+    path('chat/stats/', get_chat_stats, name="chat_stats"),
 
 ]
 
@@ -0,0 +1,184 @@
+"""
+Cold archive of old messages.
+
+Messages older than a room's retention period are moved out of the
+database by `manage.py archive_messages` into append-only segment files,
+one per room per month:
+
+    <CHAT_ARCHIVE_DIR>/<room_id>/<YYYY-MM>.ndjson.zst (or .ndjson.gz)
+    <CHAT_ARCHIVE_DIR>/<room_id>/<YYYY-MM>.idx
+
+A segment is a sequence of independently compressed blocks, each holding
+up to a few thousand messages as NDJSON in (timestamp, id) order. The .idx
+file has one JSON line per block with its byte offset and length, message
+count and first/last keys, so a history page only decompresses the blocks
+it needs. zstd is used when the `zstandard` package is installed, gzip
+otherwise; both can be read as long as the package is there.
+
+History reads fall through to the archive once a page reaches past the
+oldest message left in the database.
+"""
+import gzip
+import json
+import os
+import shutil
+from itertools import islice
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_DIR = getattr(settings, 'CHAT_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'archive'))
+ARCHIVE_COMPRESSION = getattr(settings, 'CHAT_ARCHIVE_COMPRESSION', None) or (
+    'zstd' if zstandard is not None else 'gzip'
+)
+
+EXTENSIONS = {'zstd': '.ndjson.zst', 'gzip': '.ndjson.gz'}
+
+
+def compress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def decompress(data, compression):
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Reading .zst archive segments needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return gzip.decompress(data)
+
+
+def message_key(message):
+    """Sort key of an archived (serialized) message."""
+    return parse_datetime(message["timestamp"]), message["id"]
+
+
+class RoomArchive:
+    """The archive segments of one room."""
+
+    def __init__(self, room_id, root=None):
+        self.path = os.path.join(root or ARCHIVE_DIR, str(room_id))
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def months(self):
+        """Months with a segment, oldest first."""
+        if not self.exists():
+            return []
+        return sorted(name[:-len('.idx')] for name in os.listdir(self.path) if name.endswith('.idx'))
+
+    def segment(self, month):
+        """Return (data file path, compression) of a month's segment, if it exists."""
+        for compression, extension in EXTENSIONS.items():
+            path = os.path.join(self.path, month + extension)
+            if os.path.exists(path):
+                return path, compression
+        return None, None
+
+    def blocks(self, month):
+        """Index entries of a month's segment, oldest first."""
+        path = os.path.join(self.path, month + '.idx')
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r', encoding='utf-8') as index:
+            return [json.loads(line) for line in index if line.strip()]
+
+    def read_block(self, month, block):
+        path, compression = self.segment(month)
+        with open(path, 'rb') as segment:
+            segment.seek(block["offset"])
+            data = decompress(segment.read(block["length"]), compression)
+        return [json.loads(line) for line in data.decode('utf-8').splitlines() if line]
+
+    def last_key(self):
+        """Key of the newest archived message, or None."""
+        for month in reversed(self.months()):
+            blocks = self.blocks(month)
+            if blocks:
+                timestamp, message_id = blocks[-1]["last"]
+                return parse_datetime(timestamp), message_id
+        return None
+
+    def append(self, month, messages, compression=ARCHIVE_COMPRESSION):
+        """
+        Append one block of serialized messages, in key order, to a month's
+        segment. The data is flushed to disk before its index line is written,
+        so an index entry never points at a partial block.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        path, existing = self.segment(month)
+        if path is None:
+            path = os.path.join(self.path, month + EXTENSIONS[compression])
+        else:
+            compression = existing
+
+        data = compress(
+            ''.join(json.dumps(message, separators=(',', ':')) + '\n' for message in messages).encode('utf-8'),
+            compression
+        )
+        with open(path, 'ab') as segment:
+            offset = segment.tell()
+            segment.write(data)
+            segment.flush()
+            os.fsync(segment.fileno())
+
+        entry = {
+            "offset": offset,
+            "length": len(data),
+            "count": len(messages),
+            "first": [messages[0]["timestamp"], messages[0]["id"]],
+            "last": [messages[-1]["timestamp"], messages[-1]["id"]],
+            "first_seq": messages[0].get("seq"),
+            "last_seq": messages[-1].get("seq"),
+        }
+        with open(os.path.join(self.path, month + '.idx'), 'a', encoding='utf-8') as index:
+            index.write(json.dumps(entry) + '\n')
+            index.flush()
+            os.fsync(index.fileno())
+
+    def read_before(self, before, limit):
+        """
+        Return up to `limit` archived messages older than the (timestamp, id)
+        key `before` (or the newest ones if None), newest first.
+        """
+        return list(islice(self.iter_before(before), limit))
+
+    def iter_before(self, before=None):
+        """Yield archived messages older than `before`, newest first, one block at a time."""
+        for month in reversed(self.months()):
+            for block in reversed(self.blocks(month)):
+                timestamp, message_id = block["first"]
+                if before is not None and (parse_datetime(timestamp), message_id) >= before:
+                    continue
+                messages = self.read_block(month, block)
+                if before is not None:
+                    messages = [message for message in messages if message_key(message) < before]
+                yield from reversed(messages)
+
+    def iter_after(self, after=None):
+        """Yield archived messages newer than `after`, oldest first, one block at a time."""
+        for month in self.months():
+            for block in self.blocks(month):
+                timestamp, message_id = block["last"]
+                if after is not None and (parse_datetime(timestamp), message_id) <= after:
+                    continue
+                messages = self.read_block(month, block)
+                if after is not None:
+                    messages = [message for message in messages if message_key(message) > after]
+                yield from messages
+
+    def read_all(self):
+        """Every archived message, oldest first."""
+        for month in self.months():
+            for block in self.blocks(month):
+                yield from self.read_block(month, block)
+
+    def delete(self):
+        shutil.rmtree(self.path, ignore_errors=True)
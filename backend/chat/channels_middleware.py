@@ -2,9 +2,9 @@
 from channels.db import database_sync_to_async
 from rest_framework.exceptions import AuthenticationFailed
 from django.db import close_old_connections
-from jwt import ExpiredSignatureError, InvalidTokenError, decode
-from django.conf import settings
-from userAuth.models import User
+from jwt import ExpiredSignatureError
+from userAuth.auth_cache import auth_cache
+from userAuth.tracing import NULL_TRACE, auth_tracer
 
 
 class JWTWebsocketMiddleware:
@@ -18,6 +18,9 @@ class JWTWebsocketMiddleware:
         # Ensure old database connections are closed
         close_old_connections()
 
+        # Sampled handshakes are timed per stage; the rest get a no-op trace
+        trace = auth_tracer.start('websocket', scope.get('path'))
+
         # Extract cookies from headers
         headers = dict(scope.get("headers", []))
         cookie_header = headers.get(b"cookie", b"").decode("utf-8")
@@ -26,20 +29,29 @@ class JWTWebsocketMiddleware:
         # Parse cookies
         cookies = self.parse_cookies(cookie_header)
         token = cookies.get("access_token")
+        trace.mark('extract', source='cookie' if token else None)
 
         if not token:
+            trace.finish('anonymous')
             await send({"type": "websocket.close", "code": 4000})
             return
 
+        trace.note(token=token)
         try:
-            user = await self.authenticate_user(token)
+            # A warm cache answers without a database query or thread hop
+            user = auth_cache.cached_user(token, trace)
+            if user is None:
+                user = await self.authenticate_user(token, trace)
             scope['user'] = user
+            trace.finish('ok', user_id=user.pk)
             
         except ExpiredSignatureError:
+            trace.finish('expired')
             # Close with 4001 to trigger frontend token refresh
             await send({"type": "websocket.close", "code": 4001})
             return
         except AuthenticationFailed as e:
+            trace.finish('rejected', reason=str(e.detail))
             await send({"type": "websocket.close", "code": 4002})
             return
 
@@ -63,33 +75,15 @@ class JWTWebsocketMiddleware:
         return cookies
 
     @database_sync_to_async
-    def authenticate_user(self, token):
+    def authenticate_user(self, token, trace=NULL_TRACE):
         """
         Authenticate the user using the provided JWT token.
         Raises ExpiredSignatureError separately so it can be handled differently.
         """
         try:
-            # Decode the JWT token
-            payload = decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-            
-            # Verify token type (should be 'access', not 'refresh')
-            token_type = payload.get("type")
-            if token_type != "access":
-                raise AuthenticationFailed(f"Invalid token type: {token_type}")
-            
-            # Extract user ID from the token payload
-            user_id = payload.get("id")
-            if not user_id:
-                raise AuthenticationFailed("Invalid token payload")
-            
-            # Fetch and return the user
-            user = User.objects.get(id=user_id)
-            return user
+            # Verifies the token (type, expiry, token version) and loads the user
+            return auth_cache.authenticate(token, trace)
             
         except ExpiredSignatureError:
             # Re-raise this so it can be caught separately in __call__
-            raise ExpiredSignatureError("Token has expired")
-        except InvalidTokenError as e:
-            raise AuthenticationFailed(f"Invalid token: {str(e)}")
-        except User.DoesNotExist:
-            raise AuthenticationFailed("User not found")
\ No newline at end of file
+            raise ExpiredSignatureError("Token has expired")
\ No newline at end of file
@@ -1,8 +1,37 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
 import json
-from chat.models import Message
-from datetime import datetime
+from chat import encoding
+from chat.encoding import BINARY_SUBPROTOCOL
+from chat.history_cache import HISTORY_CACHE_SIZE, build_page, history_cache
+from chat.archive import RoomArchive
+from chat.models import (
+    Message, group_room_id, record_room_activity, room_group_name, room_id_from_group, room_messages, room_pks
+)
+from chat.membership import membership_cache
+from chat.outbound import OutboundQueue
+from chat.serializers import get_display_name, serialize_message
+from chat.persistence import WRITE_BEHIND_ENABLED, message_queue
+from chat.presence import presence_tracker
+from chat.read_state import read_tracker
+from chat.sequences import current_seq, next_seq_db, record_seq_db, shared_sequences
+from chat.typing_state import typing_tracker
 from asgiref.sync import sync_to_async
+from backend.ratelimit import rate_limiter
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from urllib.parse import parse_qs
+
+HISTORY_PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+HISTORY_MAX_PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_MAX_PAGE_SIZE', 200)
+RESUME_MAX_GAP = getattr(settings, 'CHAT_RESUME_MAX_GAP', 500)
+MULTIPLEX_MAX_ROOMS = getattr(settings, 'CHAT_MULTIPLEX_MAX_ROOMS', 100)
+
+# Close code sent when the room of a connection is deleted
+CLOSE_ROOM_DELETED = 4004
+# Close code of handshakes by users who aren't members of the room
+CLOSE_NOT_MEMBER = 4003
 
 
 class PersonalChatConsumer(AsyncWebsocketConsumer):
@@ -13,151 +42,603 @@ class PersonalChatConsumer(AsyncWebsocketConsumer):
         
         self.user = request_user
         
-        # Accept the connection
-        await self.accept()
-        
         # Get room details
         room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f"chat_{room_id}"
-        
-        # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-        
-        # Fetch and send message history
-        history = await sync_to_async(self.fetch_message_history)()
+
+        # Only members get in; rejected before accept(), from cache when warm
+        if not await membership_cache.is_member(self.user.id, room_id):
+            await self.close(code=CLOSE_NOT_MEMBER)
+            return
+
+        await self.accept_protocol()
+        self.room_group_name = room_group_name(room_id)
         
-        await self.send(text_data=json.dumps({
-            "type": "message_history",
-            "messages": history
-        }))
+        # A reconnecting client sends the last sequence number it saw
+        await self.join_room(self.room_group_name, self.query_param('last_seq'))
         
 
     async def disconnect(self, close_code):
         
+        self.stop_outbound()
         if hasattr(self, 'room_group_name'):
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
+            await self.leave_room(self.room_group_name)
         
 
     async def receive(self, text_data=None, bytes_data=None):
         try:
-            if not text_data:
-                await self.send(text_data=json.dumps({
+            if not text_data and not bytes_data:
+                await self.send_frame({
                     "type": "error", 
                     "message": "Received empty message."
-                }))
+                })
                 return
 
-            data = json.loads(text_data)
-            message = data.get('message', '')
+            if bytes_data:
+                data = encoding.unpackb(bytes_data)
+            else:
+                data = encoding.loads(text_data)
 
-            if not message:
-                await self.send(text_data=json.dumps({
-                    "type": "error", 
-                    "message": "Message is empty."
-                }))
+            if data.get('type') == 'ack':
+                # Not addressed to a room: the client reports what it received
+                if not self.outbound.ack(data.get('received')):
+                    await self.send_frame({
+                        "type": "error",
+                        "message": "Invalid ack."
+                    })
                 return
 
-            request_user = self.scope['user']
-
-            if message == "typing":
-                # Get username for typing indicator
-                username = await sync_to_async(self.get_username)(request_user)
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "user_typing",
-                        "user": request_user.email,
-                        "username": username
-                    }
-                )
-            else:
-                # Save message to database
-                saved_message = await sync_to_async(self.save_message_to_db)(request_user, message)
-
-                # Broadcast new message with username
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "chat_message",
-                        "message": saved_message['message'],
-                        "user": saved_message['user'],
-                        "username": saved_message['username'],
-                        "timestamp": saved_message['timestamp']
-                    }
-                )
+            await self.dispatch_frame(data)
                 
         except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 "type": "error", 
                 "message": "Invalid JSON format."
-            }))
+            })
+        except encoding.FrameDecodeError:
+            await self.send_frame({
+                "type": "error",
+                "message": "Invalid MessagePack frame."
+            })
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 "type": "error", 
                 "message": "An error occurred."
-            }))
+            })
+
+    async def dispatch_frame(self, data):
+        """Route a decoded client frame; this consumer serves a single room."""
+        await self.handle_room_frame(self.room_group_name, data)
+
+    async def handle_room_frame(self, room, data):
+        """Handle a client frame addressed to one room."""
+        if data.get('type') == 'load_more':
+            await self.load_more(room, data)
+            return
+
+        if data.get('type') == 'mark_read':
+            await self.mark_read(room, data)
+            return
+
+        message = data.get('message', '')
+        if data.get('type') == 'typing':
+            message = "typing"
+
+        if not message:
+            await self.send_frame({
+                "type": "error", 
+                "room_id": group_room_id(room),
+                "message": "Message is empty."
+            })
+            return
+
+        request_user = self.scope['user']
+
+        # Reject floods before any database work
+        action = 'typing' if message == "typing" else 'message'
+        retry_after = await rate_limiter.acheck(action, *self.rate_limit_idents())
+        if retry_after:
+            if action == 'message':
+                await self.send_frame({
+                    "type": "error",
+                    "room_id": group_room_id(room),
+                    "message": "Rate limit exceeded.",
+                    "retry_after": round(retry_after, 3)
+                })
+            return
+
+        if message == "typing":
+            # Recorded in memory only; the tracker sends coalesced updates
+            typing_tracker.touch(
+                room,
+                request_user.email,
+                self.get_username(request_user),
+                self.channel_layer
+            )
+        else:
+            typing_tracker.stop(room, request_user.email)
+            await self.post_message(room, request_user, message)
+
+    async def accept_protocol(self):
+        """Accept the connection, switching to MessagePack frames if the client asked for them."""
+        self.binary = self.wants_binary_protocol()
+        if BINARY_SUBPROTOCOL in self.scope.get('subprotocols', []):
+            await self.accept(subprotocol=BINARY_SUBPROTOCOL)
+        else:
+            await self.accept()
+        # Frames to the client go through a bounded queue from here on
+        self.outbound = OutboundQueue(self.send, self.close)
+
+    def stop_outbound(self):
+        outbound = getattr(self, 'outbound', None)
+        if outbound is not None:
+            outbound.stop()
+
+    async def join_room(self, room, last_seq=None):
+        """Subscribe to a room's group and send its history, or only what was missed."""
+        # The history cache follows the room while we are subscribed
+        history_cache.subscribe(room)
+        await self.channel_layer.group_add(
+            room,
+            self.channel_name
+        )
+        await presence_tracker.join(
+            room,
+            self.user.email,
+            self.get_username(self.user),
+            self.channel_name,
+            self.channel_layer
+        )
+
+        if last_seq is None or not await self.resume(room, last_seq):
+            # Fetch and send the latest page of message history
+            history = await sync_to_async(self.fetch_message_history)(room)
+            
+            await self.send_frame({
+                "type": "message_history",
+                "room_id": group_room_id(room),
+                **history
+            })
+
+        # Full member list once; deltas follow as presence_update events
+        members = await presence_tracker.members(room)
+        await self.send_frame({
+            "type": "presence",
+            "room_id": group_room_id(room),
+            "users": members,
+            "online": len(members)
+        })
+
+    async def leave_room(self, room):
+        typing_tracker.stop(room, self.user.email)
+        await presence_tracker.leave(room, self.user.email, self.channel_name)
+        await self.channel_layer.group_discard(
+            room,
+            self.channel_name
+        )
+        history_cache.unsubscribe(room)
+
+    async def post_message(self, room, user, message):
+        """Save a message and broadcast it to the room."""
+        # Shared sequences are allocated here (write-behind requires them);
+        # otherwise the DB allocates them on save
+        seq = None
+        if shared_sequences is not None:
+            seq = await shared_sequences.allocate(room)
+
+        if WRITE_BEHIND_ENABLED:
+            # Only rooms with a Rooms row get a sequence number
+            saved_message = None
+            if seq is not None:
+                # Buffer for a batched insert; id and timestamp are assigned now
+                saved_message = self.serialize_message(
+                    message_queue.enqueue(user, room, message, seq)
+                )
+                history_cache.append_local(room, saved_message)
+        else:
+            # Save message to database
+            saved_message = await sync_to_async(self.save_message_to_db)(user, room, message, seq)
+
+        if saved_message is None:
+            await self.send_frame({
+                "type": "error",
+                "room_id": group_room_id(room),
+                "message": "Room not found."
+            })
+            return
+
+        # The sender has read everything up to their own message
+        if saved_message['seq'] is not None:
+            read_tracker.mark(room, user, self.get_username(user), saved_message['seq'], self.channel_layer)
+
+        # Broadcast new message with username, encoded once for all recipients
+        await self.channel_layer.group_send(
+            room,
+            {
+                "type": "chat_message",
+                "room": room,
+                "id": saved_message['id'],
+                **encoding.encode_broadcast({
+                    "type": "message",
+                    "room_id": group_room_id(room),
+                    **saved_message
+                })
+            }
+        )
+
+    async def resume(self, room, last_seq):
+        """
+        Send only the messages after `last_seq`. Returns False if the client
+        is too far behind (or sent a bad number) and needs the full history.
+        """
+        try:
+            last_seq = int(last_seq)
+        except (TypeError, ValueError):
+            return False
+
+        missed, current = await sync_to_async(self.fetch_missed_messages)(room, last_seq)
+        if missed is None:
+            await self.send_frame({
+                "type": "resume_gap",
+                "room_id": group_room_id(room),
+                "last_seq": current
+            })
+            return False
+
+        await self.send_frame({
+            "type": "resume",
+            "room_id": group_room_id(room),
+            "messages": missed,
+            "last_seq": missed[-1]["seq"] if missed else last_seq
+        })
+        return True
+
+    async def load_more(self, room, data):
+        """Send the page of messages older than the client's cursor."""
+        cursor = self.parse_cursor(data.get('cursor'))
+        if cursor is None:
+            await self.send_frame({
+                "type": "error",
+                "room_id": group_room_id(room),
+                "message": "Invalid cursor."
+            })
+            return
+
+        history = await sync_to_async(self.fetch_message_history)(
+            room,
+            before=cursor,
+            limit=data.get('limit')
+        )
+
+        await self.send_frame({
+            "type": "message_history_page",
+            "room_id": group_room_id(room),
+            **history
+        })
+
+    async def mark_read(self, room, data):
+        """Record the client's read position; it is written to the database in batches."""
+        seq = data.get('seq')
+        if not isinstance(seq, int) or isinstance(seq, bool) or seq < 1:
+            await self.send_frame({
+                "type": "error",
+                "room_id": group_room_id(room),
+                "message": "Invalid seq."
+            })
+            return
+        read_tracker.mark(room, self.user, self.get_username(self.user), seq, self.channel_layer)
+
+    async def send_frame(self, data):
+        """Encode a frame in the protocol this connection negotiated and queue it."""
+        if self.binary:
+            await self.outbound.put(bytes_data=encoding.packb(data))
+        else:
+            await self.outbound.put(text=encoding.dumps(data))
+
+    async def send_encoded(self, event, kind='message'):
+        """Queue a frame that the sender already encoded for every protocol."""
+        if self.binary:
+            await self.outbound.put(bytes_data=event['binary'], kind=kind, room=event.get('room'))
+        else:
+            await self.outbound.put(text=event['frame'], kind=kind, room=event.get('room'))
 
     async def chat_message(self, event):
-        """Send new message to WebSocket clients."""
-        await self.send(text_data=json.dumps({
-            "type": "message",
-            "message": event['message'],
-            "user": event['user'],
-            "username": event['username'],
-            "timestamp": event['timestamp']
-        }))
+        """Forward the pre-encoded new message frame to the client."""
+        history_cache.on_broadcast(event['room'], event)
+        await self.send_encoded(event)
 
     async def message_history(self, event):
         """Send chat history when requested."""
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             "type": "message_history",
             "messages": event["messages"]
-        }))
+        })
+
+    async def presence_update(self, event):
+        """Forward the pre-encoded presence delta to the client."""
+        await self.send_encoded(event)
 
-    async def user_typing(self, event):
-        """Notify all clients that a user is typing."""
-        await self.send(text_data=json.dumps({
-            "type": "typing",
-            "user": event["user"],
-            "username": event["username"]
-        }))
+    async def read_receipts(self, event):
+        """Forward the pre-encoded read receipts to the client."""
+        await self.send_encoded(event)
+
+    async def room_deleted(self, event):
+        """The room was deleted: tell the client and disconnect."""
+        await self.send_frame({
+            "type": "room_deleted",
+            "room_id": group_room_id(event['room'])
+        })
+        await self.leave_room(event['room'])
+        del self.room_group_name
+        await self.outbound.close(code=CLOSE_ROOM_DELETED)
+
+    async def users_typing(self, event):
+        """Forward the pre-encoded typing frame; it may be dropped or coalesced under load."""
+        await self.send_encoded(event, kind='typing')
+
+    def query_param(self, name):
+        """Return a query string parameter of the WebSocket URL, or None."""
+        query = parse_qs(self.scope.get('query_string', b'').decode('utf-8'))
+        values = query.get(name)
+        return values[0] if values else None
+
+    def rate_limit_idents(self):
+        """Identities whose token buckets a frame from this connection draws on."""
+        # The user only: everyone behind one NAT or proxy would share an IP bucket
+        return [f"user:{self.user.pk}"]
+
+    def wants_binary_protocol(self):
+        """Check the subprotocols and query string for a MessagePack request."""
+        if BINARY_SUBPROTOCOL in self.scope.get('subprotocols', []):
+            return True
+        return self.query_param('protocol') == 'msgpack'
 
     def get_username(self, user):
         """Get username or fallback to email prefix."""
-        if hasattr(user, 'username') and user.username:
-            return user.username
-        return user.email.split('@')[0]
-
-    def fetch_message_history(self):
-        """Fetch chat history from the database."""
-        messages = Message.objects.filter(chat_room=self.room_group_name).order_by('timestamp')
-        return [
-            {
-                "user": msg.user.email,
-                "username": self.get_username(msg.user),
-                "message": msg.message,
-                "timestamp": msg.timestamp.isoformat()
-            }
-            for msg in messages
-        ]
+        return get_display_name(user)
+
+    def parse_cursor(self, cursor):
+        """
+        Parse a {"timestamp": iso, "id": int} cursor into a (timestamp, id) tuple.
+        Returns None if the cursor is malformed.
+        """
+        if not isinstance(cursor, dict):
+            return None
+        try:
+            timestamp = parse_datetime(cursor.get('timestamp') or '')
+            message_id = int(cursor.get('id'))
+        except (TypeError, ValueError):
+            return None
+        if timestamp is None:
+            return None
+        return timestamp, message_id
+
+    def fetch_message_history(self, room, before=None, limit=None):
+        """
+        Fetch one page of chat history, from the hot cache when possible.
+
+        Uses keyset pagination on (timestamp, id) so each page costs the same
+        regardless of how deep into the history it is. Messages are returned
+        oldest first, along with the cursor for the next (older) page.
+        """
+        try:
+            limit = int(limit) if limit is not None else HISTORY_PAGE_SIZE
+        except (TypeError, ValueError):
+            limit = HISTORY_PAGE_SIZE
+        limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+        cached = history_cache.get_page(room, before, limit)
+        if cached is not None:
+            return cached
 
-    def save_message_to_db(self, user, message):
-        """Save message to the database."""
-        saved_message = Message.objects.create(
-            user=user,
-            chat_room=self.room_group_name,
-            message=message,
-            timestamp=datetime.now()
+        if before is None and history_cache.enabled:
+            # Read enough rows to fill the cache as well as answer this page
+            token = history_cache.fill_token(room)
+            page = self.query_message_history(room, None, max(limit, HISTORY_CACHE_SIZE))
+            history_cache.fill(room, page["messages"], page["has_more"], token)
+            return build_page(page["messages"], limit, page["has_more"])
+
+        return self.query_message_history(room, before, limit)
+
+    def query_message_history(self, room, before, limit):
+        """Read one page of chat history from the database."""
+        messages = (
+            room_messages(room)
+            .select_related('user')
+            .only('id', 'seq', 'message', 'timestamp', 'user__email', 'user__username')
+            .order_by('-timestamp', '-id')
         )
-        return {
-            "user": saved_message.user.email,
-            "username": self.get_username(saved_message.user),
-            "message": saved_message.message,
-            "timestamp": saved_message.timestamp.isoformat()
-        }
\ No newline at end of file
+        if before is not None:
+            timestamp, message_id = before
+            messages = messages.filter(
+                Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+            )
+
+        # Fetch one extra row to know whether an older page exists
+        page = list(messages[:limit + 1])
+        if before is None and WRITE_BEHIND_ENABLED:
+            # Include messages that were broadcast but not flushed yet
+            seen = {msg.id for msg in page}
+            page += [msg for msg in message_queue.pending_for(room) if msg.id not in seen]
+            page.sort(key=lambda msg: (msg.timestamp, msg.id), reverse=True)
+        has_more = len(page) > limit
+        page = page[:limit]
+        page.reverse()
+        messages = [self.serialize_message(msg) for msg in page]
+
+        if not has_more:
+            # The database ran out; older messages may have been archived
+            oldest = (page[0].timestamp, page[0].id) if page else before
+            archived, has_more = self.read_archive(room, oldest, limit - len(page))
+            messages = archived + messages
+
+        return build_page(messages, limit, has_more)
+
+    def read_archive(self, room, before, limit):
+        """
+        Read up to `limit` archived messages older than `before`, oldest first.
+        Returns (messages, has_more).
+        """
+        room_id = room_id_from_group(room)
+        if room_id is None:
+            return [], False
+        archive = RoomArchive(room_id)
+        if not archive.exists():
+            return [], False
+        archived = archive.read_before(before, limit + 1)
+        has_more = len(archived) > limit
+        messages = [
+            {key: value for key, value in message.items() if key != 'user_id'}
+            for message in reversed(archived[:limit])
+        ]
+        return messages, has_more
+
+    def fetch_missed_messages(self, room, last_seq):
+        """
+        Return (messages after last_seq, current seq), or (None, current seq)
+        if more than RESUME_MAX_GAP messages were missed.
+        """
+        missed = history_cache.get_since(room, last_seq)
+        if missed is None:
+            current = current_seq(room)
+            if current is None or last_seq > current:
+                # Room without sequence numbers, or a number from another room
+                return None, current
+            if current - last_seq > RESUME_MAX_GAP:
+                return None, current
+
+            messages = list(
+                room_messages(room)
+                .filter(seq__gt=last_seq)
+                .select_related('user')
+                .only('id', 'seq', 'message', 'timestamp', 'user__email', 'user__username')
+                .order_by('seq')[:RESUME_MAX_GAP + 1]
+            )
+            if WRITE_BEHIND_ENABLED:
+                seen = {msg.id for msg in messages}
+                messages += [
+                    msg for msg in message_queue.pending_for(room)
+                    if msg.seq is not None and msg.seq > last_seq and msg.id not in seen
+                ]
+                messages.sort(key=lambda msg: msg.seq)
+            missed = [self.serialize_message(msg) for msg in messages]
+
+        if len(missed) > RESUME_MAX_GAP:
+            # Only reached from the cache, which holds everything up to the latest message
+            return None, missed[-1]["seq"]
+        return missed, missed[-1]["seq"] if missed else last_seq
+
+    def serialize_message(self, msg):
+        """Convert a Message into the dict sent to clients."""
+        return serialize_message(msg)
+
+    def save_message_to_db(self, user, room, message, seq=None):
+        """
+        Save message to the database, numbering it within the room.
+        Returns None if the room does not exist.
+        """
+        room_pk = room_pks([room]).get(room)
+        if room_pk is None:
+            return None
+        with transaction.atomic():
+            if seq is None:
+                seq = next_seq_db(room)
+            else:
+                record_seq_db(room, seq)
+            saved_message = Message.objects.create(
+                user=user,
+                room_id=room_pk,
+                chat_room=room,
+                seq=seq,
+                message=message
+            )
+            record_room_activity(room_pk, [saved_message])
+        data = self.serialize_message(saved_message)
+        history_cache.append(room, data)
+        return data
+
+
+class MultiplexChatConsumer(PersonalChatConsumer):
+    """
+    One WebSocket for any number of rooms.
+
+    The client subscribes and unsubscribes with control frames
+    ({"type": "subscribe", "room_id": ..., "last_seq": ...} and
+    {"type": "unsubscribe", "room_id": ...}) and addresses every other frame
+    to a room with a "room_id" key. Room events sent back carry "room_id" too.
+    """
+
+    async def connect(self):
+        # User is already authenticated by middleware, once for all rooms
+        self.user = self.scope.get('user')
+        self.rooms = set()
+        await self.accept_protocol()
+
+    async def disconnect(self, close_code):
+        self.stop_outbound()
+        for room in list(self.rooms):
+            await self.leave_room(room)
+        self.rooms.clear()
+
+    async def room_deleted(self, event):
+        """The room was deleted: tell the client and drop the subscription."""
+        room = event['room']
+        if room not in self.rooms:
+            return
+        self.rooms.discard(room)
+        await self.leave_room(room)
+        await self.send_frame({
+            "type": "room_deleted",
+            "room_id": group_room_id(room)
+        })
+
+    async def dispatch_frame(self, data):
+        room_id = data.get('room_id')
+        if not room_id or not isinstance(room_id, str):
+            await self.send_frame({
+                "type": "error",
+                "message": "room_id is required."
+            })
+            return
+        room = room_group_name(room_id)
+        frame_type = data.get('type')
+
+        if frame_type == 'subscribe':
+            if room in self.rooms:
+                return
+            if len(self.rooms) >= MULTIPLEX_MAX_ROOMS:
+                await self.send_frame({
+                    "type": "error",
+                    "room_id": room_id,
+                    "message": "Too many rooms on one connection."
+                })
+                return
+            if not await membership_cache.is_member(self.user.id, room_id):
+                await self.send_frame({
+                    "type": "error",
+                    "room_id": room_id,
+                    "message": "Not a member of this room."
+                })
+                return
+            self.rooms.add(room)
+            await self.join_room(room, data.get('last_seq'))
+            return
+
+        if frame_type == 'unsubscribe':
+            if room in self.rooms:
+                self.rooms.discard(room)
+                await self.leave_room(room)
+            await self.send_frame({
+                "type": "unsubscribed",
+                "room_id": room_id
+            })
+            return
+
+        if room not in self.rooms:
+            await self.send_frame({
+                "type": "error",
+                "room_id": room_id,
+                "message": "Not subscribed to this room."
+            })
+            return
+
+        await self.handle_room_frame(room, data)
@@ -0,0 +1,78 @@
+"""
+Paginated user directory with prefix search.
+
+`/api/users/` used to serialize every user but the caller in one response.
+It now returns pages of `USER_DIRECTORY_PAGE_SIZE` users ordered by username,
+paginated with a username keyset (the unique index on username serves it),
+optionally filtered to usernames or emails starting with `?q=`, case
+insensitively. Migration userAuth 0003 adds the indexes that prefix search
+needs on SQLite and PostgreSQL.
+
+Rows are fetched with `.values()` and returned as they are. Each page has an
+ETag computed from its content, so a client revalidating an unchanged page
+with If-None-Match gets an empty 304.
+"""
+import base64
+import hashlib
+import json
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+
+User = get_user_model()
+
+USER_DIRECTORY_PAGE_SIZE = getattr(settings, 'USER_DIRECTORY_PAGE_SIZE', 50)
+USER_DIRECTORY_MAX_PAGE_SIZE = getattr(settings, 'USER_DIRECTORY_MAX_PAGE_SIZE', 200)
+
+DIRECTORY_FIELDS = ('id', 'username', 'email', 'first_name', 'last_name')
+
+
+def encode_cursor(username):
+    """Opaque cursor for the page after this username."""
+    data = json.dumps({"username": username}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Parse an encode_cursor value into a username, or None if malformed."""
+    try:
+        username = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))["username"]
+    except (TypeError, ValueError, KeyError):
+        return None
+    return username if isinstance(username, str) else None
+
+
+def directory_page(exclude_id, query='', after=None, limit=None):
+    """
+    One page of users other than `exclude_id`, by username, after the
+    username `after`. Returns {"users", "has_more", "next_cursor"}.
+    """
+    try:
+        limit = int(limit) if limit is not None else USER_DIRECTORY_PAGE_SIZE
+    except (TypeError, ValueError):
+        limit = USER_DIRECTORY_PAGE_SIZE
+    limit = max(1, min(limit, USER_DIRECTORY_MAX_PAGE_SIZE))
+
+    users = User.objects.exclude(id=exclude_id)
+    query = (query or '').strip()
+    if query:
+        users = users.filter(Q(username__istartswith=query) | Q(email__istartswith=query))
+    if after is not None:
+        users = users.filter(username__gt=after)
+
+    # One extra row tells whether there is another page
+    rows = list(users.order_by('username').values(*DIRECTORY_FIELDS)[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "users": rows,
+        "has_more": has_more,
+        "next_cursor": encode_cursor(rows[-1]["username"]) if has_more else None,
+    }
+
+
+def page_etag(page):
+    """Strong ETag of a directory page, from its content."""
+    data = json.dumps(page, sort_keys=True, separators=(',', ':'), default=str)
+    return '"%s"' % hashlib.sha256(data.encode('utf-8')).hexdigest()[:32]
@@ -0,0 +1,91 @@
+"""
+Encoding of WebSocket frames.
+
+Two wire protocols are supported:
+
+* JSON text frames (default), e.g. {"type": "message", "message": "hi", ...}
+* MessagePack binary frames, negotiated with the `chat.msgpack` subprotocol
+  or a `?protocol=msgpack` query parameter. A frame is a two element array
+  [type_tag, body] where type_tag is one of the integers in TYPE_TAGS and
+  body is the JSON frame without its "type" key.
+
+Room broadcasts are encoded once by the sender, in both protocols, and the
+results are carried through `group_send`, so every recipient forwards the
+same payload instead of serializing its own copy. orjson is used for JSON
+when it is installed.
+"""
+import json
+
+import msgpack
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BINARY_SUBPROTOCOL = "chat.msgpack"
+
+TYPE_TAGS = {
+    "message": 1,
+    "typing": 2,
+    "message_history": 3,
+    "message_history_page": 4,
+    "error": 5,
+    "load_more": 6,
+    "resume": 7,
+    "resume_gap": 8,
+    "subscribe": 9,
+    "unsubscribe": 10,
+    "unsubscribed": 11,
+    "presence": 12,
+    "room_deleted": 13,
+    "mark_read": 14,
+    "read": 15,
+    "ack": 16,
+}
+TAG_TYPES = {tag: frame_type for frame_type, tag in TYPE_TAGS.items()}
+
+
+class FrameDecodeError(ValueError):
+    """Raised when a binary frame is not a valid [type_tag, body] array."""
+
+
+def dumps(data):
+    """Encode a frame as compact JSON text."""
+    if orjson is not None:
+        return orjson.dumps(data).decode('utf-8')
+    return json.dumps(data, separators=(',', ':'))
+
+
+def loads(text):
+    """Decode a JSON frame. Raises json.JSONDecodeError on invalid input."""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def packb(data):
+    """Encode a frame as a MessagePack [type_tag, body] array."""
+    body = {key: value for key, value in data.items() if key != "type"}
+    return msgpack.packb([TYPE_TAGS[data["type"]], body], use_bin_type=True)
+
+
+def unpackb(payload):
+    """Decode a MessagePack frame back into the dict form used for JSON."""
+    try:
+        frame = msgpack.unpackb(payload, raw=False)
+    except (msgpack.UnpackException, ValueError) as e:
+        raise FrameDecodeError(str(e)) from e
+
+    if not isinstance(frame, (list, tuple)) or not frame or not isinstance(frame[0], int) \
+            or frame[0] not in TAG_TYPES:
+        raise FrameDecodeError("Expected a [type_tag, body] array")
+    body = frame[1] if len(frame) > 1 else {}
+    if not isinstance(body, dict):
+        raise FrameDecodeError("Frame body must be a map")
+    return {**body, "type": TAG_TYPES[frame[0]]}
+
+
+def encode_broadcast(data):
+    """Encode a frame once per protocol, for carrying through group_send."""
+    return {"frame": dumps(data), "binary": packb(data)}
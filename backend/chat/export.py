@@ -0,0 +1,159 @@
+"""
+Bulk export of a room's whole history as NDJSON.
+
+Used by `GET /rooms/<room_id>/export/` (staff only) and
+`manage.py export_room`. Each line is one message, oldest first, in the
+same shape as archive records:
+
+    {"id": 1, "seq": 1, "user": "...", "username": "...", "message": "...",
+     "timestamp": "...", "user_id": 4}
+
+Archived messages come first, read one archive block at a time. Then the
+database's, read with `.iterator()`: a server-side cursor on PostgreSQL,
+chunked fetches on SQLite, `CHAT_EXPORT_BATCH_SIZE` rows at a time. Lines
+are written out a batch at a time, optionally gzip-compressed as they go,
+so memory stays constant whatever the size of the room.
+
+Rows per second are logged when an export finishes, printed by the
+command, and kept in /chat/stats/. Messages still in the write-behind
+buffer are not exported. Avoid running `archive_messages` on a room while
+it is exported: messages it moves during the export can be left out.
+"""
+import json
+import logging
+import time
+import zlib
+
+from django.conf import settings
+
+from chat.archive import RoomArchive
+from chat.models import Message
+from chat.serializers import MESSAGE_VALUES, serialize_message_values
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = getattr(settings, 'CHAT_EXPORT_BATCH_SIZE', 2000)
+
+COMPRESSIONS = {
+    None: ('application/x-ndjson', '.ndjson'),
+    'gzip': ('application/gzip', '.ndjson.gz'),
+}
+
+
+class ExportStats:
+    """Totals of the exports run by this process."""
+
+    def __init__(self):
+        self.exports = 0
+        self.aborted = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.last = None
+
+    def record(self, export):
+        if not export.finished:
+            self.aborted += 1
+            return
+        self.exports += 1
+        self.rows += export.rows
+        self.seconds += export.elapsed
+        self.last = {
+            "room_id": str(export.room.room_id),
+            "rows": export.rows,
+            "bytes": export.bytes,
+            "seconds": round(export.elapsed, 3),
+            "rows_per_second": export.rows_per_second,
+        }
+
+    def stats(self):
+        return {
+            "exports": self.exports,
+            "aborted": self.aborted,
+            "rows": self.rows,
+            "rows_per_second": round(self.rows / self.seconds) if self.seconds else 0,
+            "last": self.last,
+        }
+
+
+export_stats = ExportStats()
+
+
+class RoomExport:
+    """One export of a room, produced as a stream of byte chunks."""
+
+    def __init__(self, room, compression=None, batch_size=EXPORT_BATCH_SIZE):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unsupported export compression: {compression}")
+        self.room = room
+        self.compression = compression
+        self.batch_size = max(1, batch_size)
+        self.rows = 0
+        self.bytes = 0
+        self.started = None
+        self.elapsed = 0.0
+        self.finished = False
+
+    @property
+    def content_type(self):
+        return COMPRESSIONS[self.compression][0]
+
+    @property
+    def filename(self):
+        return f"room-{self.room.room_id}{COMPRESSIONS[self.compression][1]}"
+
+    @property
+    def rows_per_second(self):
+        return round(self.rows / self.elapsed) if self.elapsed else 0
+
+    def records(self):
+        """Every message of the room, oldest first."""
+        archive = RoomArchive(self.room.room_id)
+        if archive.exists():
+            yield from archive.iter_after(None)
+
+        rows = (
+            Message.objects
+            .filter(room=self.room)
+            .order_by('timestamp', 'id')
+            .values(*MESSAGE_VALUES, 'user_id')
+            .iterator(chunk_size=self.batch_size)
+        )
+        for row in rows:
+            yield {**serialize_message_values(row), "user_id": row["user_id"]}
+
+    def batches(self):
+        """NDJSON lines, `batch_size` at a time, as bytes."""
+        lines = []
+        for record in self.records():
+            lines.append(json.dumps(record, separators=(',', ':')))
+            if len(lines) == self.batch_size:
+                self.rows += len(lines)
+                yield ('\n'.join(lines) + '\n').encode('utf-8')
+                lines = []
+        if lines:
+            self.rows += len(lines)
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def chunks(self):
+        """The export file's content, compressed if asked, in chunks of bytes."""
+        self.started = time.perf_counter()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if self.compression == 'gzip' else None
+        try:
+            for batch in self.batches():
+                chunk = compressor.compress(batch) if compressor else batch
+                self.elapsed = time.perf_counter() - self.started
+                if chunk:
+                    self.bytes += len(chunk)
+                    yield chunk
+            if compressor:
+                chunk = compressor.flush()
+                self.bytes += len(chunk)
+                yield chunk
+            self.elapsed = time.perf_counter() - self.started
+            self.finished = True
+            logger.info(
+                "Exported %d messages of room %s (%d bytes) in %.1fs, %d rows/s",
+                self.rows, self.room.room_id, self.bytes, self.elapsed, self.rows_per_second
+            )
+        finally:
+            export_stats.record(self)
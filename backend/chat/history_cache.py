@@ -0,0 +1,401 @@
+"""
+Hot cache of recent messages per room.
+
+Keeps the last `CHAT_HISTORY_CACHE_SIZE` serialized messages of each room so
+connects and `load_more` requests near the tail of a room are answered
+without touching the database.
+
+Two tiers:
+
+* In-process: an LRU of rooms with a global byte budget
+  (`CHAT_HISTORY_CACHE_MAX_BYTES`). A room is only cached while this process
+  has sockets subscribed to it, because those sockets receive every room
+  broadcast and keep the entry up to date, even for messages saved by other
+  processes.
+* Shared (optional): a Redis list per room, enabled by setting
+  `CHAT_HISTORY_CACHE_REDIS_URL`. Appends bump a per-room version counter
+  and a fill only lands if the version is unchanged since the database read,
+  so a slow fill never hides a newer message.
+"""
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from chat import encoding
+
+logger = logging.getLogger(__name__)
+
+HISTORY_CACHE_ENABLED = getattr(settings, 'CHAT_HISTORY_CACHE_ENABLED', True)
+HISTORY_CACHE_SIZE = getattr(settings, 'CHAT_HISTORY_CACHE_SIZE', 200)
+HISTORY_CACHE_MAX_BYTES = getattr(settings, 'CHAT_HISTORY_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+HISTORY_CACHE_REDIS_URL = getattr(settings, 'CHAT_HISTORY_CACHE_REDIS_URL', None)
+HISTORY_CACHE_REDIS_TTL = getattr(settings, 'CHAT_HISTORY_CACHE_REDIS_TTL', 3600)
+
+# Rough per-message overhead of the dict, tuple and set entries
+MESSAGE_OVERHEAD_BYTES = 400
+
+
+def message_key(message):
+    """Sort key of a serialized message: (timestamp, id)."""
+    return parse_datetime(message["timestamp"]), message["id"]
+
+
+def build_page(messages, limit, has_more):
+    """
+    Build a history page from the newest `limit` of `messages` (oldest first).
+    `has_more` says whether older messages exist beyond `messages`.
+    """
+    page = messages[-limit:]
+    has_more = has_more or len(messages) > limit
+    next_cursor = None
+    if has_more and page:
+        next_cursor = {"timestamp": page[0]["timestamp"], "id": page[0]["id"]}
+    return {
+        "messages": page,
+        "has_more": has_more,
+        "next_cursor": next_cursor
+    }
+
+
+class RoomHistory:
+    """Ring buffer of one room's newest messages, sorted by (timestamp, id)."""
+    __slots__ = ('entries', 'ids', 'loaded', 'truncated', 'size', 'subscribers')
+
+    def __init__(self):
+        self.entries = []   # [(key, message, size)]
+        self.ids = set()
+        self.loaded = False
+        self.truncated = False  # older messages exist that are not cached
+        self.size = 0
+        self.subscribers = 0
+
+    def add(self, message, capacity):
+        """Insert a message, returning the change in bytes."""
+        if message["id"] in self.ids:
+            return 0
+        size = MESSAGE_OVERHEAD_BYTES + len(message["message"]) + len(message["username"]) + len(message["user"])
+        entry = (message_key(message), message, size)
+        if not self.entries or entry[0] > self.entries[-1][0]:
+            self.entries.append(entry)
+        else:
+            # Keys are unique, so the tuple comparison never reaches the dict
+            bisect.insort(self.entries, entry)
+        self.ids.add(message["id"])
+        delta = size
+        while len(self.entries) > capacity:
+            _, dropped, dropped_size = self.entries.pop(0)
+            self.ids.discard(dropped["id"])
+            self.truncated = True
+            delta -= dropped_size
+        self.size += delta
+        return delta
+
+    def clear(self):
+        freed = self.size
+        self.entries = []
+        self.ids = set()
+        self.loaded = False
+        self.truncated = False
+        self.size = 0
+        return freed
+
+    def page(self, before, limit):
+        """Return a page from the buffer, or None if the buffer can't answer it."""
+        if before is None:
+            candidates = self.entries
+        else:
+            candidates = self.entries[:bisect.bisect_left(self.entries, (before,))]
+        if len(candidates) <= limit and self.truncated:
+            # Part of the page is older than what is cached
+            return None
+        return build_page([message for _, message, _ in candidates], limit, False)
+
+
+class RedisHistoryTier:
+    """Shared tier: one capped Redis list of JSON messages per room."""
+
+    # KEYS: list, version, meta. ARGV: expected version, ttl, has_more, messages...
+    FILL_SCRIPT = """
+    if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then return 0 end
+    redis.call('DEL', KEYS[1])
+    if #ARGV > 3 then redis.call('RPUSH', KEYS[1], unpack(ARGV, 4)) end
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    redis.call('SET', KEYS[3], ARGV[3], 'EX', ARGV[2])
+    return 1
+    """
+
+    # KEYS: list, version, meta. ARGV: message, capacity, ttl
+    APPEND_SCRIPT = """
+    redis.call('INCR', KEYS[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+    if redis.call('EXISTS', KEYS[3]) == 0 then return 0 end
+    if redis.call('RPUSH', KEYS[1], ARGV[1]) > tonumber(ARGV[2]) then
+        redis.call('LTRIM', KEYS[1], -tonumber(ARGV[2]), -1)
+        redis.call('SET', KEYS[3], '1', 'EX', ARGV[3])
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    redis.call('EXPIRE', KEYS[3], ARGV[3])
+    return 1
+    """
+
+    def __init__(self, url, capacity, ttl):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.capacity = capacity
+        self.ttl = ttl
+        self.fill_script = self.client.register_script(self.FILL_SCRIPT)
+        self.append_script = self.client.register_script(self.APPEND_SCRIPT)
+
+    def keys(self, room):
+        return [f"chat:history:{room}", f"chat:history:{room}:version", f"chat:history:{room}:meta"]
+
+    def version(self, room):
+        value = self.client.get(self.keys(room)[1])
+        return value.decode('utf-8') if value is not None else ''
+
+    def get(self, room):
+        """Return (messages, truncated) or None on a miss."""
+        list_key, _, meta_key = self.keys(room)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.lrange(list_key, 0, -1)
+        pipe.get(meta_key)
+        raw_messages, meta = pipe.execute()
+        if meta is None:
+            return None
+        # A write-behind flush may append a message the fill already included
+        messages, seen = [], set()
+        for raw in raw_messages:
+            message = encoding.loads(raw)
+            if message["id"] not in seen:
+                seen.add(message["id"])
+                messages.append(message)
+        return messages, meta == b'1'
+
+    def fill(self, room, messages, truncated, version):
+        self.fill_script(
+            keys=self.keys(room),
+            args=[version, self.ttl, '1' if truncated else '0'] + [encoding.dumps(m) for m in messages]
+        )
+
+    def append(self, room, message):
+        self.append_script(keys=self.keys(room), args=[encoding.dumps(message), self.capacity, self.ttl])
+
+
+class HistoryCache:
+    """Two-tier cache of recent room history."""
+
+    def __init__(self, capacity=HISTORY_CACHE_SIZE, max_bytes=HISTORY_CACHE_MAX_BYTES,
+                 redis_url=HISTORY_CACHE_REDIS_URL, redis_ttl=HISTORY_CACHE_REDIS_TTL,
+                 enabled=HISTORY_CACHE_ENABLED):
+        self.enabled = enabled
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.shared = RedisHistoryTier(redis_url, capacity, redis_ttl) if enabled and redis_url else None
+        self._rooms = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.shared_misses = 0
+        self.shared_errors = 0
+        self.evictions = 0
+
+    def subscribe(self, room):
+        """Start caching a room; call when a local socket joins its group."""
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self._rooms.get(room)
+            if entry is None:
+                entry = self._rooms[room] = RoomHistory()
+            entry.subscribers += 1
+
+    def unsubscribe(self, room):
+        """Drop the room once no local socket receives its broadcasts."""
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self._rooms.get(room)
+            if entry is None:
+                return
+            entry.subscribers -= 1
+            if entry.subscribers <= 0:
+                self.size -= entry.clear()
+                del self._rooms[room]
+
+    def get_page(self, room, before=None, limit=None):
+        """
+        Return a history page from the cache, or None on a miss.
+        `before` is a (timestamp, id) cursor as parsed by the consumer.
+        """
+        if not self.enabled:
+            return None
+        limit = limit or self.capacity
+        with self._lock:
+            entry = self._rooms.get(room)
+            if entry is not None and entry.loaded:
+                page = entry.page(before, limit)
+                if page is not None:
+                    self._rooms.move_to_end(room)
+                    self.hits += 1
+                    return page
+        if self.shared is not None and before is None:
+            try:
+                cached = self.shared.get(room)
+            except Exception:
+                self.shared_errors += 1
+                logger.warning("Shared history cache read failed for %s", room, exc_info=True)
+                cached = None
+            if cached is not None:
+                self.shared_hits += 1
+                messages, truncated = cached
+                self._fill_local(room, messages, truncated)
+                self.hits += 1
+                return build_page(messages, limit, truncated)
+            self.shared_misses += 1
+        self.misses += 1
+        return None
+
+    def get_since(self, room, seq):
+        """
+        Return the cached messages with a sequence number above `seq`, in
+        sequence order, or None if the cache can't tell.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._rooms.get(room)
+            if entry is not None and entry.loaded:
+                seqs = [message.get("seq") for _, message, _ in entry.entries]
+                covered = (
+                    None not in seqs
+                    and (not entry.truncated or (seqs and min(seqs) <= seq + 1))
+                    and (not seqs or seq <= max(seqs))
+                )
+                if covered:
+                    self._rooms.move_to_end(room)
+                    self.hits += 1
+                    missed = [message for _, message, _ in entry.entries if message["seq"] > seq]
+                    missed.sort(key=lambda message: message["seq"])
+                    return missed
+        self.misses += 1
+        return None
+
+    def fill_token(self, room):
+        """Read the shared tier's version before querying the database."""
+        if self.shared is None:
+            return None
+        try:
+            return self.shared.version(room)
+        except Exception:
+            self.shared_errors += 1
+            logger.warning("Shared history cache read failed for %s", room, exc_info=True)
+            return None
+
+    def fill(self, room, messages, truncated, token=None):
+        """Load the newest messages of a room (oldest first) read from the database."""
+        if not self.enabled:
+            return
+        messages = messages[-self.capacity:]
+        self._fill_local(room, messages, truncated)
+        if self.shared is not None and token is not None:
+            try:
+                self.shared.fill(room, messages, truncated, token)
+            except Exception:
+                self.shared_errors += 1
+                logger.warning("Shared history cache fill failed for %s", room, exc_info=True)
+
+    def append(self, room, message):
+        """Record a newly saved message in both tiers."""
+        self.append_local(room, message)
+        self.append_shared(room, message)
+
+    def append_local(self, room, message):
+        """Record a message in this process, if the room is cached here."""
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self._rooms.get(room)
+            if entry is None or message["id"] in entry.ids:
+                return
+            self.size += entry.add(message, self.capacity)
+            self._evict()
+
+    def append_shared(self, room, message):
+        """Record a message in the shared tier, if it already holds the room."""
+        if self.shared is None:
+            return
+        try:
+            self.shared.append(room, message)
+        except Exception:
+            self.shared_errors += 1
+            logger.warning("Shared history cache append failed for %s", room, exc_info=True)
+
+    def on_broadcast(self, room, event):
+        """Apply a chat_message broadcast; a no-op after the first local socket saw it."""
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self._rooms.get(room)
+            if entry is None or event["id"] in entry.ids:
+                return
+        message = encoding.loads(event["frame"])
+        message.pop("type", None)
+        self.append_local(room, message)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "rooms": len(self._rooms),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "shared": {
+                "enabled": self.shared is not None,
+                "hits": self.shared_hits,
+                "misses": self.shared_misses,
+                "errors": self.shared_errors,
+            },
+        }
+
+    def _fill_local(self, room, messages, truncated):
+        with self._lock:
+            entry = self._rooms.get(room)
+            if entry is None:
+                # Not subscribed here, so broadcasts would not keep it fresh
+                return
+            # Keep anything appended by broadcasts while the database was read
+            for message in messages:
+                self.size += entry.add(message, self.capacity)
+            entry.truncated = entry.truncated or truncated
+            entry.loaded = True
+            self._rooms.move_to_end(room)
+            self._evict()
+
+    def _evict(self):
+        # Least recently used rooms go first; subscribed rooms reload on next read
+        while self.size > self.max_bytes and self._rooms:
+            room, entry = next(iter(self._rooms.items()))
+            if entry.size == 0:
+                if len(self._rooms) == 1:
+                    break
+                self._rooms.move_to_end(room)
+                continue
+            self.size -= entry.clear()
+            self._rooms.move_to_end(room)
+            self.evictions += 1
+
+
+history_cache = HistoryCache()
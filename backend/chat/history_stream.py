@@ -0,0 +1,178 @@
+"""
+Streaming REST history.
+
+`GET /rooms/<room_id>/messages/` returns pages of up to
+`CHAT_HISTORY_STREAM_MAX_PAGE_SIZE` messages, far more than a WebSocket
+history page, without holding them in memory. Rows are read with a
+`.values()` projection joined to the sender's email and username, fetched
+with `.iterator()` in chunks of `CHAT_HISTORY_STREAM_CHUNK_SIZE`, and
+written out as JSON as they arrive. Archived messages are read one archive
+block at a time.
+
+Pages use the (timestamp, id) keyset with the same opaque cursors as
+search:
+
+* `before` (or no cursor): messages older than the cursor, newest first.
+  Archived messages follow the database's.
+* `after`: messages newer than the cursor, oldest first. Archived messages
+  come before the database's.
+* Both: the messages between the two cursors, oldest first.
+
+The body is {"room_id", "order", "messages": [...], "has_more",
+"next_cursor"}. The summary fields come last because they are only known
+once the messages have been written. To continue, pass `next_cursor` as
+the same parameter (`before` or `after`) again.
+
+Under ASGI, Django reads a synchronous streaming iterator to the end before
+sending anything. `aiter_chunks` avoids that: it runs the generator on the
+request's thread one chunk at a time and hands each chunk to the server.
+Under WSGI (and the test client) it is the other way around, so
+`streaming_chunks` only wraps the generator for ASGI requests.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Q
+
+from chat.archive import RoomArchive, message_key
+from chat.models import Message, room_group_name
+from chat.persistence import WRITE_BEHIND_ENABLED, message_queue
+from chat.search import encode_cursor
+from chat.serializers import MESSAGE_VALUES, serialize_message, serialize_message_values
+
+HISTORY_PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+HISTORY_STREAM_MAX_PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_STREAM_MAX_PAGE_SIZE', 10_000)
+HISTORY_STREAM_CHUNK_SIZE = getattr(settings, 'CHAT_HISTORY_STREAM_CHUNK_SIZE', 500)
+
+
+def page_limit(limit):
+    try:
+        limit = int(limit) if limit is not None else HISTORY_PAGE_SIZE
+    except (TypeError, ValueError):
+        limit = HISTORY_PAGE_SIZE
+    return max(1, min(limit, HISTORY_STREAM_MAX_PAGE_SIZE))
+
+
+def database_messages(room, before, after, ascending):
+    """Serialized messages of a room between the keys, read in chunks."""
+    messages = Message.objects.filter(room=room)
+    if before is not None:
+        timestamp, message_id = before
+        messages = messages.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id))
+    if after is not None:
+        timestamp, message_id = after
+        messages = messages.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id))
+    order = ('timestamp', 'id') if ascending else ('-timestamp', '-id')
+    rows = messages.order_by(*order).values(*MESSAGE_VALUES).iterator(chunk_size=HISTORY_STREAM_CHUNK_SIZE)
+    for row in rows:
+        yield serialize_message_values(row)
+
+
+def archived_messages(room, before, after, ascending):
+    archive = RoomArchive(room.room_id)
+    if not archive.exists():
+        return
+    if ascending:
+        messages = archive.iter_after(after)
+    else:
+        messages = archive.iter_before(before)
+    for message in messages:
+        key = message_key(message)
+        if (before is not None and key >= before) or (after is not None and key <= after):
+            return  # Past the other end of the range
+        yield {name: value for name, value in message.items() if name != 'user_id'}
+
+
+def pending_messages(room, after):
+    """Messages broadcast but not written to the database yet, oldest first."""
+    if not WRITE_BEHIND_ENABLED:
+        return []
+    pending = sorted(
+        message_queue.pending_for(room_group_name(str(room.room_id))),
+        key=lambda msg: (msg.timestamp, msg.id)
+    )
+    return [serialize_message(msg) for msg in pending if after is None or (msg.timestamp, msg.id) > after]
+
+
+def history_messages(room, before=None, after=None):
+    """Yield a room's serialized messages between the keys, oldest first if `after` is given."""
+    ascending = after is not None
+    # Only the newest end of the history can have unflushed messages
+    pending = pending_messages(room, after) if before is None else []
+    pending_ids = {message["id"] for message in pending}
+
+    if ascending:
+        yield from archived_messages(room, before, after, ascending)
+        for message in database_messages(room, before, after, ascending):
+            pending_ids.discard(message["id"])  # Flushed since
+            yield message
+        yield from (message for message in pending if message["id"] in pending_ids)
+    else:
+        yield from reversed(pending)
+        for message in database_messages(room, before, after, ascending):
+            if message["id"] not in pending_ids:
+                yield message
+        yield from archived_messages(room, before, after, ascending)
+
+
+def stream_page(room, before=None, after=None, limit=None):
+    """Yield the JSON body of one history page in chunks of bytes."""
+    limit = page_limit(limit)
+    ascending = after is not None
+    yield json.dumps({
+        "room_id": str(room.room_id),
+        "order": "asc" if ascending else "desc",
+    })[:-1].encode('utf-8') + b', "messages": ['
+
+    messages = history_messages(room, before, after)
+    count = 0
+    last = None
+    has_more = False
+    chunk = []
+    try:
+        for message in messages:
+            if count == limit:
+                has_more = True
+                break
+            chunk.append(json.dumps(message, separators=(',', ':')))
+            count += 1
+            last = message
+            if len(chunk) == HISTORY_STREAM_CHUNK_SIZE:
+                yield (',' if count > len(chunk) else '').encode('utf-8') + ','.join(chunk).encode('utf-8')
+                chunk = []
+    finally:
+        messages.close()
+    if chunk:
+        yield (',' if count > len(chunk) else '').encode('utf-8') + ','.join(chunk).encode('utf-8')
+
+    next_cursor = None
+    if has_more:
+        timestamp, message_id = message_key(last)
+        next_cursor = encode_cursor(timestamp, message_id)
+    yield b'], ' + json.dumps({"has_more": has_more, "next_cursor": next_cursor})[1:].encode('utf-8')
+
+
+def streaming_chunks(request, chunks):
+    """The chunk generator as the server serving `request` streams it best."""
+    # DRF wraps the Django request
+    if isinstance(getattr(request, '_request', request), ASGIRequest):
+        return aiter_chunks(chunks)
+    return chunks
+
+
+async def aiter_chunks(chunks):
+    """
+    Serve a synchronous chunk generator to ASGI as it is produced. Each chunk
+    is made on the request's thread, which also holds its database connection.
+    """
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+    try:
+        while True:
+            chunk = await next_chunk(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close, thread_sensitive=True)()
@@ -0,0 +1,71 @@
+import time
+from datetime import timedelta
+from itertools import groupby
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.archive import ARCHIVE_COMPRESSION, RoomArchive
+from chat.models import Message, Rooms
+from chat.serializers import serialize_archived_message
+
+RETENTION_DAYS = getattr(settings, 'CHAT_RETENTION_DAYS', None)
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages older than each room's retention period (Rooms.retention_days, "
+        "or CHAT_RETENTION_DAYS) from the database into the room's archive segments. "
+        "Meant to run periodically, e.g. daily from cron; safe to interrupt and rerun."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--block-size', type=int, default=2000, help="Messages per compressed archive block")
+        parser.add_argument('--sleep', type=float, default=0.0, help="Seconds to pause between blocks")
+        parser.add_argument('--room', help="Only archive this room_id")
+
+    def handle(self, *args, **options):
+        rooms = Rooms.objects.filter(deleted_at__isnull=True)
+        if options['room']:
+            rooms = rooms.filter(room_id=options['room'])
+
+        total = 0
+        for room in rooms.iterator():
+            days = room.retention_days if room.retention_days is not None else RETENTION_DAYS
+            if not days:
+                continue
+            archived = self.archive_room(room, timezone.now() - timedelta(days=days), options)
+            if archived:
+                self.stdout.write(f"  {room.chat_room_name} ({room.room_id}): {archived} messages archived")
+            total += archived
+
+        self.stdout.write(self.style.SUCCESS(f"Archived {total} messages ({ARCHIVE_COMPRESSION})."))
+
+    def archive_room(self, room, cutoff, options):
+        archive = RoomArchive(room.room_id)
+        # An interrupted run may have archived messages without deleting them yet
+        archived_until = archive.last_key()
+        archived = 0
+
+        while True:
+            batch = list(
+                Message.objects
+                .filter(room=room, timestamp__lt=cutoff)
+                .select_related('user')
+                .order_by('timestamp', 'id')[:options['block_size']]
+            )
+            if not batch:
+                return archived
+
+            fresh = [msg for msg in batch if archived_until is None or (msg.timestamp, msg.id) > archived_until]
+            for month, messages in groupby(fresh, key=lambda msg: msg.timestamp.strftime('%Y-%m')):
+                archive.append(month, [serialize_archived_message(msg) for msg in messages])
+            if fresh:
+                archived_until = (fresh[-1].timestamp, fresh[-1].id)
+
+            # Only delete once the block is safely on disk
+            Message.objects.filter(id__in=[msg.id for msg in batch]).delete()
+            archived += len(fresh)
+            if options['sleep']:
+                time.sleep(options['sleep'])
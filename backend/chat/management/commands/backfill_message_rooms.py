@@ -0,0 +1,72 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.models import Message, Rooms, rebuild_room_summary, room_group_name
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill Message.room from the chat_room group name. Works through the table "
+        "in short id-range batches, each in its own transaction, so writes are never "
+        "blocked for long. The summaries (message count, latest message) of the rooms "
+        "that gained messages are then recomputed. Safe to interrupt and run again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help="Message ids per batch")
+        parser.add_argument('--sleep', type=float, default=0.0, help="Seconds to pause between batches")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        pause = options['sleep']
+
+        rooms = {
+            room_group_name(room_id): pk
+            for room_id, pk in Rooms.objects.values_list('room_id', 'id').iterator()
+        }
+        pending = Message.objects.filter(room__isnull=True)
+
+        updated = orphaned = 0
+        touched = set()
+        last_id = None
+        started = time.perf_counter()
+        while True:
+            # Keyset over the primary key; write-behind ids are sparse, so ranges would crawl
+            ids = pending.order_by('id')
+            if last_id is not None:
+                ids = ids.filter(id__gt=last_id)
+            ids = list(ids.values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+
+            batch = pending.filter(id__gte=ids[0], id__lte=last_id)
+            for chat_room in set(batch.values_list('chat_room', flat=True)):
+                room_pk = rooms.get(chat_room)
+                if room_pk is None:
+                    # Messages of rooms that were deleted before the foreign key existed
+                    orphaned += batch.filter(chat_room=chat_room).count()
+                    continue
+                updated += batch.filter(chat_room=chat_room).update(room_id=room_pk)
+                touched.add(room_pk)
+
+            self.stdout.write(f"  up to id {last_id}: {updated} updated", ending='\r')
+            if pause:
+                time.sleep(pause)
+
+        if not updated and not orphaned:
+            self.stdout.write(self.style.SUCCESS("Nothing to backfill."))
+            return
+
+        # Counts kept since the foreign key existed missed the messages linked just now
+        for room_pk in touched:
+            rebuild_room_summary(room_pk)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(
+            f"Backfilled {updated} messages in {elapsed:.1f}s; "
+            f"{orphaned} messages belong to rooms that no longer exist. "
+            f"Recomputed the summary of {len(touched)} rooms."
+        ))
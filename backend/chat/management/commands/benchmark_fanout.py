@@ -0,0 +1,62 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat import encoding
+
+
+class Command(BaseCommand):
+    help = "Measure the per-recipient cost of encoding a room broadcast, per recipient vs. once per send."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=1000, help="Members in the simulated room")
+        parser.add_argument('--rounds', type=int, default=200, help="Broadcasts to simulate")
+        parser.add_argument('--message-size', type=int, default=200, help="Characters per chat message")
+
+    def handle(self, *args, **options):
+        recipients = options['recipients']
+        rounds = options['rounds']
+        event = {
+            "type": "chat_message",
+            "id": 361522568504065,
+            "message": "x" * options['message_size'],
+            "user": "alice@example.com",
+            "username": "alice",
+            "timestamp": "2026-01-01T12:00:00.000000+00:00",
+        }
+
+        def per_recipient():
+            # Old handlers: every recipient rebuilds the dict and serializes it
+            for _ in range(recipients):
+                json.dumps({
+                    "type": "message",
+                    "id": event['id'],
+                    "message": event['message'],
+                    "user": event['user'],
+                    "username": event['username'],
+                    "timestamp": event['timestamp']
+                })
+
+        def serialize_once():
+            # New handlers: the sender encodes once, recipients forward the text
+            frame = {"type": "chat_message", "frame": encoding.dumps({"type": "message", **event})}
+            for _ in range(recipients):
+                frame['frame']
+
+        self.stdout.write(
+            f"{recipients} recipients x {rounds} broadcasts, "
+            f"encoder: {'orjson' if encoding.orjson is not None else 'json'}"
+        )
+        results = {}
+        for name, fn in (("per-recipient json.dumps", per_recipient), ("serialize once", serialize_once)):
+            started = time.perf_counter()
+            for _ in range(rounds):
+                fn()
+            elapsed = time.perf_counter() - started
+            results[name] = elapsed
+            per_recipient_ns = elapsed / (rounds * recipients) * 1e9
+            self.stdout.write(f"  {name:<26} {elapsed * 1000:9.1f} ms total  {per_recipient_ns:8.1f} ns/recipient")
+
+        before, after = results.values()
+        self.stdout.write(self.style.SUCCESS(f"Speedup: {before / after:.1f}x"))
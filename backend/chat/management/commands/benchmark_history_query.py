@@ -0,0 +1,132 @@
+import os
+import random
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from chat.models import Message, Rooms, room_group_name, room_messages
+
+PAGE_SIZE = 50
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a separate benchmark database with messages and time history queries "
+        "filtering on the chat_room string against the indexed room foreign key."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10_000_000, help="Messages to seed")
+        parser.add_argument('--rooms', type=int, default=1000, help="Rooms to spread them over")
+        parser.add_argument('--queries', type=int, default=20, help="Rooms to query per benchmark")
+        parser.add_argument('--keepdb', action='store_true', help="Reuse an already seeded benchmark database")
+
+    def handle(self, *args, **options):
+        # Never touch the real database: run against Django's test database
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = os.path.join(
+                tempfile.gettempdir(), 'chat_benchmark_history.sqlite3'
+            )
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            if not Message.objects.exists():
+                self.seed(options['rows'], options['rooms'])
+            self.benchmark(options['queries'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+    def seed(self, rows, room_count):
+        started = time.perf_counter()
+        user = get_user_model().objects.create_user('bench@example.com', 'bench', 'bench')
+        Rooms.objects.bulk_create([
+            Rooms(room_id=uuid.uuid4(), chat_room_name=f"bench-{i}") for i in range(room_count)
+        ])
+        rooms = list(Rooms.objects.values_list('id', 'room_id'))
+        seqs = dict.fromkeys((pk for pk, _ in rooms), 0)
+
+        table = Message._meta.db_table
+        sql = (
+            f"INSERT INTO {table} (user_id, room_id, chat_room, seq, message, timestamp) "
+            f"VALUES (%s, %s, %s, %s, %s, %s)"
+        )
+        adapt = connection.ops.adapt_datetimefield_value
+        base = timezone.now() - timedelta(seconds=rows)
+        rng = random.Random(0)
+        batch = []
+        with connection.cursor() as cursor:
+            for i in range(rows):
+                pk, room_id = rooms[rng.randrange(room_count)]
+                seqs[pk] += 1
+                batch.append((
+                    user.pk, pk, room_group_name(room_id), seqs[pk],
+                    f"message {i}", adapt(base + timedelta(seconds=i))
+                ))
+                if len(batch) == 50_000:
+                    with transaction.atomic():
+                        cursor.executemany(sql, batch)
+                    batch = []
+                    self.stdout.write(f"  seeded {i + 1} rows", ending='\r')
+            if batch:
+                with transaction.atomic():
+                    cursor.executemany(sql, batch)
+        Rooms.objects.bulk_update(
+            [Rooms(id=pk, last_seq=seq) for pk, seq in seqs.items()], ['last_seq'], batch_size=1000
+        )
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(f"ANALYZE {table}")
+        self.stdout.write('')
+        self.stdout.write(f"Seeded {rows} messages in {room_count} rooms in {time.perf_counter() - started:.1f}s")
+
+    def benchmark(self, queries):
+        rows = Message.objects.count()
+        rooms = list(Rooms.objects.order_by('?').values_list('room_id', 'last_seq')[:queries])
+        self.stdout.write(f"{rows} messages, timing {len(rooms)} rooms per query")
+
+        def latest_page(messages):
+            return list(messages.order_by('-timestamp', '-id')[:PAGE_SIZE + 1])
+
+        def older_page(messages):
+            # Keyset page from the middle of the room's history
+            cursor = messages.order_by('-timestamp', '-id')[PAGE_SIZE * 20]
+            return list(
+                messages
+                .filter(Q(timestamp__lt=cursor.timestamp) | Q(timestamp=cursor.timestamp, id__lt=cursor.id))
+                .order_by('-timestamp', '-id')[:PAGE_SIZE + 1]
+            )
+
+        def resume(messages, last_seq):
+            return list(messages.filter(seq__gt=last_seq - PAGE_SIZE).order_by('seq'))
+
+        cases = (
+            ("latest page", lambda messages, last_seq: latest_page(messages)),
+            ("older page", lambda messages, last_seq: older_page(messages)),
+            ("resume (seq)", resume),
+        )
+        lookups = (
+            ("chat_room string", lambda room_id: Message.objects.filter(chat_room=room_group_name(room_id))),
+            ("room foreign key", lambda room_id: room_messages(room_group_name(room_id))),
+        )
+
+        for case, run in cases:
+            results = []
+            for name, lookup in lookups:
+                started = time.perf_counter()
+                for room_id, last_seq in rooms:
+                    run(lookup(room_id), last_seq)
+                elapsed_ms = (time.perf_counter() - started) * 1000 / len(rooms)
+                results.append(elapsed_ms)
+                self.stdout.write(f"  {case:<13} {name:<17} {elapsed_ms:10.2f} ms/query")
+            before, after = results
+            self.stdout.write(self.style.SUCCESS(f"  {case:<13} speedup {before / after:.0f}x"))
+
+        room_id = rooms[0][0]
+        self.stdout.write("Plan of the latest page query:")
+        self.stdout.write(room_messages(room_group_name(room_id)).order_by('-timestamp', '-id')[:PAGE_SIZE].explain())
@@ -0,0 +1,58 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.export import EXPORT_BATCH_SIZE, RoomExport
+from chat.models import Rooms, room_group_name, room_id_from_group
+
+
+class Command(BaseCommand):
+    help = (
+        "Export every message of a room, archived ones included, as NDJSON (one message per line, "
+        "oldest first), optionally gzip-compressed. Memory use doesn't depend on the size of the room."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_id', help="room_id of the room to export")
+        parser.add_argument('--output', '-o', default='-', help="File to write; '-' (default) for stdout")
+        parser.add_argument(
+            '--compression', choices=['gzip'],
+            help="Compress the output (default: gzip if --output ends in .gz, else none)"
+        )
+        parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE, help="Rows fetched per batch")
+        parser.add_argument('--progress', type=float, default=5.0, help="Seconds between progress lines")
+
+    def handle(self, *args, **options):
+        room = None
+        if room_id_from_group(room_group_name(options['room_id'])) is not None:
+            room = Rooms.objects.filter(room_id=options['room_id']).first()
+        if room is None:
+            raise CommandError(f"Room {options['room_id']} not found")
+        if room.deleted_at is not None:
+            self.stderr.write(f"Room {room.room_id} is deleted; exporting what hasn't been purged yet")
+
+        compression = options['compression']
+        if compression is None and options['output'].endswith('.gz'):
+            compression = 'gzip'
+        export = RoomExport(room, compression=compression, batch_size=options['batch_size'])
+
+        # Progress goes to stderr, so stdout can be piped
+        output = sys.stdout.buffer if options['output'] == '-' else open(options['output'], 'wb')
+        next_report = time.monotonic() + options['progress']
+        try:
+            for chunk in export.chunks():
+                output.write(chunk)
+                if time.monotonic() >= next_report:
+                    self.stderr.write(f"  {export.rows} messages, {export.rows_per_second} rows/s")
+                    next_report = time.monotonic() + options['progress']
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+            else:
+                output.flush()
+
+        self.stderr.write(self.style.SUCCESS(
+            f"Exported {export.rows} messages of {room.chat_room_name} ({room.room_id}), "
+            f"{export.bytes} bytes in {export.elapsed:.1f}s, {export.rows_per_second} rows/s."
+        ))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import RoomPurge
+from chat.purge import PURGE_BATCH_SIZE, PURGE_SLEEP_MS, purge_room, unfinished_purges
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the purges of deleted rooms that have not finished, including ones "
+        "interrupted by a restart or that failed. Don't run it while a server "
+        "process is still purging the same room."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=PURGE_BATCH_SIZE, help="Rows deleted per batch")
+        parser.add_argument('--sleep', type=int, default=PURGE_SLEEP_MS, help="Milliseconds to pause between batches")
+
+    def handle(self, *args, **options):
+        purges = list(unfinished_purges())
+        if not purges:
+            self.stdout.write(self.style.SUCCESS("No unfinished purges."))
+            return
+
+        for purge in purges:
+            self.stdout.write(f"Purging {purge.chat_room_name} ({purge.room_id}), {purge.status}...")
+            purge = purge_room(purge, batch_size=options['batch_size'], sleep_ms=options['sleep'])
+            if purge.status == RoomPurge.DONE:
+                self.stdout.write(self.style.SUCCESS(
+                    f"  deleted {purge.messages_deleted} messages, {purge.participants_deleted} participants"
+                ))
+            else:
+                self.stdout.write(self.style.ERROR(f"  failed: {purge.error}"))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from chat.models import Message
+from chat.search import SearchNotSupported, search_backend
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the full-text message search index if it is missing and reindex "
+        "every message in the database. New messages are indexed on insert, so this "
+        "is only needed for existing data, e.g. after restoring a backup."
+    )
+
+    def handle(self, *args, **options):
+        try:
+            backend = search_backend()
+        except SearchNotSupported as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(f"Rebuilding the {connection.vendor} search index...")
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {Message.objects.count()} messages."))
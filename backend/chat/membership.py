@@ -0,0 +1,203 @@
+"""
+Cached room membership checks.
+
+WebSocket handshakes and multiplex subscriptions only let members of a room
+(users with a RoomParticipant row, in a room that is not deleted) in. The
+answer is cached per (user, room) so a warm check does no database query:
+
+* In process memory by default, for `CHAT_MEMBERSHIP_CACHE_TTL` seconds
+  (members) or `CHAT_MEMBERSHIP_NEGATIVE_TTL` seconds (non-members).
+* In Redis with `CHAT_MEMBERSHIP_REDIS_URL`, one hash per room, so that an
+  invalidation reaches every server process at once.
+
+Views that change membership (`create_room`, `join_room`, `delete_room`)
+invalidate the affected entries. Without Redis, other processes only see
+the change once their entry expires, which is why non-members are cached
+for a short time only. If Redis is unreachable the database is asked.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from chat.models import RoomParticipant, room_group_name, room_id_from_group
+
+logger = logging.getLogger(__name__)
+
+MEMBERSHIP_CACHE_TTL = getattr(settings, 'CHAT_MEMBERSHIP_CACHE_TTL', 300)
+MEMBERSHIP_NEGATIVE_TTL = getattr(settings, 'CHAT_MEMBERSHIP_NEGATIVE_TTL', 5)
+MEMBERSHIP_REDIS_URL = getattr(settings, 'CHAT_MEMBERSHIP_REDIS_URL', None)
+MEMBERSHIP_CACHE_MAX_KEYS = getattr(settings, 'CHAT_MEMBERSHIP_CACHE_MAX_KEYS', 100_000)
+
+
+def is_member_db(user_id, room_id):
+    return RoomParticipant.objects.filter(
+        user_id=user_id,
+        room__room_id=room_id,
+        room__deleted_at__isnull=True
+    ).exists()
+
+
+class LocalMembershipStore:
+    """Membership answers in process memory, dropped least recently used first."""
+
+    def __init__(self, max_keys=MEMBERSHIP_CACHE_MAX_KEYS):
+        self.max_keys = max_keys
+        self._entries = OrderedDict()  # (room_id, user_id) -> (is_member, expires_at)
+        # Used from the event loop and from sync views' threads
+        self._lock = threading.Lock()
+
+    def get(self, room_id, user_id):
+        key = (room_id, user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, room_id, user_id, is_member, ttl):
+        with self._lock:
+            self._entries[(room_id, user_id)] = (is_member, time.monotonic() + ttl)
+            self._entries.move_to_end((room_id, user_id))
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+
+    def forget(self, room_id, user_id=None):
+        with self._lock:
+            if user_id is not None:
+                self._entries.pop((room_id, user_id), None)
+                return
+            for key in [key for key in self._entries if key[0] == room_id]:
+                del self._entries[key]
+
+
+class RedisMembershipStore:
+    """Membership answers in a Redis hash per room: user id -> "1" or "0"."""
+
+    # Hash fields can't expire on their own, so each one carries its expiry
+    GET_SCRIPT = """
+    local value = redis.call('HGET', KEYS[1], ARGV[1])
+    if not value then return false end
+    local clock = redis.call('TIME')
+    local sep = string.find(value, ':')
+    if tonumber(string.sub(value, sep + 1)) <= tonumber(clock[1]) then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+        return false
+    end
+    return string.sub(value, 1, sep - 1)
+    """
+
+    SET_SCRIPT = """
+    local clock = redis.call('TIME')
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2] .. ':' .. (tonumber(clock[1]) + tonumber(ARGV[3])))
+    if redis.call('TTL', KEYS[1]) < tonumber(ARGV[4]) then
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+    end
+    """
+
+    def __init__(self, url, max_ttl):
+        import redis
+        import redis.asyncio
+
+        self.max_ttl = int(max_ttl) + 1
+        self.client = redis.Redis.from_url(url)
+        self.async_client = redis.asyncio.Redis.from_url(url)
+        self.get_script = self.async_client.register_script(self.GET_SCRIPT)
+        self.set_script = self.async_client.register_script(self.SET_SCRIPT)
+
+    def key(self, room_id):
+        return f"chat:members:{room_id}"
+
+    async def get(self, room_id, user_id):
+        value = await self.get_script(keys=[self.key(room_id)], args=[user_id])
+        return None if value is None else value == b'1'
+
+    async def set(self, room_id, user_id, is_member, ttl):
+        await self.set_script(
+            keys=[self.key(room_id)],
+            args=[user_id, '1' if is_member else '0', int(ttl), self.max_ttl]
+        )
+
+    def forget(self, room_id, user_id=None):
+        if user_id is not None:
+            self.client.hdel(self.key(room_id), user_id)
+        else:
+            self.client.delete(self.key(room_id))
+
+
+class MembershipCache:
+    """Answer "is this user a member of this room?" from a cache, else the database."""
+
+    def __init__(self, ttl=MEMBERSHIP_CACHE_TTL, negative_ttl=MEMBERSHIP_NEGATIVE_TTL,
+                 redis_url=MEMBERSHIP_REDIS_URL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.local = LocalMembershipStore()
+        self.shared = RedisMembershipStore(redis_url, max(ttl, negative_ttl)) if redis_url else None
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    async def is_member(self, user_id, room_id):
+        """Check membership of a room, by its room_id, without blocking the event loop."""
+        room_id = room_id_from_group(room_group_name(room_id))
+        if room_id is None:
+            return False
+        room_id = str(room_id)
+
+        cached = None
+        if self.shared is not None:
+            try:
+                cached = await self.shared.get(room_id, user_id)
+            except Exception:
+                logger.exception("Membership cache lookup failed, asking the database")
+                self.errors += 1
+        else:
+            cached = self.local.get(room_id, user_id)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        is_member = await sync_to_async(is_member_db)(user_id, room_id)
+        ttl = self.ttl if is_member else self.negative_ttl
+        if self.shared is not None:
+            try:
+                await self.shared.set(room_id, user_id, is_member, ttl)
+            except Exception:
+                logger.exception("Membership cache update failed")
+                self.errors += 1
+        else:
+            self.local.set(room_id, user_id, is_member, ttl)
+        return is_member
+
+    def invalidate(self, room_id, user_id=None):
+        """Forget one user's membership of a room, or everyone's if user_id is None."""
+        room_id = str(room_id)
+        self.local.forget(room_id, user_id)
+        if self.shared is not None:
+            try:
+                self.shared.forget(room_id, user_id)
+            except Exception:
+                logger.exception("Membership cache invalidation failed")
+                self.errors += 1
+
+    def stats(self):
+        return {
+            "shared": self.shared is not None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+        }
+
+
+membership_cache = MembershipCache()
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.20 on 2026-10-18 13:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_alter_message_timestamp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='rooms',
+            name='last_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat_room', 'seq'], name='chat_message_room_seq_idx'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+from array import array
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 1000
+
+
+def backfill_message_seq(apps, schema_editor):
+    """
+    Number existing messages of every room in (timestamp, id) order.
+
+    Each batch of BATCH_SIZE rows is written in its own short transaction, so
+    the message table is never locked for the whole run. A room's ids are read
+    in full before its first write, so no cursor is open while writing.
+    Numbering is deterministic: an interrupted run can simply be started again.
+    """
+    Rooms = apps.get_model('chat', 'Rooms')
+    Message = apps.get_model('chat', 'Message')
+
+    for room_pk, room_id in list(Rooms.objects.values_list('pk', 'room_id')):
+        chat_room = f"chat_{room_id}"
+        ids = array('q', (
+            Message.objects
+            .filter(chat_room=chat_room)
+            .order_by('timestamp', 'id')
+            .values_list('id', flat=True)
+            .iterator(chunk_size=BATCH_SIZE)
+        ))
+        for start in range(0, len(ids), BATCH_SIZE):
+            batch = [
+                Message(id=message_id, seq=start + offset + 1)
+                for offset, message_id in enumerate(ids[start:start + BATCH_SIZE])
+            ]
+            with transaction.atomic():
+                Message.objects.bulk_update(batch, ['seq'])
+        Rooms.objects.filter(pk=room_pk).update(last_seq=len(ids))
+
+
+class Migration(migrations.Migration):
+
+    # Commit batch by batch instead of holding one transaction over the whole table
+    atomic = False
+
+    dependencies = [
+        ('chat', '0004_message_seq'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_message_seq, migrations.RunPython.noop, atomic=False),
+    ]
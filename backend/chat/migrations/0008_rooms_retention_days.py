@@ -0,0 +1,18 @@
+# Generated by Django 4.2.20 on 2026-10-18 13:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_room_purge'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rooms',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 4.2.20 on 2026-10-18 13:54
+
+from django.db import migrations, models
+from django.db.models import Q
+
+PREVIEW_LENGTH = 200
+
+
+def backfill_room_summary(apps, schema_editor):
+    """Fill in the summary of existing rooms from the messages still in the database."""
+    Rooms = apps.get_model('chat', 'Rooms')
+    Message = apps.get_model('chat', 'Message')
+
+    for room in Rooms.objects.all().iterator():
+        # Message.room is only filled in by `backfill_message_rooms`, which may
+        # not have run yet: count the messages that only name the room too
+        messages = Message.objects.filter(
+            Q(room=room) | Q(room__isnull=True, chat_room=f"chat_{room.room_id}")
+        )
+        latest = messages.order_by('-timestamp', '-id').first()
+        if latest is None:
+            continue
+        room.message_count = messages.count()
+        room.last_message_at = latest.timestamp
+        room.last_message_preview = latest.message[:PREVIEW_LENGTH]
+        room.save(update_fields=['message_count', 'last_message_at', 'last_message_preview'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_rooms_retention_days'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rooms',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='rooms',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='rooms',
+            name='message_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_room_summary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.20 on 2026-10-18 13:56
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def mark_existing_read(apps, schema_editor):
+    """Start existing participants with everything read, rather than the whole history unread."""
+    Rooms = apps.get_model('chat', 'Rooms')
+    RoomParticipant = apps.get_model('chat', 'RoomParticipant')
+    RoomParticipant.objects.update(
+        last_read_seq=Subquery(Rooms.objects.filter(pk=OuterRef('room_id')).values('last_seq')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_rooms_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roomparticipant',
+            name='last_read_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(mark_existing_read, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,66 @@
+from django.db import migrations
+
+# Kept in sync with chat/search.py
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5(
+        message,
+        content='chat_message',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts(rowid, message) VALUES (new.id, new.message);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, message) VALUES ('delete', old.id, old.message);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_update AFTER UPDATE OF message ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        INSERT INTO chat_message_fts(rowid, message) VALUES (new.id, new.message);
+    END
+    """,
+    "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS chat_message_fts_insert",
+    "DROP TRIGGER IF EXISTS chat_message_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_message_fts_update",
+    "DROP TABLE IF EXISTS chat_message_fts",
+]
+
+POSTGRES_FORWARD = [
+    "CREATE INDEX IF NOT EXISTS chat_msg_fts_idx ON chat_message USING GIN (to_tsvector('simple', message))",
+]
+
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS chat_msg_fts_idx",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_participant_last_read_seq'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRES_BACKWARD}),
+        ),
+    ]
@@ -1,28 +1,146 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Coalesce, Greatest
 from django.conf import settings  
+from django.utils import timezone
 import uuid
 
+# Characters of the latest message kept on Rooms for room lists
+PREVIEW_LENGTH = 200
+
+
+def room_group_name(room_id):
+    """Channel-layer group (and Message.chat_room value) of a room."""
+    return f"chat_{room_id}"
+
+
+def group_room_id(group_name):
+    """Inverse of room_group_name."""
+    return group_name.partition('_')[2]
+
+
+def room_id_from_group(group_name):
+    """Return the Rooms.room_id for a "chat_<room_id>" group name, or None."""
+    prefix, _, room_id = group_name.partition('_')
+    if prefix != 'chat':
+        return None
+    try:
+        return uuid.UUID(room_id)
+    except ValueError:
+        return None
+
+
+def room_messages(group_name):
+    """Messages of the room behind a group name; none if there is no such room."""
+    room_id = room_id_from_group(group_name)
+    if room_id is None:
+        return Message.objects.none()
+    return Message.objects.filter(room__room_id=room_id, room__deleted_at__isnull=True)
+
+
+def room_pks(group_names):
+    """Map group names to Rooms primary keys, leaving out unknown and deleted rooms."""
+    room_ids = {room_id_from_group(name): name for name in group_names}
+    room_ids.pop(None, None)
+    if not room_ids:
+        return {}
+    return {
+        room_ids[room_id]: pk
+        for room_id, pk in (
+            Rooms.objects
+            .filter(room_id__in=room_ids, deleted_at__isnull=True)
+            .values_list('room_id', 'id')
+        )
+    }
+
+
+def record_room_activity(room_pk, messages):
+    """
+    Fold newly saved messages into the room's summary (message count and
+    latest message) with a single UPDATE, so concurrent writers never lose
+    a count or move the preview back to an older message. Call in the
+    transaction that inserts the messages.
+    """
+    if not messages:
+        return
+    latest = max(messages, key=lambda msg: (msg.timestamp, msg.id))
+    is_latest = Q(last_message_at__isnull=True) | Q(last_message_at__lte=latest.timestamp)
+    Rooms.objects.filter(pk=room_pk).update(
+        message_count=F('message_count') + len(messages),
+        last_message_preview=Case(
+            When(is_latest, then=Value(latest.message[:PREVIEW_LENGTH])),
+            default=F('last_message_preview')
+        ),
+        last_message_at=Greatest(Coalesce(F('last_message_at'), Value(latest.timestamp)), Value(latest.timestamp)),
+    )
+
+
+def rebuild_room_summary(room_pk):
+    """
+    Recompute a room's summary from all of its linked messages, e.g. after
+    `backfill_message_rooms` linked old ones. The room row stays locked
+    meanwhile, so record_room_activity can't interleave.
+    """
+    with transaction.atomic():
+        if not Rooms.objects.select_for_update().filter(pk=room_pk).exists():
+            return
+        messages = Message.objects.filter(room_id=room_pk)
+        latest = messages.order_by('-timestamp', '-id').values('message', 'timestamp').first()
+        Rooms.objects.filter(pk=room_pk).update(
+            message_count=messages.count(),
+            last_message_preview=latest['message'][:PREVIEW_LENGTH] if latest else '',
+            last_message_at=latest['timestamp'] if latest else None,
+        )
+
+
 class Message(models.Model):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
         related_name='messages'
     )
+    room = models.ForeignKey(
+        'Rooms',
+        on_delete=models.CASCADE,
+        related_name='messages',
+        null=True,
+        blank=True,
+        # Covered by the (room, ...) indexes below
+        db_index=False
+    )
+    # Group name of the room; superseded by `room`, kept until every row is backfilled
     chat_room = models.CharField(max_length=255)  
+    # Per-room sequence number, allocated from Rooms.last_seq; None for rooms without a Rooms row
+    seq = models.BigIntegerField(null=True, blank=True)
     message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add so write-behind saves keep the timestamp that was broadcast
+    timestamp = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
         return f"{self.user.email}: {self.message[:30]}"
 
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_msg_room_time_idx'),
+            models.Index(fields=['room', 'seq'], name='chat_msg_room_seq_idx'),
+        ]
 
 
 class Rooms(models.Model):
     room_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     chat_room_name = models.CharField(max_length=255)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Sequence number of the latest message in the room
+    last_seq = models.BigIntegerField(default=0)
+    # Set when the room is deleted; the row goes away once its RoomPurge finishes
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    # Days messages stay in the database before being archived; None uses CHAT_RETENTION_DAYS
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+    # Summary of the room's messages for room lists, kept up to date by record_room_activity
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default='')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    message_count = models.BigIntegerField(default=0)
 
     def __str__(self):
         return f"{self.chat_room_name} ({self.room_id})"
@@ -36,9 +154,47 @@ class RoomParticipant(models.Model):
         on_delete=models.CASCADE
     )
     joined_at = models.DateTimeField(auto_now_add=True)
+    # Sequence number of the last message the user has read; unread = room.last_seq - last_read_seq
+    last_read_seq = models.BigIntegerField(default=0)
 
     class Meta:
         unique_together = ['room', 'user']  # Prevent duplicate participants
 
     def __str__(self):
-        return f"{self.user.email} in {self.room.chat_room_name}"
\ No newline at end of file
+        return f"{self.user.email} in {self.room.chat_room_name}"
+
+
+class RoomPurge(models.Model):
+    """Background deletion of a room's messages and participants, in batches."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    # Not a foreign key: the purge record outlives the room
+    room_id = models.UUIDField(unique=True)
+    chat_room_name = models.CharField(max_length=255)
+    requested_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name="room_purges",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True
+    )
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    messages_total = models.BigIntegerField(default=0)
+    messages_deleted = models.BigIntegerField(default=0)
+    participants_deleted = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Purge of {self.chat_room_name} ({self.status})"
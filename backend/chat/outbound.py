@@ -0,0 +1,231 @@
+"""
+Per-connection outbound queue.
+
+Consumers hand frames to a bounded queue that a writer task drains to the
+socket, so a client with a stalled TCP window only backs up its own queue
+instead of blocking the consumer from reading its channel (which is what
+fills the channel layer and raises "channel full" for everyone).
+
+When the queue is full, `CHAT_OUTBOUND_POLICY` decides what happens:
+
+* "drop_typing" (default): discard queued typing frames, then incoming ones.
+  If only chat messages are queued the client is disconnected.
+* "coalesce": keep at most one pending typing frame per room, replacing it
+  with the newest one. Typing frames are full snapshots, so nothing is lost.
+  Disconnects when the queue is full of chat messages.
+* "disconnect": disconnect as soon as the queue is full.
+
+The queue only fills up while send() blocks, which depends on the server:
+Daphne buffers every frame it is given, so a slow client never backs up the
+queue there. Clients can therefore acknowledge what they received with
+{"type": "ack", "received": N}, N being the frames received on the
+connection so far. From a connection's first ack on, frames sent but not
+acknowledged count against the queue size as well, whatever the server.
+
+Slow clients are closed with CLOSE_SLOW_CONSUMER, after which they can
+reconnect with ?last_seq=N and resume without refetching the history.
+"""
+import asyncio
+import logging
+import time
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_QUEUE_SIZE = getattr(settings, 'CHAT_OUTBOUND_QUEUE_SIZE', 256)
+OUTBOUND_POLICY = getattr(settings, 'CHAT_OUTBOUND_POLICY', 'drop_typing')
+
+# Close code for evicted slow consumers; clients should reconnect and resume
+CLOSE_SLOW_CONSUMER = 4008
+
+POLICIES = ('drop_typing', 'coalesce', 'disconnect')
+
+
+class OutboundItem:
+    __slots__ = ('kind', 'room', 'text', 'bytes', 'enqueued_at')
+
+    def __init__(self, kind, room, text, bytes_data):
+        self.kind = kind
+        self.room = room
+        self.text = text
+        self.bytes = bytes_data
+        self.enqueued_at = time.monotonic()
+
+
+class OutboundStats:
+    """Process-wide totals across all connections."""
+
+    def __init__(self):
+        self.queues = weakref.WeakSet()
+        self.dropped = 0
+        self.coalesced = 0
+        self.evicted = 0
+
+    def snapshot(self):
+        queues = list(self.queues)
+        return {
+            "connections": len(queues),
+            "policy": OUTBOUND_POLICY,
+            "queue_size": OUTBOUND_QUEUE_SIZE,
+            "max_depth": max((queue.depth for queue in queues), default=0),
+            "max_unacked": max((queue.unacked for queue in queues), default=0),
+            "max_lag_ms": round(max((queue.max_lag_ms for queue in queues), default=0.0), 3),
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "evicted": self.evicted,
+        }
+
+
+outbound_stats = OutboundStats()
+
+
+class OutboundQueue:
+    """Bounded queue of frames for one connection, drained by a writer task."""
+
+    def __init__(self, send, close, maxsize=OUTBOUND_QUEUE_SIZE, policy=OUTBOUND_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown outbound policy: {policy}")
+        self._send = send
+        self._close = close
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self._items = deque()
+        self._typing = {}  # room -> pending typing item, for coalescing
+        self._ready = asyncio.Event()
+        self._writer = asyncio.get_running_loop().create_task(self._drain())
+        self.closed = False
+        self.close_code = None
+        self.acked = None  # Frames the client reported receiving; None until it acks
+
+        # Per-connection lag metrics
+        self.max_depth = 0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+        outbound_stats.queues.add(self)
+
+    @property
+    def depth(self):
+        return len(self._items)
+
+    @property
+    def unacked(self):
+        """Frames sent that the client hasn't acknowledged, 0 if it never acks."""
+        return 0 if self.acked is None else self.sent - self.acked
+
+    def ack(self, received):
+        """Record the client's count of frames received. Returns False if it isn't one."""
+        if not isinstance(received, int) or isinstance(received, bool) or received < 0:
+            return False
+        # Acks can't go backwards, nor past what was sent
+        self.acked = max(self.acked or 0, min(received, self.sent))
+        return True
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "unacked": self.unacked,
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "last_lag_ms": round(self.last_lag_ms, 3),
+            "max_lag_ms": round(self.max_lag_ms, 3),
+        }
+
+    async def put(self, text=None, bytes_data=None, kind='message', room=None):
+        """Queue a frame. kind is 'typing' for frames that may be dropped or coalesced."""
+        if self.closed:
+            return
+
+        if kind == 'typing' and self.policy == 'coalesce':
+            pending = self._typing.get(room)
+            if pending is not None:
+                pending.text, pending.bytes = text, bytes_data
+                self.coalesced += 1
+                outbound_stats.coalesced += 1
+                return
+
+        if len(self._items) + self.unacked >= self.maxsize:
+            if kind == 'typing' and self.policy != 'disconnect':
+                self._drop()
+                return
+            if self.policy == 'drop_typing' and self._drop_queued_typing():
+                pass
+            else:
+                await self.evict()
+                return
+
+        item = OutboundItem(kind, room, text, bytes_data)
+        self._items.append(item)
+        if kind == 'typing':
+            self._typing[room] = item
+        self.max_depth = max(self.max_depth, len(self._items))
+        self._ready.set()
+
+    async def close(self, code=None):
+        """Close the connection once the frames queued so far are sent."""
+        if self.closed:
+            return
+        self.close_code = code
+        self._items.append(OutboundItem('close', None, None, None))
+        self._ready.set()
+
+    async def evict(self):
+        """Disconnect a client that can't keep up."""
+        logger.info("Closing slow consumer with %d queued frames", len(self._items))
+        outbound_stats.evicted += 1
+        self.stop()
+        await self._close(code=CLOSE_SLOW_CONSUMER)
+
+    def stop(self):
+        """Discard queued frames and stop the writer."""
+        self.closed = True
+        self._items.clear()
+        self._typing.clear()
+        self._writer.cancel()
+        outbound_stats.queues.discard(self)
+
+    def _drop(self):
+        self.dropped += 1
+        outbound_stats.dropped += 1
+
+    def _drop_queued_typing(self):
+        for item in self._items:
+            if item.kind == 'typing':
+                self._items.remove(item)
+                if self._typing.get(item.room) is item:
+                    del self._typing[item.room]
+                self._drop()
+                return True
+        return False
+
+    async def _drain(self):
+        try:
+            while True:
+                while not self._items:
+                    self._ready.clear()
+                    await self._ready.wait()
+                item = self._items.popleft()
+                if item.kind == 'close':
+                    self.closed = True
+                    await self._close(code=self.close_code)
+                    return
+                if item.kind == 'typing' and self._typing.get(item.room) is item:
+                    del self._typing[item.room]
+
+                lag_ms = (time.monotonic() - item.enqueued_at) * 1000
+                self.last_lag_ms = lag_ms
+                self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+                await self._send(text_data=item.text, bytes_data=item.bytes)
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Outbound writer stopped")
+            self.closed = True
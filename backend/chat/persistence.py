@@ -0,0 +1,305 @@
+"""
+Write-behind persistence for chat messages.
+
+Instead of one INSERT/COMMIT per message, messages are given a server-assigned
+id and timestamp, broadcast straight away and buffered in a per-process queue.
+The queue is flushed with `bulk_create` every `CHAT_WRITE_BEHIND_BATCH_SIZE`
+messages or every `CHAT_WRITE_BEHIND_FLUSH_MS` milliseconds, whichever comes
+first, and once more when the process exits.
+
+Message ids embed a node id, so every server process that writes behind
+needs its own `CHAT_WRITE_BEHIND_NODE_ID` (0-255); the process refuses to
+start without one. An id that collides with an existing row can only come
+from two processes sharing a node id; such a message is not saved, since
+clients already hold its id, and the collision is logged as critical.
+
+Sequence numbers must come from Redis (`CHAT_SEQUENCE_REDIS_URL`), or each
+message would still wait for a row-locking database transaction; the
+process refuses to start with write-behind on and no shared sequences.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from chat.history_cache import history_cache
+from chat.models import Message, record_room_activity, room_pks
+from chat.sequences import record_seq_db, shared_sequences
+from chat.serializers import serialize_message
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_ENABLED = getattr(settings, 'CHAT_WRITE_BEHIND_ENABLED', False)
+WRITE_BEHIND_BATCH_SIZE = getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 100)
+WRITE_BEHIND_FLUSH_MS = getattr(settings, 'CHAT_WRITE_BEHIND_FLUSH_MS', 200)
+WRITE_BEHIND_NODE_ID = getattr(settings, 'CHAT_WRITE_BEHIND_NODE_ID', None)
+
+
+class MessageIdGenerator:
+    """
+    Generate unique, time-ordered 53-bit message ids without a DB round trip.
+
+    Layout: 41 bits of milliseconds since EPOCH_MS, 8 bits of node id and
+    4 bits of per-millisecond sequence, so ids stay below 2**53 and survive
+    JSON parsing in browsers. Ids are far above anything the database
+    sequence hands out, so both can coexist in the same table. Each process
+    must have its own node id, or their ids collide.
+    """
+    EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+    NODE_BITS = 8
+    SEQUENCE_BITS = 4
+
+    def __init__(self, node_id):
+        if not 0 <= node_id < (1 << self.NODE_BITS):
+            raise ImproperlyConfigured(
+                f"CHAT_WRITE_BEHIND_NODE_ID must be between 0 and {(1 << self.NODE_BITS) - 1}"
+            )
+        self.node_id = node_id
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now_ms = int(time.time() * 1000) - self.EPOCH_MS
+            # Never go backwards, even if the wall clock does
+            if now_ms <= self._last_ms:
+                now_ms = self._last_ms
+                self._sequence = (self._sequence + 1) & ((1 << self.SEQUENCE_BITS) - 1)
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond, borrow the next one
+                    now_ms += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            return (
+                (now_ms << (self.NODE_BITS + self.SEQUENCE_BITS))
+                | (self.node_id << self.SEQUENCE_BITS)
+                | self._sequence
+            )
+
+
+class MessageWriteBehindQueue:
+    """
+    Per-process buffer of unsaved messages, flushed in batches by a
+    background task on the event loop.
+    """
+
+    def __init__(self, batch_size=WRITE_BEHIND_BATCH_SIZE, flush_ms=WRITE_BEHIND_FLUSH_MS,
+                 node_id=WRITE_BEHIND_NODE_ID, enabled=WRITE_BEHIND_ENABLED, sequences=shared_sequences):
+        if enabled and sequences is None:
+            raise ImproperlyConfigured(
+                "CHAT_WRITE_BEHIND_ENABLED needs CHAT_SEQUENCE_REDIS_URL: without shared sequences "
+                "every message would still take a database transaction"
+            )
+        if node_id is None:
+            if enabled:
+                raise ImproperlyConfigured(
+                    "CHAT_WRITE_BEHIND_ENABLED needs a CHAT_WRITE_BEHIND_NODE_ID unique to this server process"
+                )
+            node_id = 0  # The queue is never used
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(1, flush_ms) / 1000
+        self.id_generator = MessageIdGenerator(node_id)
+        self._pending = []
+        self._inflight = []
+        self._lock = threading.Lock()
+        # Held for a whole flush, so the shutdown flush waits for one in progress
+        self._flush_lock = threading.Lock()
+        self._wakeup = None
+        self._task = None
+        self._loop = None
+
+        # Counters
+        self.enqueued = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failed = 0
+        self.collisions = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def enqueue(self, user, chat_room, message, seq=None):
+        """
+        Buffer a message for saving and return it with its assigned id and
+        timestamp. Must be called from the event loop thread.
+        """
+        msg = Message(
+            id=self.id_generator.next_id(),
+            user=user,
+            chat_room=chat_room,
+            seq=seq,
+            message=message,
+            timestamp=timezone.now()
+        )
+        with self._lock:
+            self._pending.append(msg)
+            depth = len(self._pending)
+        self.enqueued += 1
+
+        self._ensure_flusher()
+        if depth >= self.batch_size:
+            self._wakeup.set()
+        return msg
+
+    def pending_for(self, chat_room):
+        """Return buffered messages for a room that are not yet in the DB."""
+        with self._lock:
+            return [msg for msg in self._inflight + self._pending if msg.chat_room == chat_room]
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    @property
+    def in_flight(self):
+        return len(self._inflight)
+
+    def stats(self):
+        return {
+            "queue_depth": self.depth,
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "failed": self.failed,
+            "id_collisions": self.collisions,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+            "max_flush_ms": round(self.max_flush_ms, 3),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 3) if self.flushes else 0.0,
+        }
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._pending:
+                await self.flush()
+
+    async def flush(self):
+        """Write everything currently buffered to the database."""
+        await sync_to_async(self.flush_sync, thread_sensitive=False)()
+
+    def flush_sync(self):
+        """Blocking flush, used by the background task and at shutdown."""
+        # Runs on executor threads outside any request, so recycle their
+        # connections the way Django's request cycle does
+        with self._flush_lock:
+            close_old_connections()
+            try:
+                self._flush_pending()
+            finally:
+                close_old_connections()
+
+    def _flush_pending(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+            self._inflight = batch
+
+        try:
+            for start in range(0, len(batch), self.batch_size):
+                self._write(batch[start:start + self.batch_size])
+        finally:
+            with self._lock:
+                self._inflight = []
+
+    def _write(self, batch):
+        started = time.perf_counter()
+        pks = room_pks({msg.chat_room for msg in batch})
+        for msg in batch:
+            msg.room_id = pks.get(msg.chat_room)
+        orphans = [msg for msg in batch if msg.room_id is None]
+        if orphans:
+            # The room was deleted after the messages were sent
+            self.failed += len(orphans)
+            logger.warning("Dropping %d messages for deleted rooms", len(orphans))
+            batch = [msg for msg in batch if msg.room_id is not None]
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+                self._record_activity(batch)
+            saved = batch
+        except Exception:
+            logger.exception("Bulk insert of %d messages failed, retrying one by one", len(batch))
+            saved = []
+            for msg in batch:
+                try:
+                    with transaction.atomic():
+                        msg.save(force_insert=True)
+                        record_room_activity(msg.room_id, [msg])
+                    saved.append(msg)
+                except IntegrityError:
+                    self.failed += 1
+                    if not Message.objects.filter(id=msg.id).exists():
+                        logger.exception("Dropping message %s for %s", msg.id, msg.chat_room)
+                        continue
+                    # Clients already have this id, so the message can't be saved under another
+                    self.collisions += 1
+                    logger.critical(
+                        "Dropping message %s for %s: its id is already taken. Another process "
+                        "must be using CHAT_WRITE_BEHIND_NODE_ID=%d; give each process its own.",
+                        msg.id, msg.chat_room, self.id_generator.node_id
+                    )
+                except Exception:
+                    self.failed += 1
+                    logger.exception("Dropping message %s for %s", msg.id, msg.chat_room)
+        written = len(saved)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.flushes += 1
+        self.flushed += written
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self.total_flush_ms += elapsed_ms
+        logger.debug("Flushed %d messages in %.1f ms", written, elapsed_ms)
+
+        # Other processes read the shared history tier, so only publish saved messages
+        for msg in saved:
+            history_cache.append_shared(msg.chat_room, serialize_message(msg))
+
+        if shared_sequences is not None:
+            # Sequence numbers came from Redis; move Rooms.last_seq up to match
+            last_seqs = {}
+            for msg in saved:
+                if msg.seq is not None:
+                    last_seqs[msg.chat_room] = max(msg.seq, last_seqs.get(msg.chat_room, 0))
+            for chat_room, seq in last_seqs.items():
+                record_seq_db(chat_room, seq)
+
+    def _record_activity(self, batch):
+        """Update the summary of every room in the batch, one UPDATE per room."""
+        by_room = {}
+        for msg in batch:
+            by_room.setdefault(msg.room_id, []).append(msg)
+        # Same order in every process, so concurrent flushes can't deadlock on the rows
+        for room_pk in sorted(by_room):
+            record_room_activity(room_pk, by_room[room_pk])
+
+
+message_queue = MessageWriteBehindQueue()
+
+
+@atexit.register
+def flush_on_shutdown():
+    """Durably write whatever is still buffered before the process exits."""
+    if message_queue.depth or message_queue.in_flight:
+        logger.info("Flushing %d buffered messages on shutdown", message_queue.depth)
+        # Waits for a flush that is still running on another thread first
+        message_queue.flush_sync()
@@ -0,0 +1,307 @@
+"""
+Room presence: who is online in each room.
+
+Members are stored with an expiry that every server process refreshes for
+its own connections once per `CHAT_PRESENCE_HEARTBEAT_MS`. If a process dies
+its members stop being refreshed and expire after `CHAT_PRESENCE_TTL_MS`, so
+a crashed node can't leave ghost users behind.
+
+Changes are broadcast as deltas ({"joined": [...], "left": [...]}) at most
+once per `CHAT_PRESENCE_DEBOUNCE_MS` per room; a join and leave inside one
+window cancel out. Clients get the full member list once, when they join.
+
+Members live in process memory by default. With `CHAT_PRESENCE_REDIS_URL`
+they are kept in a sorted set per room (score = expiry) shared by all
+processes. A user connected through several processes stays online until
+the last connection closes: leaving only shortens the member's expiry to
+one heartbeat, which another process refreshes if the user is still there.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from chat import encoding
+from chat.models import group_room_id
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_HEARTBEAT_MS = getattr(settings, 'CHAT_PRESENCE_HEARTBEAT_MS', 5000)
+PRESENCE_TTL_MS = getattr(settings, 'CHAT_PRESENCE_TTL_MS', 15000)
+PRESENCE_DEBOUNCE_MS = getattr(settings, 'CHAT_PRESENCE_DEBOUNCE_MS', 500)
+PRESENCE_REDIS_URL = getattr(settings, 'CHAT_PRESENCE_REDIS_URL', None)
+
+
+class LocalPresenceStore:
+    """
+    Room members in process memory.
+
+    The event loop changes members while sync views count them from worker
+    threads, so every access holds `_lock`.
+    """
+
+    def __init__(self):
+        self._rooms = {}  # room -> {user: [username, expires_at]}
+        self._lock = threading.Lock()
+
+    async def add(self, room, user, username, ttl):
+        """Add or refresh a member. Returns True if they were not online."""
+        with self._lock:
+            members = self._rooms.setdefault(room, {})
+            new = user not in members
+            members[user] = [username, time.monotonic() + ttl]
+        return new
+
+    async def remove(self, room, user, grace):
+        """Remove a member. Returns True if they went offline now."""
+        with self._lock:
+            members = self._rooms.get(room)
+            if not members or members.pop(user, None) is None:
+                return False
+            if not members:
+                del self._rooms[room]
+        return True
+
+    async def refresh(self, entries, ttl):
+        expires_at = time.monotonic() + ttl
+        with self._lock:
+            for room, user in entries:
+                member = self._rooms.get(room, {}).get(user)
+                if member is not None:
+                    member[1] = expires_at
+
+    async def expire(self, room):
+        """Remove and return the members whose expiry has passed."""
+        now = time.monotonic()
+        with self._lock:
+            members = self._rooms.get(room)
+            if not members:
+                return []
+            gone = [user for user, (_, expires_at) in members.items() if expires_at <= now]
+            for user in gone:
+                del members[user]
+            if not members:
+                del self._rooms[room]
+        return gone
+
+    def _snapshot(self, room):
+        with self._lock:
+            return [(user, *member) for user, member in self._rooms.get(room, {}).items()]
+
+    async def members(self, room):
+        now = time.monotonic()
+        return [
+            {"user": user, "username": username}
+            for user, username, expires_at in sorted(self._snapshot(room))
+            if expires_at > now
+        ]
+
+    async def acount(self, room):
+        return self.count(room)
+
+    def count(self, room):
+        now = time.monotonic()
+        return sum(1 for _, _, expires_at in self._snapshot(room) if expires_at > now)
+
+
+class RedisPresenceStore:
+    """Room members in a Redis sorted set per room, scored by expiry."""
+
+    # Returns 1 if the user was not a member before
+    ADD_SCRIPT = """
+    local new = redis.call('ZADD', KEYS[1], 'GT', ARGV[1], ARGV[2])
+    redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    redis.call('EXPIRE', KEYS[2], ARGV[4])
+    return new
+    """
+
+    # Removes expired members and returns them
+    EXPIRE_SCRIPT = """
+    local gone = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    if #gone > 0 then
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+        redis.call('HDEL', KEYS[2], unpack(gone))
+    end
+    return gone
+    """
+
+    def __init__(self, url):
+        import redis
+        import redis.asyncio
+
+        self.client = redis.Redis.from_url(url)
+        self.async_client = redis.asyncio.Redis.from_url(url)
+        self.add_script = self.async_client.register_script(self.ADD_SCRIPT)
+        self.expire_script = self.async_client.register_script(self.EXPIRE_SCRIPT)
+
+    @staticmethod
+    def keys(room):
+        return f"chat:presence:{room}", f"chat:presence:{room}:names"
+
+    async def add(self, room, user, username, ttl):
+        key_ttl = int(ttl * 2) + 1
+        new = await self.add_script(
+            keys=self.keys(room),
+            args=[time.time() + ttl, user, username, key_ttl]
+        )
+        return bool(new)
+
+    async def remove(self, room, user, grace):
+        # Left for the expiry sweep, unless another process still has the user
+        await self.async_client.zadd(self.keys(room)[0], {user: time.time() + grace}, xx=True)
+        return False
+
+    async def refresh(self, entries, ttl):
+        expires_at = time.time() + ttl
+        async with self.async_client.pipeline(transaction=False) as pipe:
+            for room, user in entries:
+                pipe.zadd(self.keys(room)[0], {user: expires_at}, xx=True, gt=True)
+            await pipe.execute()
+
+    async def expire(self, room):
+        gone = await self.expire_script(keys=self.keys(room), args=[time.time()])
+        return [user.decode('utf-8') for user in gone]
+
+    async def members(self, room):
+        key, names_key = self.keys(room)
+        users = await self.async_client.zrangebyscore(key, time.time(), '+inf')
+        if not users:
+            return []
+        names = await self.async_client.hmget(names_key, users)
+        return sorted(
+            (
+                {"user": user.decode('utf-8'), "username": (name or b'').decode('utf-8')}
+                for user, name in zip(users, names)
+            ),
+            key=lambda member: member["user"]
+        )
+
+    async def acount(self, room):
+        return await self.async_client.zcount(self.keys(room)[0], time.time(), '+inf')
+
+    def count(self, room):
+        return self.client.zcount(self.keys(room)[0], time.time(), '+inf')
+
+
+class PresenceTracker:
+    """Track this process's connections per room and broadcast presence deltas."""
+
+    def __init__(self, store, heartbeat_ms=PRESENCE_HEARTBEAT_MS, ttl_ms=PRESENCE_TTL_MS,
+                 debounce_ms=PRESENCE_DEBOUNCE_MS):
+        self.store = store
+        self.heartbeat = heartbeat_ms / 1000
+        self.ttl = ttl_ms / 1000
+        self.debounce = debounce_ms / 1000
+        self._local = {}    # room -> {user: set of channel names}
+        self._pending = {}  # room -> ({user: username} joined, set of users left)
+        self._scheduled = set()
+        self._heartbeat_task = None
+        self._channel_layer = None
+
+    async def join(self, room, user, username, channel_name, channel_layer):
+        """Record a connection of a user to a room."""
+        self._channel_layer = channel_layer
+        connections = self._local.setdefault(room, {}).setdefault(user, set())
+        first = not connections
+        connections.add(channel_name)
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.get_running_loop().create_task(self._heartbeat_loop())
+
+        if first and await self.store.add(room, user, username, self.ttl):
+            self._queue(room, user, username=username)
+
+    async def leave(self, room, user, channel_name):
+        """Forget a connection; the user goes offline with their last one."""
+        users = self._local.get(room)
+        connections = users.get(user) if users else None
+        if connections is None:
+            return
+        connections.discard(channel_name)
+        if connections:
+            return
+        del users[user]
+        if not users:
+            del self._local[room]
+
+        if await self.store.remove(room, user, self.heartbeat):
+            self._queue(room, user)
+
+    async def members(self, room):
+        return await self.store.members(room)
+
+    def online_count(self, room):
+        return self.store.count(room)
+
+    def _queue(self, room, user, username=None):
+        """Add a join (with username) or leave to the room's next delta."""
+        joined, left = self._pending.setdefault(room, ({}, set()))
+        if username is not None:
+            if user in left:
+                left.discard(user)  # left and came back: no change
+            else:
+                joined[user] = username
+        else:
+            if user in joined:
+                del joined[user]  # joined and left again: no change
+            else:
+                left.add(user)
+
+        if room not in self._scheduled:
+            self._scheduled.add(room)
+            asyncio.get_running_loop().create_task(self._flush(room))
+
+    async def _flush(self, room):
+        try:
+            await asyncio.sleep(self.debounce)
+            self._scheduled.discard(room)
+            joined, left = self._pending.pop(room, ({}, set()))
+            if not joined and not left:
+                return
+            await self._channel_layer.group_send(room, {
+                "type": "presence_update",
+                "room": room,
+                **encoding.encode_broadcast({
+                    "type": "presence",
+                    "room_id": group_room_id(room),
+                    "joined": [
+                        {"user": user, "username": username}
+                        for user, username in sorted(joined.items())
+                    ],
+                    "left": sorted(left),
+                    "online": await self.store.acount(room)
+                })
+            })
+        except Exception:
+            logger.exception("Presence broadcast for %s failed", room)
+        finally:
+            self._scheduled.discard(room)
+
+    async def _heartbeat_loop(self):
+        try:
+            while self._local:
+                await asyncio.sleep(self.heartbeat)
+                try:
+                    await self.store.refresh(
+                        [(room, user) for room, users in self._local.items() for user in users],
+                        self.ttl
+                    )
+                    # Pick up members of crashed processes
+                    for room in list(self._local):
+                        for user in await self.store.expire(room):
+                            self._queue(room, user)
+                except Exception:
+                    logger.exception("Presence heartbeat failed")
+        finally:
+            self._heartbeat_task = None
+
+
+def make_store():
+    if PRESENCE_REDIS_URL:
+        return RedisPresenceStore(PRESENCE_REDIS_URL)
+    return LocalPresenceStore()
+
+
+presence_tracker = PresenceTracker(make_store())
@@ -0,0 +1,134 @@
+"""
+Background purge of deleted rooms.
+
+Deleting a room only marks it (`Rooms.deleted_at`) and records a RoomPurge.
+A worker thread then deletes the room's messages and participants in
+batches of `CHAT_PURGE_BATCH_SIZE` rows, each in its own short transaction,
+pausing `CHAT_PURGE_SLEEP_MS` between batches so that other queries keep
+getting their turn. Legacy messages that only name the room through
+`chat_room` (no `room` foreign key) are deleted the same way. The Rooms row
+and the room's archive go last.
+
+Each pending purge is claimed by exactly one process. Purges that were
+interrupted by a restart (left "running") or failed are resumed with
+`manage.py purge_deleted_rooms`.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from chat.archive import RoomArchive
+from chat.models import Message, RoomParticipant, RoomPurge, Rooms, room_group_name
+
+logger = logging.getLogger(__name__)
+
+PURGE_BATCH_SIZE = getattr(settings, 'CHAT_PURGE_BATCH_SIZE', 1000)
+PURGE_SLEEP_MS = getattr(settings, 'CHAT_PURGE_SLEEP_MS', 50)
+
+
+def request_purge(room, user=None):
+    """Mark a room deleted and record its purge. Returns the RoomPurge."""
+    with transaction.atomic():
+        Rooms.objects.filter(pk=room.pk).update(deleted_at=timezone.now())
+        purge, _ = RoomPurge.objects.get_or_create(
+            room_id=room.room_id,
+            defaults={
+                "chat_room_name": room.chat_room_name,
+                "requested_by": user if user is not None and user.is_authenticated else None,
+            }
+        )
+    return purge
+
+
+def purge_room(purge, batch_size=PURGE_BATCH_SIZE, sleep_ms=PURGE_SLEEP_MS):
+    """Delete a deleted room's rows in batches, recording progress on the purge."""
+    room = Rooms.objects.filter(room_id=purge.room_id).first()
+    legacy_messages = Message.objects.filter(room__isnull=True, chat_room=room_group_name(str(purge.room_id)))
+    purge.status = RoomPurge.RUNNING
+    purge.started_at = purge.started_at or timezone.now()
+    if not purge.messages_total:
+        purge.messages_total = legacy_messages.count()
+        if room is not None:
+            purge.messages_total += Message.objects.filter(room=room).count()
+    purge.save(update_fields=['status', 'started_at', 'messages_total'])
+
+    batches = [(legacy_messages, 'messages_deleted')]
+    if room is not None:
+        batches[:0] = [
+            (Message.objects.filter(room=room), 'messages_deleted'),
+            (RoomParticipant.objects.filter(room=room), 'participants_deleted'),
+        ]
+    try:
+        for rows, counter in batches:
+            while True:
+                ids = list(rows.values_list('id', flat=True)[:batch_size])
+                if not ids:
+                    break
+                deleted, _ = rows.model.objects.filter(id__in=ids).delete()
+                setattr(purge, counter, getattr(purge, counter) + deleted)
+                purge.save(update_fields=[counter])
+                if sleep_ms:
+                    time.sleep(sleep_ms / 1000)
+        if room is not None:
+            room.delete()
+        RoomArchive(purge.room_id).delete()
+    except Exception as e:
+        logger.exception("Purge of room %s failed", purge.room_id)
+        purge.status = RoomPurge.FAILED
+        purge.error = str(e)
+        purge.save(update_fields=['status', 'error'])
+        return purge
+
+    purge.status = RoomPurge.DONE
+    purge.error = ''
+    purge.finished_at = timezone.now()
+    purge.save(update_fields=['status', 'error', 'finished_at'])
+    logger.info("Purged room %s: %d messages", purge.room_id, purge.messages_deleted)
+    return purge
+
+
+def unfinished_purges():
+    return RoomPurge.objects.exclude(status=RoomPurge.DONE).order_by('created_at')
+
+
+def claim_pending_purges():
+    """Yield pending purges, each one only if this process won it."""
+    for purge in RoomPurge.objects.filter(status=RoomPurge.PENDING).order_by('created_at'):
+        if RoomPurge.objects.filter(pk=purge.pk, status=RoomPurge.PENDING).update(status=RoomPurge.RUNNING):
+            yield purge
+
+
+class PurgeWorker:
+    """Runs pending purges one at a time on a daemon thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def wake(self):
+        """Start the worker if needed and have it look for purges."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="room-purge", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                for purge in claim_pending_purges():
+                    purge_room(purge)
+            except Exception:
+                logger.exception("Room purge worker failed")
+            finally:
+                connection.close()
+
+
+purge_worker = PurgeWorker()
@@ -0,0 +1,159 @@
+"""
+Per-user read state.
+
+Each RoomParticipant row stores the sequence number of the last message the
+user has read (`last_read_seq`); a room's unread count is then simply
+`Rooms.last_seq - last_read_seq`, so no per-message rows are kept and the
+counts for all of a user's rooms come out of the room list query.
+
+`mark_read` frames only record the highest sequence number in memory. A
+background task writes what has accumulated at most once every
+`CHAT_READ_FLUSH_MS`, with one UPDATE per (room, user), and then sends the
+room a "read" frame with the new read positions (read receipts). Positions
+past the room's `last_seq` are capped to it, so a client can't announce
+having read messages that don't exist. Whatever is still pending is written
+when the process exits.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from chat import encoding
+from chat.models import RoomParticipant, Rooms, group_room_id, room_id_from_group
+
+logger = logging.getLogger(__name__)
+
+READ_FLUSH_MS = getattr(settings, 'CHAT_READ_FLUSH_MS', 3000)
+
+
+def room_sequences(group_names):
+    """Map group names to (Rooms primary key, last_seq), leaving out unknown and deleted rooms."""
+    room_ids = {room_id_from_group(name): name for name in group_names}
+    room_ids.pop(None, None)
+    if not room_ids:
+        return {}
+    return {
+        room_ids[room_id]: (pk, last_seq)
+        for room_id, pk, last_seq in (
+            Rooms.objects
+            .filter(room_id__in=room_ids, deleted_at__isnull=True)
+            .values_list('room_id', 'id', 'last_seq')
+        )
+    }
+
+
+class ReadTracker:
+    """Coalesce read positions in memory and write them in periodic batches."""
+
+    def __init__(self, flush_ms=READ_FLUSH_MS):
+        self.flush_interval = max(1, flush_ms) / 1000
+        self._pending = {}  # (room, user id) -> (seq, email, username)
+        self._lock = threading.Lock()
+        self._task = None
+        self._loop = None
+        self._channel_layer = None
+
+        # Counters
+        self.marked = 0
+        self.written = 0
+
+    def mark(self, room, user, username, seq, channel_layer):
+        """Record that a user has read a room up to `seq`. Does no I/O."""
+        key = (room, user.id)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None or seq > pending[0]:
+                self._pending[key] = (seq, user.email, username)
+        self.marked += 1
+        self._channel_layer = channel_layer
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def stats(self):
+        return {
+            "pending": self.depth,
+            "marked": self.marked,
+            "written": self.written,
+        }
+
+    async def _run(self):
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                updated = await sync_to_async(self.flush_sync, thread_sensitive=False)()
+                await self._send_receipts(updated)
+            except Exception:
+                logger.exception("Writing read positions failed")
+
+    def flush_sync(self):
+        """
+        Write the pending read positions, never moving one backwards.
+        Returns {room: [(email, username, seq), ...]} of the rows updated.
+        """
+        # Runs on executor threads outside any request, so recycle their
+        # connections the way Django's request cycle does
+        close_old_connections()
+        try:
+            return self._write_pending()
+        finally:
+            close_old_connections()
+
+    def _write_pending(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return {}
+
+        rooms = room_sequences({room for room, _ in batch})
+        updated = {}
+        # Same order in every process, so concurrent flushes can't deadlock on the rows
+        for (room, user_id), (seq, email, username) in sorted(batch.items()):
+            if room not in rooms:
+                continue
+            room_pk, last_seq = rooms[room]
+            # last_seq only grows, so capping to what was just read is safe
+            seq = min(seq, last_seq)
+            # Only participants have read state, and positions only move forward
+            if RoomParticipant.objects.filter(
+                room_id=room_pk, user_id=user_id, last_read_seq__lt=seq
+            ).update(last_read_seq=seq):
+                updated.setdefault(room, []).append((email, username, seq))
+        self.written += sum(len(receipts) for receipts in updated.values())
+        return updated
+
+    async def _send_receipts(self, updated):
+        for room, receipts in updated.items():
+            await self._channel_layer.group_send(room, {
+                "type": "read_receipts",
+                "room": room,
+                **encoding.encode_broadcast({
+                    "type": "read",
+                    "room_id": group_room_id(room),
+                    "receipts": [
+                        {"user": email, "username": username, "seq": seq}
+                        for email, username, seq in receipts
+                    ]
+                })
+            })
+
+
+read_tracker = ReadTracker()
+
+
+@atexit.register
+def flush_on_shutdown():
+    """Write read positions that are still only in memory."""
+    if read_tracker.depth:
+        logger.info("Writing %d buffered read positions on shutdown", read_tracker.depth)
+        read_tracker.flush_sync()
@@ -1,7 +1,8 @@
 from django.urls import path
 
-from .consumers import PersonalChatConsumer
+from .consumers import PersonalChatConsumer, MultiplexChatConsumer
 websocket_urlpatterns = [
+    path('ws/chat/', MultiplexChatConsumer.as_asgi()),
     path('ws/chat/<str:room_id>/', PersonalChatConsumer.as_asgi()), 
     path('messages/<str:room_id>/receive/', PersonalChatConsumer.receive, name='recive_message'),
 ]
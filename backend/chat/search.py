@@ -0,0 +1,230 @@
+"""
+Full-text search of room messages.
+
+Messages are indexed by the database itself, so the index is updated in
+the same transaction as every insert (including write-behind bulk inserts)
+and delete (purges, archiving):
+
+* SQLite: an FTS5 table `chat_message_fts` over `chat_message.message`,
+  kept up to date by triggers.
+* PostgreSQL: a GIN index on `to_tsvector('simple', message)`.
+
+Both are created by migration 0011. `manage.py rebuild_search_index`
+recreates them and reindexes existing messages; run it after restoring a
+database, or on SQLite after a migration that rebuilt `chat_message`
+(which drops its triggers).
+
+Results come newest first and are paginated with the same (timestamp, id)
+keyset as the history pages. Each result carries a `highlight` snippet of
+the message, HTML-escaped, with the matched words wrapped in <mark> tags.
+Archived messages are not searchable.
+"""
+import base64
+import html
+import json
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.utils.dateparse import parse_datetime
+
+from chat.models import Message
+from chat.serializers import serialize_message
+
+SEARCH_PAGE_SIZE = getattr(settings, 'CHAT_SEARCH_PAGE_SIZE', 20)
+SEARCH_MAX_PAGE_SIZE = getattr(settings, 'CHAT_SEARCH_MAX_PAGE_SIZE', 100)
+
+# Control characters marking matches in snippets; they can't come from escaped text
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+WORD_RE = re.compile(r'\w+')
+
+
+class SearchNotSupported(Exception):
+    """Raised when the database has no full-text search backend."""
+
+
+def search_terms(query):
+    """Split a user query into words; operators and punctuation are ignored."""
+    return WORD_RE.findall(query or '')[:16]
+
+
+def encode_cursor(timestamp, message_id):
+    """Opaque cursor for the next page after a (timestamp, id) key."""
+    data = json.dumps({"timestamp": timestamp.isoformat(), "id": message_id}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Parse an encode_cursor value into a (timestamp, id) key, or None if malformed."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        timestamp = parse_datetime(data["timestamp"])
+        message_id = int(data["id"])
+    except (TypeError, ValueError, KeyError):
+        return None
+    if timestamp is None:
+        return None
+    return timestamp, message_id
+
+
+def highlight_html(snippet):
+    """Escape a snippet and turn the match markers into <mark> tags."""
+    return html.escape(snippet).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+class SQLiteSearchBackend:
+    """FTS5 external-content table over chat_message, maintained by triggers."""
+
+    SETUP = [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5(
+            message,
+            content='chat_message',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS chat_message_fts_insert AFTER INSERT ON chat_message BEGIN
+            INSERT INTO chat_message_fts(rowid, message) VALUES (new.id, new.message);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS chat_message_fts_delete AFTER DELETE ON chat_message BEGIN
+            INSERT INTO chat_message_fts(chat_message_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS chat_message_fts_update AFTER UPDATE OF message ON chat_message BEGIN
+            INSERT INTO chat_message_fts(chat_message_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            INSERT INTO chat_message_fts(rowid, message) VALUES (new.id, new.message);
+        END
+        """,
+    ]
+
+    def match_expression(self, terms):
+        # Every word must match; the last one as a prefix, for search-as-you-type
+        quoted = ['"%s"' % term.replace('"', '""') for term in terms]
+        quoted[-1] += '*'
+        return ' '.join(quoted)
+
+    def search(self, room_pk, terms, before, limit):
+        """Return [(message id, snippet)] of the newest matches older than `before`."""
+        sql = """
+            SELECT m.id, snippet(chat_message_fts, 0, %s, %s, '…', 24)
+            FROM chat_message_fts
+            JOIN chat_message m ON m.id = chat_message_fts.rowid
+            WHERE chat_message_fts MATCH %s AND m.room_id = %s
+        """
+        params = [MATCH_START, MATCH_END, self.match_expression(terms), room_pk]
+        if before is not None:
+            timestamp = connection.ops.adapt_datetimefield_value(before[0])
+            sql += " AND (m.timestamp < %s OR (m.timestamp = %s AND m.id < %s))"
+            params += [timestamp, timestamp, before[1]]
+        sql += " ORDER BY m.timestamp DESC, m.id DESC LIMIT %s"
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            for sql in self.SETUP:
+                cursor.execute(sql)
+            cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+            cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('optimize')")
+
+
+class PostgresSearchBackend:
+    """
+    GIN expression index on to_tsvector('simple', message). Queries must use
+    the same expression, with the same text search configuration, to use it.
+    """
+
+    def ts_query(self, terms):
+        # Every word must match; the last one as a prefix, for search-as-you-type.
+        # Words only contain \w characters, so they can't break out of the quotes.
+        quoted = ["'%s'" % term for term in terms]
+        quoted[-1] += ':*'
+        return ' & '.join(quoted)
+
+    def search(self, room_pk, terms, before, limit):
+        """Return [(message id, snippet)] of the newest matches older than `before`."""
+        inner = """
+            SELECT id, message, timestamp
+            FROM chat_message
+            WHERE room_id = %s AND to_tsvector('simple', message) @@ to_tsquery('simple', %s)
+        """
+        params = [room_pk, self.ts_query(terms)]
+        if before is not None:
+            inner += " AND (timestamp, id) < (%s, %s)"
+            params += [connection.ops.adapt_datetimefield_value(before[0]), before[1]]
+        inner += " ORDER BY timestamp DESC, id DESC LIMIT %s"
+        params.append(limit)
+
+        # Headlines are expensive, so only make them for the page
+        sql = f"""
+            SELECT page.id, ts_headline('simple', page.message, to_tsquery('simple', %s), %s)
+            FROM ({inner}) AS page
+            ORDER BY page.timestamp DESC, page.id DESC
+        """
+        options = f'StartSel="{MATCH_START}", StopSel="{MATCH_END}", MaxWords=24, MinWords=8, MaxFragments=1'
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [self.ts_query(terms), options] + params)
+            return cursor.fetchall()
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS chat_msg_fts_idx ON chat_message "
+                "USING GIN (to_tsvector('simple', message))"
+            )
+            cursor.execute("REINDEX INDEX chat_msg_fts_idx")
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def search_backend():
+    backend = BACKENDS.get(connection.vendor)
+    if backend is None:
+        raise SearchNotSupported(f"Full-text search is not available on {connection.vendor}")
+    return backend()
+
+
+def search_messages(room_pk, terms, before=None, limit=None):
+    """
+    Search a room's messages for all of `terms`, newest first.
+    Returns {"messages", "has_more", "next_cursor"} like a history page.
+    """
+    try:
+        limit = int(limit) if limit is not None else SEARCH_PAGE_SIZE
+    except (TypeError, ValueError):
+        limit = SEARCH_PAGE_SIZE
+    limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+
+    # One extra row tells whether there is another page
+    rows = search_backend().search(room_pk, terms, before, limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    messages = Message.objects.select_related('user').in_bulk([message_id for message_id, _ in rows])
+    results = []
+    last = None
+    for message_id, snippet in rows:
+        msg = messages.get(message_id)
+        if msg is None:
+            continue  # Deleted since the search ran
+        results.append({**serialize_message(msg), "highlight": highlight_html(snippet)})
+        last = msg
+
+    return {
+        "messages": results,
+        "has_more": has_more,
+        "next_cursor": encode_cursor(last.timestamp, last.id) if has_more and last is not None else None,
+    }
@@ -0,0 +1,91 @@
+"""
+Per-room message sequence numbers.
+
+Every message in a room gets the next number from `Rooms.last_seq`, so a
+reconnecting client can send the last number it saw and receive only what it
+missed. By default the number is allocated in the database, in the same
+transaction as the message insert. Setting `CHAT_SEQUENCE_REDIS_URL` moves
+allocation to a Redis counter per room, which the event loop can use without
+a thread hop, and `Rooms.last_seq` is then brought up to date when messages
+are saved. The write-behind queue requires it, and refuses to start
+without it.
+"""
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+from chat.models import Rooms, room_id_from_group
+
+logger = logging.getLogger(__name__)
+
+SEQUENCE_REDIS_URL = getattr(settings, 'CHAT_SEQUENCE_REDIS_URL', None)
+
+
+def current_seq(chat_room):
+    """Return the room's latest sequence number, or None if it has none."""
+    room_id = room_id_from_group(chat_room)
+    if room_id is None:
+        return None
+    return Rooms.objects.filter(room_id=room_id, deleted_at__isnull=True).values_list('last_seq', flat=True).first()
+
+
+def next_seq_db(chat_room):
+    """
+    Allocate the next sequence number from Rooms.last_seq.
+    Call inside transaction.atomic() so the row lock covers the insert.
+    """
+    room_id = room_id_from_group(chat_room)
+    if room_id is None:
+        return None
+    rooms = Rooms.objects.filter(room_id=room_id, deleted_at__isnull=True)
+    if not rooms.update(last_seq=F('last_seq') + 1):
+        return None
+    return rooms.values_list('last_seq', flat=True).get()
+
+
+def record_seq_db(chat_room, seq):
+    """Advance Rooms.last_seq to a number allocated elsewhere."""
+    room_id = room_id_from_group(chat_room)
+    if room_id is None or seq is None:
+        return
+    Rooms.objects.filter(room_id=room_id).update(last_seq=Greatest(F('last_seq'), Value(seq)))
+
+
+class RedisSequenceAllocator:
+    """Allocate sequence numbers with INCR on a per-room Redis counter."""
+
+    # Returns false when the counter has not been seeded from the database yet
+    INCR_SCRIPT = """
+    if redis.call('EXISTS', KEYS[1]) == 0 then return false end
+    return redis.call('INCR', KEYS[1])
+    """
+
+    SEED_SCRIPT = """
+    redis.call('SETNX', KEYS[1], ARGV[1])
+    return redis.call('INCR', KEYS[1])
+    """
+
+    def __init__(self, url):
+        import redis.asyncio
+
+        self.client = redis.asyncio.Redis.from_url(url)
+        self.incr_script = self.client.register_script(self.INCR_SCRIPT)
+        self.seed_script = self.client.register_script(self.SEED_SCRIPT)
+
+    async def allocate(self, chat_room):
+        if room_id_from_group(chat_room) is None:
+            return None
+        key = f"chat:seq:{chat_room}"
+        seq = await self.incr_script(keys=[key])
+        if seq is None:
+            last_seq = await sync_to_async(current_seq)(chat_room)
+            if last_seq is None:
+                return None
+            seq = await self.seed_script(keys=[key], args=[last_seq])
+        return int(seq)
+
+
+shared_sequences = RedisSequenceAllocator(SEQUENCE_REDIS_URL) if SEQUENCE_REDIS_URL else None
@@ -3,6 +3,46 @@ from django.contrib.auth import get_user_model
 from .models import Message,Rooms
 User = get_user_model()
 
+
+def get_display_name(user):
+    """Get username or fallback to email prefix."""
+    if getattr(user, 'username', None):
+        return user.username
+    return user.email.split('@')[0]
+
+
+def serialize_message(msg):
+    """Convert a Message into the dict sent to WebSocket clients."""
+    return {
+        "id": msg.id,
+        "seq": msg.seq,
+        "user": msg.user.email,
+        "username": get_display_name(msg.user),
+        "message": msg.message,
+        "timestamp": msg.timestamp.isoformat()
+    }
+
+
+# .values() projection with what serialize_message_values needs
+MESSAGE_VALUES = ('id', 'seq', 'message', 'timestamp', 'user__email', 'user__username')
+
+
+def serialize_message_values(row):
+    """serialize_message for a MESSAGE_VALUES row, without building model instances."""
+    return {
+        "id": row["id"],
+        "seq": row["seq"],
+        "user": row["user__email"],
+        "username": row["user__username"] or row["user__email"].split('@')[0],
+        "message": row["message"],
+        "timestamp": row["timestamp"].isoformat()
+    }
+
+
+def serialize_archived_message(msg):
+    """Archive record of a Message: the client dict plus the sender's user id."""
+    return {**serialize_message(msg), "user_id": msg.user_id}
+
 class UserGetSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
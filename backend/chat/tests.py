@@ -1,3 +1,1089 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import gzip
+import importlib
+import io
+import json
+import tempfile
+import threading
+import warnings
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from backend.ratelimit import LocalBuckets, RateLimiter, rate_limiter
+from chat.archive import RoomArchive
+from chat.channels_middleware import JWTWebsocketMiddleware
+from chat.consumers import CLOSE_NOT_MEMBER
+from chat.encoding import BINARY_SUBPROTOCOL, FrameDecodeError, packb, unpackb
+from chat.membership import membership_cache
+from chat.models import Message, RoomParticipant, RoomPurge, Rooms, room_group_name
+from chat.outbound import CLOSE_SLOW_CONSUMER, OutboundQueue
+from chat.persistence import MessageIdGenerator, MessageWriteBehindQueue
+from chat.presence import LocalPresenceStore, PresenceTracker
+from chat.purge import purge_room, purge_worker
+from chat.read_state import read_tracker
+from chat.route import websocket_urlpatterns
+from chat.search import encode_cursor
+from chat.serializers import serialize_archived_message
+from chat.typing_state import TypingTracker
+from userAuth.models import User
+from userAuth.tokens import create_access_token
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class ConsumerTestCase(TestCase):
+    """Opens sockets through the JWT middleware, as asgi.py does, with an access-token cookie."""
+
+    def communicator(self, user, path, **kwargs):
+        token = create_access_token(user.id, user.token_version)
+        return WebsocketCommunicator(
+            JWTWebsocketMiddleware(URLRouter(websocket_urlpatterns)),
+            path,
+            headers=[(b'cookie', f"access_token={token}".encode())],
+            **kwargs
+        )
+
+    async def receive(self, communicator, frame_type):
+        """Return the next frame of this type, skipping the others."""
+        while True:
+            frame = await communicator.receive_json_from(timeout=2)
+            if frame.get('type') == frame_type:
+                return frame
+
+
+class HistoryPaginationTests(ConsumerTestCase):
+    """Latest page on connect, older pages with load_more."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('a@example.com', 'alice', 'pw')
+        cls.room = Rooms.objects.create(chat_room_name='general', last_seq=120)
+        RoomParticipant.objects.create(room=cls.room, user=cls.user)
+        start = timezone.now() - datetime.timedelta(days=1)
+        Message.objects.bulk_create([
+            Message(
+                user=cls.user, room=cls.room, chat_room=room_group_name(cls.room.room_id), seq=i + 1,
+                message=f"m{i}", timestamp=start + datetime.timedelta(minutes=i)
+            )
+            for i in range(120)
+        ])
+
+    async def connect(self):
+        communicator = self.communicator(self.user, f"/ws/chat/{self.room.room_id}/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, await self.receive(communicator, 'message_history')
+
+    async def test_connect_sends_latest_page(self):
+        communicator, history = await self.connect()
+        await communicator.disconnect()
+
+        self.assertEqual(len(history['messages']), 50)
+        self.assertTrue(history['has_more'])
+        self.assertEqual(history['messages'][-1]['message'], 'm119')
+
+    async def test_load_more_walks_whole_history(self):
+        communicator, page = await self.connect()
+        seen = [message['message'] for message in page['messages']]
+        while page['has_more']:
+            await communicator.send_json_to({'type': 'load_more', 'cursor': page['next_cursor'], 'limit': 30})
+            page = await self.receive(communicator, 'message_history_page')
+            seen = [message['message'] for message in page['messages']] + seen
+        await communicator.disconnect()
+
+        self.assertEqual(seen, [f"m{i}" for i in range(120)])
+
+    async def test_load_more_rejects_malformed_cursor(self):
+        communicator, _ = await self.connect()
+        await communicator.send_json_to({'type': 'load_more', 'cursor': 'not-a-cursor'})
+        error = await self.receive(communicator, 'error')
+        await communicator.disconnect()
+
+        self.assertEqual(error['message'], "Invalid cursor.")
+
+
+class WriteBehindSequenceTests(TestCase):
+
+    def test_write_behind_requires_shared_sequences(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, "CHAT_SEQUENCE_REDIS_URL"):
+            MessageWriteBehindQueue(node_id=1, enabled=True, sequences=None)
+
+    def test_disabled_queue_needs_no_shared_sequences(self):
+        MessageWriteBehindQueue(node_id=None, enabled=False, sequences=None)
+
+
+class MessageIdTests(TestCase):
+    """Write-behind ids: unique, time-ordered, JSON-safe, one node id per process."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('a@example.com', 'alice', 'pw')
+        cls.room = Rooms.objects.create(chat_room_name='general')
+
+    def queue(self):
+        return MessageWriteBehindQueue(node_id=3, enabled=True, sequences=mock.Mock())
+
+    def test_ids_are_unique_and_increasing(self):
+        generator = MessageIdGenerator(255)
+        ids = [generator.next_id() for _ in range(5000)]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(ids, sorted(ids))
+        self.assertLess(ids[-1], 2 ** 53)
+
+    def test_nodes_never_share_ids(self):
+        first, second = MessageIdGenerator(1), MessageIdGenerator(2)
+        ids = [first.next_id() for _ in range(500)] + [second.next_id() for _ in range(500)]
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_node_id_is_required_with_write_behind(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, "CHAT_WRITE_BEHIND_NODE_ID"):
+            MessageWriteBehindQueue(node_id=None, enabled=True, sequences=mock.Mock())
+        with self.assertRaises(ImproperlyConfigured):
+            MessageIdGenerator(256)
+
+    def test_colliding_id_is_reported_not_reassigned(self):
+        queue = self.queue()
+        chat_room = room_group_name(self.room.room_id)
+        with mock.patch.object(queue, '_ensure_flusher'):
+            colliding = queue.enqueue(self.user, chat_room, "hello", 1)
+            queue.enqueue(self.user, chat_room, "world", 2)
+        Message.objects.create(id=colliding.id, user=self.user, room=self.room, chat_room=chat_room, message="taken")
+
+        with self.assertLogs('chat.persistence', 'CRITICAL') as logs:
+            queue.flush_sync()
+
+        self.assertIn("CHAT_WRITE_BEHIND_NODE_ID=3", logs.output[-1])
+        self.assertEqual(queue.stats()['id_collisions'], 1)
+        self.assertEqual(Message.objects.get(id=colliding.id).message, "taken")
+        self.assertFalse(Message.objects.filter(message="hello").exists())
+        self.assertTrue(Message.objects.filter(message="world").exists())
+
+    def test_flush_waits_for_flush_in_progress(self):
+        queue = self.queue()
+        started, release = threading.Event(), threading.Event()
+
+        def write(batch):
+            started.set()
+            release.wait(5)
+
+        with mock.patch.object(queue, '_write', side_effect=write):
+            queue._pending = [Message()]
+            first = threading.Thread(target=queue.flush_sync)
+            first.start()
+            self.assertTrue(started.wait(5))
+            second = threading.Thread(target=queue.flush_sync)
+            second.start()
+            second.join(0.2)
+            self.assertTrue(second.is_alive())
+
+            release.set()
+            second.join(5)
+            first.join(5)
+        self.assertFalse(second.is_alive())
+        self.assertEqual(queue.in_flight, 0)
+
+
+class RateLimitTests(ConsumerTestCase):
+    """Token buckets, taken all or nothing; chat frames are limited per user."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('a@example.com', 'alice', 'pw')
+        cls.bob = User.objects.create_user('b@example.com', 'bob', 'pw')
+        cls.room = Rooms.objects.create(chat_room_name='general')
+        for user in (cls.alice, cls.bob):
+            RoomParticipant.objects.create(room=cls.room, user=user)
+
+    def test_rejection_takes_no_token_from_other_buckets(self):
+        limiter = RateLimiter(limits={'login': (2, 60)}, redis_url=None)
+        self.assertEqual(limiter.check('login', 'ip:1', 'email:a'), 0)
+        self.assertEqual(limiter.check('login', 'ip:1', 'email:a'), 0)
+        self.assertGreater(limiter.check('login', 'ip:1', 'email:b'), 0)
+        # email:b was not charged for the rejected attempt
+        self.assertEqual(limiter.check('login', 'ip:2', 'email:b'), 0)
+        self.assertEqual(limiter.check('login', 'ip:3', 'email:b'), 0)
+        self.assertGreater(limiter.check('login', 'ip:4', 'email:b'), 0)
+        self.assertEqual(limiter.stats()['rejected'], 2)
+
+    def test_unlisted_action_is_not_limited(self):
+        limiter = RateLimiter(limits={}, redis_url=None)
+        self.assertEqual(limiter.check('login', 'ip:1'), 0)
+
+    async def send_messages(self, user, count):
+        """Send messages as this user; return the error frame of the first rejected one, if any."""
+        communicator = self.communicator(user, f"/ws/chat/{self.room.room_id}/")
+        await communicator.connect()
+        await self.receive(communicator, 'message_history')
+        try:
+            for i in range(count):
+                await communicator.send_json_to({'message': f"{user.username} {i}"})
+                frame = await communicator.receive_json_from(timeout=2)
+                while frame.get('type') not in ('message', 'error'):
+                    frame = await communicator.receive_json_from(timeout=2)
+                if frame['type'] == 'error':
+                    return frame
+        finally:
+            await communicator.disconnect()
+
+    async def test_message_flood_is_rejected_per_user(self):
+        limiter = RateLimiter(limits={'message': (3, 60)}, redis_url=None)
+        # Sending marks messages read; keep that out of the tracker, which outlives the test
+        with mock.patch('chat.consumers.rate_limiter', limiter), mock.patch.object(read_tracker, 'mark'):
+            error = await self.send_messages(self.alice, 4)
+            # Same address, other user: a bucket of its own
+            self.assertIsNone(await self.send_messages(self.bob, 3))
+
+        self.assertEqual(error['message'], "Rate limit exceeded.")
+        self.assertEqual(await Message.objects.filter(room=self.room).acount(), 6)
+
+
+class ReadStateTests(ConsumerTestCase):
+    """Read positions are capped at the room's newest message."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('a@example.com', 'alice', 'pw')
+        cls.room = Rooms.objects.create(chat_room_name='general', last_seq=5)
+        RoomParticipant.objects.create(room=cls.room, user=cls.user)
+        Message.objects.bulk_create([
+            Message(user=cls.user, room=cls.room, chat_room=room_group_name(cls.room.room_id), seq=i + 1, message=f"m{i}")
+            for i in range(5)
+        ])
+
+    async def test_out_of_range_mark_read_is_capped(self):
+        communicator = self.communicator(self.user, f"/ws/chat/{self.room.room_id}/")
+        await communicator.connect()
+        await self.receive(communicator, 'message_history')
+        await communicator.send_json_to({'type': 'mark_read', 'seq': 10 ** 9})
+        await communicator.send_json_to({'type': 'load_more', 'cursor': 'x'})
+        await self.receive(communicator, 'error')  # frames are handled in order, so mark_read is done
+
+        # Flush here rather than on the tracker's thread, which can't see the test's transaction
+        read_tracker._task.cancel()
+        updated = await sync_to_async(read_tracker.flush_sync)()
+        await read_tracker._send_receipts(updated)
+        receipt = await self.receive(communicator, 'read')
+        await communicator.disconnect()
+
+        self.assertEqual(receipt['receipts'][0]['seq'], 5)
+        participant = await sync_to_async(RoomParticipant.objects.get)(room=self.room, user=self.user)
+        self.assertEqual(participant.last_read_seq, 5)
+
+
+class ExportTests(TestCase):
+    """Staff can download a room as NDJSON, optionally gzipped."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('a@example.com', 'alice', 'pw')
+        cls.staff = User.objects.create_user('s@example.com', 'staff', 'pw', is_staff=True)
+        cls.room = Rooms.objects.create(chat_room_name='general', last_seq=250)
+        Message.objects.bulk_create([
+            Message(user=cls.user, room=cls.room, chat_room=room_group_name(cls.room.room_id), seq=i + 1, message=f"m{i}")
+            for i in range(250)
+        ])
+
+    def setUp(self):
+        # Rate limit buckets outlive each test
+        patcher = mock.patch.object(rate_limiter, 'local', LocalBuckets())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def test_export_streams_every_message_oldest_first(self):
+        response = self.client.get(f"/rooms/{self.room.room_id}/export/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        body = b''.join(response)
+        records = [json.loads(line) for line in body.decode('utf-8').splitlines()]
+        self.assertEqual([record['seq'] for record in records], list(range(1, 251)))
+        self.assertEqual(records[0]['user_id'], self.user.id)
+
+        response = self.client.get(f"/rooms/{self.room.room_id}/export/", {'compression': 'gzip'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(gzip.decompress(b''.join(response)), body)
+
+    def test_export_is_staff_only(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(f"/rooms/{self.room.room_id}/export/")
+        self.assertEqual(response.status_code, 403)
+
+
+class MembershipTests(ConsumerTestCase):
+    """Only members get into a room, and membership changes reach the cache at once."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create_user('a@example.com', 'alice', 'pw')
+        cls.outsider = User.objects.create_user('b@example.com', 'bob', 'pw')
+        cls.room = Rooms.objects.create(chat_room_name='general')
+        RoomParticipant.objects.create(room=cls.room, user=cls.member)
+
+    def setUp(self):
+        # The cache outlives each test's rolled-back transaction
+        membership_cache.invalidate(self.room.room_id)
+
+    async def assertAdmitted(self, user, admitted):
+        communicator = self.communicator(user, f"/ws/chat/{self.room.room_id}/")
+        connected, code = await communicator.connect()
+        if connected:
+            await communicator.disconnect()
+        self.assertEqual((connected, code), (True, None) if admitted else (False, CLOSE_NOT_MEMBER))
+
+    def api(self, user, method, path, **kwargs):
+        client = APIClient()
+        client.force_authenticate(user)
+        with self.captureOnCommitCallbacks(execute=True):
+            return getattr(client, method)(path, **kwargs)
+
+    async def test_non_member_is_refused(self):
+        await self.assertAdmitted(self.member, True)
+        await self.assertAdmitted(self.outsider, False)
+
+    async def test_multiplex_subscribe_is_refused_for_non_member(self):
+        communicator = self.communicator(self.outsider, "/ws/chat/")
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'subscribe', 'room_id': str(self.room.room_id)})
+        error = await self.receive(communicator, 'error')
+        await communicator.disconnect()
+
+        self.assertEqual(error['message'], "Not a member of this room.")
+
+    async def test_join_room_invalidates_cached_refusal(self):
+        await self.assertAdmitted(self.outsider, False)
+        response = await sync_to_async(self.api)(
+            self.outsider, 'post', '/room/join/', data={'room_id': str(self.room.room_id)}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        await self.assertAdmitted(self.outsider, True)
+
+    async def test_delete_room_invalidates_cached_membership(self):
+        await self.assertAdmitted(self.member, True)
+        with mock.patch.object(purge_worker, 'wake'):
+            response = await sync_to_async(self.api)(self.member, 'delete', f"/room/delete/{self.room.room_id}/")
+        self.assertEqual(response.status_code, 202)
+        await self.assertAdmitted(self.member, False)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class RoomPurgeTests(TestCase):
+    """Deleting a room answers at once; its rows are purged in batches afterwards."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('a@example.com', 'alice', 'pw')
+        cls.member = User.objects.create_user('b@example.com', 'bob', 'pw')
+        cls.staff = User.objects.create_user('s@example.com', 'staff', 'pw', is_staff=True)
+        cls.room = Rooms.objects.create(chat_room_name='general', last_seq=8)
+        cls.other_room = Rooms.objects.create(chat_room_name='random', last_seq=1)
+        for user in (cls.owner, cls.member):
+            RoomParticipant.objects.create(room=cls.room, user=user)
+        chat_room = room_group_name(cls.room.room_id)
+        Message.objects.bulk_create(
+            [Message(user=cls.owner, room=cls.room, chat_room=chat_room, seq=i + 1, message=f"m{i}") for i in range(5)]
+            # Legacy rows that only name the room
+            + [Message(user=cls.owner, chat_room=chat_room, seq=i + 6, message=f"m{i + 5}") for i in range(3)]
+            + [Message(user=cls.owner, room=cls.other_room, chat_room=room_group_name(cls.other_room.room_id),
+                       seq=1, message="kept")]
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def delete(self):
+        with mock.patch.object(purge_worker, 'wake') as wake, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(f"/room/delete/{self.room.room_id}/")
+        wake.assert_called_once()
+        return response
+
+    def status(self):
+        return self.client.get(f"/room/delete/{self.room.room_id}/status/")
+
+    def test_delete_is_accepted_and_hides_the_room(self):
+        response = self.delete()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['purge']['status'], RoomPurge.PENDING)
+        self.assertEqual(response.data['purge']['status_url'], f"/room/delete/{self.room.room_id}/status/")
+
+        self.assertIsNotNone(Rooms.objects.get(pk=self.room.pk).deleted_at)
+        self.assertEqual(self.client.delete(f"/room/delete/{self.room.room_id}/").status_code, 404)
+        self.assertEqual(Message.objects.count(), 9)  # Nothing is deleted yet
+
+    def test_purge_deletes_rows_in_batches(self):
+        self.delete()
+        purge = RoomPurge.objects.get(room_id=self.room.room_id)
+        with mock.patch.object(Message.objects, 'filter', wraps=Message.objects.filter) as message_filter:
+            purge_room(purge, batch_size=2, sleep_ms=0)
+
+        self.assertEqual(purge.status, RoomPurge.DONE)
+        self.assertEqual((purge.messages_total, purge.messages_deleted, purge.participants_deleted), (8, 8, 2))
+        # Three batches for the linked messages and two for the legacy ones
+        self.assertEqual(sum(1 for call in message_filter.call_args_list if 'id__in' in call.kwargs), 5)
+        self.assertFalse(Rooms.objects.filter(pk=self.room.pk).exists())
+        self.assertEqual(list(Message.objects.values_list('message', flat=True)), ["kept"])
+
+    def test_status_reports_progress_to_requester_and_staff(self):
+        self.delete()
+        purge_room(RoomPurge.objects.get(room_id=self.room.room_id), sleep_ms=0)
+
+        response = self.status()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], RoomPurge.DONE)
+        self.assertEqual(response.data['messages_deleted'], 8)
+        self.assertIsNotNone(response.data['finished_at'])
+
+        self.client.force_authenticate(self.member)
+        self.assertEqual(self.status().status_code, 404)
+        self.client.force_authenticate(self.staff)
+        self.assertEqual(self.status().status_code, 200)
+
+
+class ArchiveTests(ConsumerTestCase):
+    """Old messages move to the archive, and every history read still finds them."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('a@example.com', 'alice', 'pw')
+        cls.staff = User.objects.create_user('s@example.com', 'staff', 'pw', is_staff=True)
+        cls.room = Rooms.objects.create(chat_room_name='general', last_seq=15, retention_days=30)
+        RoomParticipant.objects.create(room=cls.room, user=cls.user)
+        now = timezone.now()
+        Message.objects.bulk_create([
+            Message(
+                user=cls.user, room=cls.room, chat_room=room_group_name(cls.room.room_id), seq=i + 1, message=f"m{i}",
+                # Ten past the retention period, five within it
+                timestamp=now - datetime.timedelta(days=45 - i) if i < 10 else now - datetime.timedelta(minutes=15 - i)
+            )
+            for i in range(15)
+        ])
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # Rate limit buckets outlive each test, and the export has a small one
+        for patcher in (
+            mock.patch('chat.archive.ARCHIVE_DIR', directory.name),
+            mock.patch.object(rate_limiter, 'local', LocalBuckets()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def archive(self):
+        out = io.StringIO()
+        call_command('archive_messages', block_size=3, stdout=out)
+        return out.getvalue()
+
+    def test_archive_round_trip(self):
+        old = [serialize_archived_message(msg) for msg in Message.objects.filter(seq__lte=10).order_by('seq')]
+        self.assertIn("10 messages archived", self.archive())
+
+        self.assertEqual(list(RoomArchive(self.room.room_id).read_all()), old)
+        self.assertEqual(list(Message.objects.order_by('seq').values_list('seq', flat=True)), list(range(11, 16)))
+        self.assertIn("Archived 0 messages", self.archive())
+
+    async def test_websocket_history_reads_the_archive(self):
+        await sync_to_async(self.archive)()
+        communicator = self.communicator(self.user, f"/ws/chat/{self.room.room_id}/")
+        await communicator.connect()
+        history = await self.receive(communicator, 'message_history')
+        await communicator.disconnect()
+
+        self.assertEqual([message['message'] for message in history['messages']], [f"m{i}" for i in range(15)])
+        self.assertFalse(history['has_more'])
+
+    def test_rest_history_and_export_read_the_archive(self):
+        self.archive()
+        client = APIClient()
+        client.force_authenticate(self.user)
+        seen, params = [], {'limit': 4}
+        while True:
+            page = json.loads(b''.join(client.get(f"/rooms/{self.room.room_id}/messages/", params)))
+            seen += [message['message'] for message in page['messages']]
+            if not page['has_more']:
+                break
+            params['before'] = page['next_cursor']
+        self.assertEqual(seen, [f"m{i}" for i in reversed(range(15))])
+
+        client.force_authenticate(self.staff)
+        body = b''.join(client.get(f"/rooms/{self.room.room_id}/export/"))
+        self.assertEqual([json.loads(line)['seq'] for line in body.splitlines()], list(range(1, 16)))
+
+
+class SearchTests(TestCase):
+    """Full-text search of a room, newest first, with escaped highlights."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create_user('a@example.com', 'alice', 'pw')
+        cls.outsider = User.objects.create_user('b@example.com', 'bob', 'pw')
+        cls.room = Rooms.objects.create(chat_room_name='general')
+        other_room = Rooms.objects.create(chat_room_name='random')
+        RoomParticipant.objects.create(room=cls.room, user=cls.member)
+        start = timezone.now() - datetime.timedelta(hours=1)
+        texts = [f"release {i} is ready" for i in range(7)] + ["<script>alert(1)</script> deployed", "nothing here"]
+        Message.objects.bulk_create(
+            [
+                Message(user=cls.member, room=cls.room, chat_room=room_group_name(cls.room.room_id), seq=i + 1,
+                        message=text, timestamp=start + datetime.timedelta(minutes=i))
+                for i, text in enumerate(texts)
+            ]
+            + [Message(user=cls.member, room=other_room, chat_room=room_group_name(other_room.room_id), seq=1,
+                       message="release elsewhere")]
+        )
+
+    def setUp(self):
+        # Rate limit buckets outlive each test
+        patcher = mock.patch.object(rate_limiter, 'local', LocalBuckets())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.client.force_authenticate(self.member)
+
+    def search(self, **params):
+        return self.client.get(f"/rooms/{self.room.room_id}/search/", params)
+
+    def test_every_word_must_match_and_the_last_is_a_prefix(self):
+        messages = self.search(q='ready releas').data['messages']
+        self.assertEqual(len(messages), 7)
+        self.assertEqual([m['message'] for m in self.search(q='release 3').data['messages']], ["release 3 is ready"])
+        self.assertEqual(self.search(q='deploy').data['messages'][0]['message'], "<script>alert(1)</script> deployed")
+
+    def test_cursor_pages_through_matches_newest_first(self):
+        seen, params = [], {'q': 'release', 'limit': 3}
+        while True:
+            page = self.search(**params).data
+            seen += [message['message'] for message in page['messages']]
+            if not page['has_more']:
+                break
+            params['cursor'] = page['next_cursor']
+        self.assertEqual(seen, [f"release {i} is ready" for i in reversed(range(7))])
+
+    def test_highlight_is_escaped(self):
+        highlight = self.search(q='deployed').data['messages'][0]['highlight']
+        self.assertEqual(highlight, "&lt;script&gt;alert(1)&lt;/script&gt; <mark>deployed</mark>")
+
+    def test_rejects_bad_input_and_non_members(self):
+        self.assertEqual(self.search(q='  ').status_code, 400)
+        self.assertEqual(self.search(q='release', cursor='x').status_code, 400)
+        self.client.force_authenticate(self.outsider)
+        self.assertEqual(self.search(q='release').status_code, 404)
+
+
+class UserDirectoryTests(TestCase):
+    """Users by username, a page at a time, with prefix search and ETags."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.me = User.objects.create_user('me@example.com', 'me', 'pw')
+        for i in range(7):
+            User.objects.create_user(f"user{i}@example.com", f"Dev{i}", 'pw')
+        User.objects.create_user('zed@devs.example.com', 'zed', 'pw')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+
+    def usernames(self, **params):
+        names = []
+        while True:
+            page = self.client.get('/api/users/', params).data
+            names += [user['username'] for user in page['users']]
+            if not page['has_more']:
+                return names
+            params['cursor'] = page['next_cursor']
+
+    def test_pages_walk_users_by_username(self):
+        self.assertEqual(self.usernames(limit=3), [f"Dev{i}" for i in range(7)] + ['zed'])
+
+    def test_prefix_matches_username_or_email(self):
+        self.assertEqual(self.usernames(q='dev', limit=2), [f"Dev{i}" for i in range(7)])
+        self.assertEqual(self.usernames(q='zed@devs'), ['zed'])
+        self.assertEqual(self.usernames(q='nobody'), [])
+
+    def test_unchanged_page_is_not_modified(self):
+        response = self.client.get('/api/users/', {'limit': 3})
+        etag = response['ETag']
+        response = self.client.get('/api/users/', {'limit': 3}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        User.objects.filter(username='Dev1').update(first_name='Changed')
+        response = self.client.get('/api/users/', {'limit': 3}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_rejects_malformed_cursor(self):
+        self.assertEqual(self.client.get('/api/users/', {'cursor': 'x'}).status_code, 400)
+
+
+class OutboundQueueTests(TestCase):
+    """Slow-consumer policies, with lag measured from the client's acks."""
+
+    async def queue(self, policy, maxsize=3):
+        self.sent, self.closed = [], []
+
+        async def send(text_data=None, bytes_data=None):
+            self.sent.append(text_data)
+
+        async def close(code=None):
+            self.closed.append(code)
+
+        queue = OutboundQueue(send, close, maxsize=maxsize, policy=policy)
+        self.addCleanup(queue.stop)
+        return queue
+
+    async def settle(self):
+        """Let the writer task send what it can."""
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+    async def put(self, queue, *frames):
+        """Queue (text, kind) frames one at a time."""
+        for text, kind in frames:
+            await queue.put(text=text, kind=kind, room='room')
+            await self.settle()
+
+    async def test_clients_that_never_ack_are_not_limited_by_sent_frames(self):
+        queue = await self.queue('disconnect')
+        await self.put(queue, *[(f"m{i}", 'message') for i in range(10)])
+        self.assertEqual(len(self.sent), 10)
+        self.assertEqual(self.closed, [])
+
+    async def test_ack_is_validated_and_never_goes_backwards(self):
+        queue = await self.queue('drop_typing')
+        await self.put(queue, ("m0", 'message'), ("m1", 'message'))
+        for invalid in (-1, True, "2", None):
+            self.assertFalse(queue.ack(invalid))
+        self.assertIsNone(queue.acked)
+        self.assertTrue(queue.ack(10))
+        self.assertEqual((queue.acked, queue.unacked), (2, 0))
+        queue.ack(1)
+        self.assertEqual(queue.acked, 2)
+
+    async def test_drop_typing_drops_typing_then_disconnects(self):
+        queue = await self.queue('drop_typing')
+        queue.ack(0)
+        await self.put(queue, ("m0", 'message'), ("m1", 'message'), ("m2", 'message'), ("t", 'typing'))
+        self.assertEqual((queue.unacked, queue.dropped), (3, 1))
+        self.assertEqual(self.closed, [])
+
+        queue.ack(2)
+        await self.put(queue, ("m3", 'message'), ("m4", 'message'))
+        self.assertEqual(self.sent, ["m0", "m1", "m2", "m3", "m4"])
+        self.assertEqual(self.closed, [])
+
+        await self.put(queue, ("m5", 'message'))
+        self.assertEqual(self.closed, [CLOSE_SLOW_CONSUMER])
+        self.assertTrue(queue.closed)
+
+    async def test_coalesce_keeps_newest_typing_frame(self):
+        queue = await self.queue('coalesce')
+        blocked = asyncio.Event()
+
+        async def send(text_data=None, bytes_data=None):
+            await blocked.wait()
+            self.sent.append(text_data)
+
+        queue._send = send
+        await self.put(queue, ("m0", 'message'), ("t1", 'typing'), ("t2", 'typing'))
+        self.assertEqual(queue.coalesced, 1)
+        blocked.set()
+        await self.settle()
+        self.assertEqual(self.sent, ["m0", "t2"])
+
+        # The client has received nothing yet
+        queue.ack(0)
+        await self.put(queue, ("m1", 'message'), ("t3", 'typing'))
+        self.assertEqual((queue.unacked, queue.dropped), (3, 1))
+        await self.put(queue, ("m2", 'message'))
+        self.assertEqual(self.closed, [CLOSE_SLOW_CONSUMER])
+
+    async def test_disconnect_closes_as_soon_as_client_falls_behind(self):
+        queue = await self.queue('disconnect', maxsize=2)
+        queue.ack(0)
+        await self.put(queue, ("m0", 'message'), ("m1", 'message'), ("t", 'typing'))
+        self.assertEqual(self.sent, ["m0", "m1"])
+        self.assertEqual(self.closed, [CLOSE_SLOW_CONSUMER])
+
+
+class AckFrameTests(ConsumerTestCase):
+    """Clients report the frames they received with ack frames."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('a@example.com', 'alice', 'pw')
+
+    async def test_invalid_ack_is_refused(self):
+        communicator = self.communicator(self.user, "/ws/chat/")
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'ack', 'received': 'all'})
+        error = await self.receive(communicator, 'error')
+        await communicator.send_json_to({'type': 'ack', 'received': 0})
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+        self.assertEqual(error['message'], "Invalid ack.")
+
+
+class HistoryStreamTests(TestCase):
+    """Streamed, keyset-paginated REST history."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('a@example.com', 'alice', 'pw')
+        cls.room = Rooms.objects.create(chat_room_name='general', last_seq=100)
+        RoomParticipant.objects.create(room=cls.room, user=cls.user)
+        start = timezone.now() - datetime.timedelta(days=1)
+        Message.objects.bulk_create([
+            Message(
+                user=cls.user, room=cls.room, chat_room=room_group_name(cls.room.room_id), seq=i + 1,
+                message=f"m{i}", timestamp=start + datetime.timedelta(minutes=i)
+            )
+            for i in range(100)
+        ])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def page(self, **params):
+        response = self.client.get(f"/rooms/{self.room.room_id}/messages/", params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return json.loads(b''.join(response))
+
+    def test_pages_walk_history_newest_first(self):
+        seen = []
+        params = {'limit': 30}
+        while True:
+            page = self.page(**params)
+            self.assertEqual(page['order'], 'desc')
+            seen += [message['message'] for message in page['messages']]
+            if not page['has_more']:
+                break
+            params['before'] = page['next_cursor']
+        self.assertEqual(seen, [f"m{i}" for i in reversed(range(100))])
+
+    def test_after_cursor_reads_oldest_first(self):
+        page = self.page(after=encode_cursor(timezone.now() - datetime.timedelta(days=2), 0), limit=10)
+        self.assertEqual(page['order'], 'asc')
+        self.assertEqual([message['message'] for message in page['messages']], [f"m{i}" for i in range(10)])
+        self.assertTrue(page['has_more'])
+
+    def test_rejects_bad_cursor_and_non_members(self):
+        response = self.client.get(f"/rooms/{self.room.room_id}/messages/", {'before': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+        other = User.objects.create_user('b@example.com', 'bob', 'pw')
+        self.client.force_authenticate(other)
+        response = self.client.get(f"/rooms/{self.room.room_id}/messages/")
+        self.assertEqual(response.status_code, 404)
+
+    def test_sync_request_gets_a_sync_stream(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            response = self.client.get(f"/rooms/{self.room.room_id}/messages/", {'limit': 5})
+            self.assertFalse(response.is_async)
+            body = b''.join(response)
+        self.assertEqual(len(json.loads(body)['messages']), 5)
+
+    async def test_asgi_request_gets_an_async_stream(self):
+        token = create_access_token(self.user.id, self.user.token_version)
+        client = AsyncClient()
+        client.cookies['access_token'] = token
+        response = await client.get(f"/rooms/{self.room.room_id}/messages/", {'limit': 5})
+        self.assertTrue(response.is_async)
+        body = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(len(json.loads(body)['messages']), 5)
+
+
+class PresenceTests(ConsumerTestCase):
+    """Presence deltas, expiry of members nobody refreshes, and the online count."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create_user('a@example.com', 'alice', 'pw')
+        cls.outsider = User.objects.create_user('b@example.com', 'bob', 'pw')
+        cls.room = Rooms.objects.create(chat_room_name='general')
+        RoomParticipant.objects.create(room=cls.room, user=cls.member)
+
+    def setUp(self):
+        # The cache outlives each test's rolled-back transaction
+        membership_cache.invalidate(self.room.room_id)
+        self.layer = mock.Mock(group_send=mock.AsyncMock())
+
+    def tracker(self, store=None, **kwargs):
+        kwargs = {'heartbeat_ms': 10, 'ttl_ms': 1000, 'debounce_ms': 10, **kwargs}
+        return PresenceTracker(store or LocalPresenceStore(), **kwargs)
+
+    async def deltas(self, count):
+        """Wait for `count` broadcasts and return their frames."""
+        for _ in range(200):
+            if self.layer.group_send.await_count >= count:
+                break
+            await asyncio.sleep(0.01)
+        return [json.loads(call.args[1]['frame']) for call in self.layer.group_send.await_args_list]
+
+    async def test_deltas_carry_net_joins_and_leaves(self):
+        tracker = self.tracker()
+        await tracker.join('chat_r', 'a', 'alice', 'c1', self.layer)
+        await tracker.join('chat_r', 'b', 'bob', 'c2', self.layer)
+        await tracker.join('chat_r', 'b', 'bob', 'c3', self.layer)  # Second connection: no change
+        first, = await self.deltas(1)
+        self.assertEqual(first['joined'], [{'user': 'a', 'username': 'alice'}, {'user': 'b', 'username': 'bob'}])
+        self.assertEqual((first['left'], first['online']), ([], 2))
+
+        # Joined and left inside one window: nothing to send
+        await tracker.join('chat_r', 'c', 'carol', 'c4', self.layer)
+        await tracker.leave('chat_r', 'c', 'c4')
+        await tracker.leave('chat_r', 'b', 'c2')  # Still connected on c3
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.layer.group_send.await_count, 1)
+
+        await tracker.leave('chat_r', 'b', 'c3')
+        _, second = await self.deltas(2)
+        self.assertEqual((second['joined'], second['left'], second['online']), ([], ['b'], 1))
+        await tracker.leave('chat_r', 'a', 'c1')
+
+    async def test_unrefreshed_members_expire(self):
+        store = LocalPresenceStore()
+        tracker = self.tracker(store)
+        # A member of a process that crashed: nobody refreshes them
+        await store.add('chat_r', 'ghost', 'ghost', 0.02)
+        await tracker.join('chat_r', 'a', 'alice', 'c1', self.layer)
+        self.assertEqual(tracker.online_count('chat_r'), 2)
+
+        frames = await self.deltas(2)
+        self.assertEqual(frames[-1]['left'], ['ghost'])
+        self.assertEqual(tracker.online_count('chat_r'), 1)  # The heartbeat keeps alice online
+        await tracker.leave('chat_r', 'a', 'c1')
+
+    async def test_online_count_is_for_members_only(self):
+        def online(user):
+            client = APIClient()
+            client.force_authenticate(user)
+            return client.get(f"/room/{self.room.room_id}/online/")
+
+        communicator = self.communicator(self.member, f"/ws/chat/{self.room.room_id}/")
+        await communicator.connect()
+        await self.receive(communicator, 'presence')
+        response = await sync_to_async(online)(self.member)
+        refused = await sync_to_async(online)(self.outsider)
+        await communicator.disconnect()
+
+        self.assertEqual((response.status_code, response.data['online']), (200, 1))
+        self.assertEqual(refused.status_code, 404)
+
+
+class TypingTests(ConsumerTestCase):
+    """Typing events reach rooms as one aggregated frame per change."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('a@example.com', 'alice', 'pw')
+        cls.room = Rooms.objects.create(chat_room_name='general')
+        RoomParticipant.objects.create(room=cls.room, user=cls.user)
+
+    def setUp(self):
+        # The cache outlives each test's rolled-back transaction
+        membership_cache.invalidate(self.room.room_id)
+        self.layer = mock.Mock(group_send=mock.AsyncMock())
+
+    async def frames(self, tracker, room):
+        """Wait for the room's broadcast loop to end and return its frames."""
+        for _ in range(200):
+            if room not in tracker._scheduled:
+                break
+            await asyncio.sleep(0.01)
+        return [json.loads(call.args[1]['frame'])['users'] for call in self.layer.group_send.await_args_list]
+
+    async def test_keystrokes_are_coalesced(self):
+        tracker = TypingTracker(interval_ms=20, ttl_ms=1000)
+        for _ in range(10):
+            tracker.touch('chat_r', 'a', 'alice', self.layer)
+            tracker.touch('chat_r', 'b', 'bob', self.layer)
+        await asyncio.sleep(0.05)
+        tracker.touch('chat_r', 'a', 'alice', self.layer)  # No change: nothing sent
+        await asyncio.sleep(0.05)
+        tracker.stop('chat_r', 'a')
+        tracker.stop('chat_r', 'b')
+
+        self.assertEqual(await self.frames(tracker, 'chat_r'), [
+            [{'user': 'a', 'username': 'alice'}, {'user': 'b', 'username': 'bob'}],
+            []
+        ])
+
+    async def test_typing_expires(self):
+        tracker = TypingTracker(interval_ms=10, ttl_ms=30)
+        tracker.touch('chat_r', 'a', 'alice', self.layer)
+        self.assertEqual(await self.frames(tracker, 'chat_r'), [[{'user': 'a', 'username': 'alice'}], []])
+        self.assertEqual(tracker.active('chat_r'), [])
+
+    async def test_typing_frame_reaches_the_room(self):
+        communicator = self.communicator(self.user, f"/ws/chat/{self.room.room_id}/")
+        await communicator.connect()
+        await self.receive(communicator, 'presence')
+        with mock.patch.object(rate_limiter, 'local', LocalBuckets()):
+            await communicator.send_json_to({'type': 'typing'})
+            frame = await self.receive(communicator, 'typing')
+        await communicator.disconnect()
+
+        self.assertEqual(frame['room_id'], str(self.room.room_id))
+        self.assertEqual(frame['users'], [{'user': 'a@example.com', 'username': 'alice'}])
+
+
+class MessagePackTests(ConsumerTestCase):
+    """Clients that ask for MessagePack send and receive [type_tag, body] binary frames."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('a@example.com', 'alice', 'pw')
+        cls.room = Rooms.objects.create(chat_room_name='general')
+        RoomParticipant.objects.create(room=cls.room, user=cls.user)
+
+    def setUp(self):
+        # The cache outlives each test's rolled-back transaction
+        membership_cache.invalidate(self.room.room_id)
+
+    async def receive_binary(self, communicator, frame_type):
+        """Return the next binary frame of this type, decoded, skipping the others."""
+        while True:
+            payload = await communicator.receive_from(timeout=2)
+            self.assertIsInstance(payload, bytes)
+            frame = unpackb(payload)
+            if frame['type'] == frame_type:
+                return frame
+
+    def test_frames_round_trip(self):
+        frame = {'type': 'message', 'room_id': 'r', 'message': 'hi', 'seq': 3}
+        self.assertEqual(unpackb(packb(frame)), frame)
+        self.assertEqual(unpackb(packb({'type': 'ack'})), {'type': 'ack'})
+
+    def test_malformed_frames_are_rejected(self):
+        # Not MessagePack, unknown tag, body not a map, not an array
+        for payload in (b'\xc1', b'\x92\x63\x80', b'\x92\x01\x01', b'\x80'):
+            with self.subTest(payload=payload), self.assertRaises(FrameDecodeError):
+                unpackb(payload)
+
+    async def test_subprotocol_is_negotiated(self):
+        communicator = self.communicator(
+            self.user, f"/ws/chat/{self.room.room_id}/", subprotocols=[BINARY_SUBPROTOCOL]
+        )
+        connected, subprotocol = await communicator.connect()
+        history = await self.receive_binary(communicator, 'message_history')
+        await communicator.disconnect()
+
+        self.assertEqual((connected, subprotocol), (True, BINARY_SUBPROTOCOL))
+        self.assertEqual(history['room_id'], str(self.room.room_id))
+
+    async def test_binary_frames_are_handled(self):
+        communicator = self.communicator(self.user, f"/ws/chat/{self.room.room_id}/?protocol=msgpack")
+        await communicator.connect()
+        await self.receive_binary(communicator, 'presence')
+        with mock.patch.object(rate_limiter, 'local', LocalBuckets()):
+            await communicator.send_to(bytes_data=packb({'type': 'typing'}))
+            typing = await self.receive_binary(communicator, 'typing')
+        await communicator.send_to(bytes_data=b'not msgpack')
+        error = await self.receive_binary(communicator, 'error')
+        await communicator.disconnect()
+
+        self.assertEqual(typing['users'], [{'user': 'a@example.com', 'username': 'alice'}])
+        self.assertEqual(error['message'], "Invalid MessagePack frame.")
+
+
+class MigrationTestCase(TransactionTestCase):
+    """Migrates chat back to an older state, and forward again after each test."""
+
+    def migrate(self, targets=None):
+        """Migrate to `targets` (default: latest) and return that state's models."""
+        executor = MigrationExecutor(connection)
+        targets = targets or executor.loader.graph.leaf_nodes()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate()
+
+
+class SeqBackfillMigrationTests(MigrationTestCase):
+    """0005 numbers existing messages per room, committing batch by batch."""
+
+    def test_messages_are_numbered_in_time_order(self):
+        apps = self.migrate([('chat', '0004_message_seq')])
+        OldRooms = apps.get_model('chat', 'Rooms')
+        OldMessage = apps.get_model('chat', 'Message')
+        user = User.objects.create_user('a@example.com', 'alice', 'pw')
+        rooms = [OldRooms.objects.create(chat_room_name=name) for name in ('general', 'random')]
+        start = timezone.now() - datetime.timedelta(hours=1)
+        for i in reversed(range(5)):
+            for room in rooms:
+                OldMessage.objects.create(
+                    user_id=user.id, chat_room=f"chat_{room.room_id}",
+                    message=f"m{i}", timestamp=start + datetime.timedelta(minutes=i)
+                )
+
+        backfill = importlib.import_module('chat.migrations.0005_backfill_message_seq')
+        self.assertFalse(backfill.Migration.atomic)
+        with mock.patch.object(backfill, 'BATCH_SIZE', 2):
+            self.migrate()
+
+        for room in rooms:
+            messages = Message.objects.filter(chat_room=room_group_name(room.room_id)).order_by('seq')
+            self.assertEqual([(m.seq, m.message) for m in messages], [(i + 1, f"m{i}") for i in range(5)])
+            self.assertEqual(Rooms.objects.get(pk=room.pk).last_seq, 5)
+
+
+class RoomSummaryMigrationTests(MigrationTestCase):
+    """0009 summarises rooms whose messages aren't linked to them yet."""
+
+    def test_legacy_messages_are_counted(self):
+        apps = self.migrate([('chat', '0008_rooms_retention_days')])
+        OldRooms = apps.get_model('chat', 'Rooms')
+        OldMessage = apps.get_model('chat', 'Message')
+        # userAuth stays migrated, so its current model matches the table
+        user = User.objects.create_user('a@example.com', 'alice', 'pw')
+        room = OldRooms.objects.create(chat_room_name='general', last_seq=5)
+        start = timezone.now() - datetime.timedelta(hours=1)
+        for i in range(5):
+            # As before the foreign key: the room is only named by chat_room
+            OldMessage.objects.create(
+                user_id=user.id, chat_room=f"chat_{room.room_id}", seq=i + 1,
+                message=f"m{i}", timestamp=start + datetime.timedelta(minutes=i)
+            )
+
+        self.migrate()
+        summary = Rooms.objects.get(pk=room.pk)
+        self.assertEqual(summary.message_count, 5)
+        self.assertEqual(summary.last_message_preview, 'm4')
+        self.assertEqual(summary.last_message_at, start + datetime.timedelta(minutes=4))
+
+        call_command('backfill_message_rooms', stdout=io.StringIO())
+        summary.refresh_from_db()
+        self.assertEqual(Message.objects.filter(room=summary).count(), 5)
+        self.assertEqual((summary.message_count, summary.last_message_preview), (5, 'm4'))
+
+    def test_backfill_repairs_summaries_counted_without_legacy_messages(self):
+        user = User.objects.create_user('a@example.com', 'alice', 'pw')
+        room = Rooms.objects.create(chat_room_name='general', last_seq=3)
+        Message.objects.bulk_create([
+            Message(user=user, chat_room=room_group_name(room.room_id), seq=i + 1, message=f"m{i}")
+            for i in range(3)
+        ])
+
+        call_command('backfill_message_rooms', stdout=io.StringIO())
+        room.refresh_from_db()
+        self.assertEqual((room.message_count, room.last_message_preview), (3, 'm2'))
@@ -0,0 +1,90 @@
+"""
+Per-room typing state.
+
+Typing events are recorded in memory with an expiry instead of being fanned
+out one by one. Each room gets at most one aggregated "typing" frame per
+`CHAT_TYPING_INTERVAL_MS`, sent only when the set of typing users changes,
+and a final empty frame once everybody has stopped.
+
+State is per process: with several server processes, each one broadcasts
+the users typing on its own connections.
+"""
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+
+from chat import encoding
+from chat.models import group_room_id
+
+logger = logging.getLogger(__name__)
+
+TYPING_INTERVAL_MS = getattr(settings, 'CHAT_TYPING_INTERVAL_MS', 1000)
+TYPING_TTL_MS = getattr(settings, 'CHAT_TYPING_TTL_MS', 3000)
+
+
+class TypingTracker:
+    """Track who is typing per room and broadcast coalesced updates."""
+
+    def __init__(self, interval_ms=TYPING_INTERVAL_MS, ttl_ms=TYPING_TTL_MS):
+        self.interval = interval_ms / 1000
+        self.ttl = ttl_ms / 1000
+        self._rooms = {}      # room -> {user: (username, expires_at)}
+        self._last_sent = {}  # room -> users in the last broadcast frame
+        self._scheduled = set()
+
+    def touch(self, room, user, username, channel_layer):
+        """Record that a user is typing. Does no I/O on the caller's path."""
+        self._rooms.setdefault(room, {})[user] = (username, time.monotonic() + self.ttl)
+        if room not in self._scheduled:
+            self._scheduled.add(room)
+            asyncio.get_running_loop().create_task(self._broadcast_loop(room, channel_layer))
+
+    def stop(self, room, user):
+        """Forget a user, e.g. after they sent their message or disconnected."""
+        typing = self._rooms.get(room)
+        if typing:
+            typing.pop(user, None)
+
+    def active(self, room):
+        """Return the users currently typing in a room, dropping expired ones."""
+        typing = self._rooms.get(room)
+        if not typing:
+            return []
+        now = time.monotonic()
+        for user in [user for user, (_, expires_at) in typing.items() if expires_at <= now]:
+            del typing[user]
+        return [
+            {"user": user, "username": username}
+            for user, (username, _) in sorted(typing.items())
+        ]
+
+    async def _broadcast_loop(self, room, channel_layer):
+        try:
+            while True:
+                users = self.active(room)
+                key = tuple(entry["user"] for entry in users)
+                if key != self._last_sent.get(room, ()):
+                    self._last_sent[room] = key
+                    await channel_layer.group_send(room, {
+                        "type": "users_typing",
+                        "room": room,
+                        **encoding.encode_broadcast({
+                            "type": "typing",
+                            "room_id": group_room_id(room),
+                            "users": users
+                        })
+                    })
+                if not self.active(room):
+                    self._rooms.pop(room, None)
+                    self._last_sent.pop(room, None)
+                    break
+                await asyncio.sleep(self.interval)
+        except Exception:
+            logger.exception("Typing broadcast for %s failed", room)
+        finally:
+            self._scheduled.discard(room)
+
+
+typing_tracker = TypingTracker()
@@ -1,9 +1,32 @@
-from rest_framework.decorators import api_view, authentication_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes, throttle_classes
+from rest_framework.permissions import IsAdminUser
 from django.contrib.auth import get_user_model
-from chat.serializers import UserGetSerializer, MessageSerializer
 from rest_framework.response import Response
-from .models import Message, Rooms, RoomParticipant
+from .directory import decode_cursor as decode_directory_cursor, directory_page, page_etag
+from .models import Rooms, RoomParticipant, RoomPurge, room_group_name, room_id_from_group
+from .export import COMPRESSIONS, RoomExport, export_stats
+from .history_cache import history_cache
+from .history_stream import stream_page, streaming_chunks
+from .membership import membership_cache
+from .outbound import outbound_stats
+from .persistence import message_queue
+from .presence import presence_tracker
+from .purge import purge_worker, request_purge
+from .read_state import read_tracker
+from .search import SearchNotSupported, decode_cursor, search_messages, search_terms
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils.http import parse_etags
+from userAuth.auth_cache import auth_cache
+from userAuth.tracing import auth_tracer
+from userAuth.hashing import hash_pool
+from userAuth.revocation import revocations
 from userAuth.tokenAuth import JWTAuthentication
+from backend.ratelimit import CreateRoomRateThrottle, ExportRateThrottle, SearchRateThrottle, rate_limiter
 User = get_user_model()
 from rest_framework import status
 
@@ -11,63 +34,132 @@ from rest_framework import status
 @authentication_classes([JWTAuthentication]) 
 def get_user_list(request):
     """
-    Fetch a list of all users except the authenticated user.
+    Fetch a page of users other than the authenticated user, by username.
+    Query parameters: optionally `q` (username or email prefix), `cursor`
+    (the `next_cursor` of the previous page) and `limit`. Answers 304 when
+    If-None-Match has the page's ETag.
     """
     try:
-        user_obj = User.objects.exclude(id=request.user.id)
-        serializer = UserGetSerializer(user_obj, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        after = None
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            after = decode_directory_cursor(cursor)
+            if after is None:
+                return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+
+        page = directory_page(
+            request.user.id,
+            query=request.query_params.get('q', ''),
+            after=after,
+            limit=request.query_params.get('limit')
+        )
+        headers = {"ETag": page_etag(page), "Cache-Control": "private, no-cache"}
+        if headers["ETag"] in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(page, status=status.HTTP_200_OK, headers=headers)
     except Exception as e:
         print("Error getting the list of users:", str(e))
         return Response({"error": "Error getting user list"}, status=status.HTTP_400_BAD_REQUEST)
 
 
+def member_room(request, room_id):
+    """The room with this room_id if the user is a member and it isn't deleted, else None."""
+    if room_id_from_group(room_group_name(room_id)) is None:
+        return None
+    return Rooms.objects.filter(
+        room_id=room_id,
+        deleted_at__isnull=True,
+        participants__user=request.user
+    ).first()
+
+
 @api_view(['GET'])
 @authentication_classes([JWTAuthentication]) 
-def get_messages(request, room_name):
+def get_messages(request, room_id):
     """
-    Fetch message history for a specific chat room.
+    Stream one page of a room's message history (see chat/history_stream.py).
+    Query parameters: optionally `before` and/or `after` (cursors from
+    `next_cursor` or search results) and `limit`. Only members of the room
+    can read it.
     """
     try:
-        room_group_name = f"chat_{room_name}"
-        messages = Message.objects.filter(chat_room=room_group_name).order_by('timestamp')
-        serializer = MessageSerializer(messages, many=True)
-
-        response_data = {
-            "type": "message_history",
-            "messages": [
-                {
-                    "user": msg["user"],
-                    "message": msg["message"],
-                    "timestamp": msg["timestamp"],
-                }
-                for msg in serializer.data
-            ]
-        }
+        bounds = {}
+        for name in ('before', 'after'):
+            cursor = request.query_params.get(name)
+            if cursor:
+                bounds[name] = decode_cursor(cursor)
+                if bounds[name] is None:
+                    return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
 
-        return Response(response_data, status=status.HTTP_200_OK)
+        room = member_room(request, room_id)
+        if not room:
+            return Response({"error": "Room not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        return StreamingHttpResponse(
+            streaming_chunks(request, stream_page(room, limit=request.query_params.get('limit'), **bounds)),
+            content_type='application/json'
+        )
     except Exception as e:
         print(f"Error fetching messages: {str(e)}")
         return Response({"error": "Error fetching messages"}, status=status.HTTP_400_BAD_REQUEST)
 
-        
+
+@api_view(['GET'])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAdminUser])
+@throttle_classes([ExportRateThrottle])
+def export_room(request, room_id):
+    """
+    Download every message of a room as NDJSON, streamed (see chat/export.py).
+    `?compression=gzip` compresses it on the fly. Staff only.
+    """
+    try:
+        compression = request.query_params.get('compression') or None
+        if compression not in COMPRESSIONS:
+            return Response({"error": "Unsupported compression"}, status=status.HTTP_400_BAD_REQUEST)
+
+        room = None
+        if room_id_from_group(room_group_name(room_id)) is not None:
+            room = Rooms.objects.filter(room_id=room_id, deleted_at__isnull=True).first()
+        if not room:
+            return Response({"error": "Room not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        export = RoomExport(room, compression=compression)
+        response = StreamingHttpResponse(streaming_chunks(request, export.chunks()), content_type=export.content_type)
+        response['Content-Disposition'] = f'attachment; filename="{export.filename}"'
+        return response
+    except Exception as e:
+        print(f"Error exporting room: {str(e)}")
+        return Response({"error": "Error exporting room"}, status=status.HTTP_400_BAD_REQUEST)
+
 
 @api_view(['GET'])
 @authentication_classes([JWTAuthentication]) 
 def get_user_rooms(request):
     """
-    Get all chat rooms the authenticated user is part of.
+    Get all chat rooms the authenticated user is part of, most recently
+    active first, each with a preview of its latest message.
     """
     try:
         participant_rooms = RoomParticipant.objects.filter(
-            user=request.user
-        ).select_related('room')
+            user=request.user,
+            room__deleted_at__isnull=True
+        ).select_related('room').annotate(
+            last_activity=Coalesce('room__last_message_at', 'room__created_at'),
+            unread_count=Greatest(F('room__last_seq') - F('last_read_seq'), Value(0))
+        ).order_by('-last_activity', '-room__id')
         
         rooms_data = [
             {
                 "room_name": participant.room.chat_room_name,
                 "room_id": str(participant.room.room_id),
                 "created_at": participant.room.created_at.isoformat(),
+                "last_message_preview": participant.room.last_message_preview,
+                "last_message_at": participant.room.last_message_at.isoformat() if participant.room.last_message_at else None,
+                "message_count": participant.room.message_count,
+                "last_seq": participant.room.last_seq,
+                "last_read_seq": participant.last_read_seq,
+                "unread_count": participant.unread_count,
                 "created_by": {
                     "id": str(participant.user.id),
                     "email": participant.user.email,
@@ -90,6 +182,7 @@ def get_user_rooms(request):
         
 @api_view(['POST'])
 @authentication_classes([JWTAuthentication]) 
+@throttle_classes([CreateRoomRateThrottle])
 def create_room(request):
     """
     Create a new chat room and add the creator as a participant.
@@ -99,14 +192,24 @@ def create_room(request):
         if not chat_room_name:
             return Response({"error": "Chat room name is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        if Rooms.objects.filter(chat_room_name=chat_room_name).exists():
+        if Rooms.objects.filter(chat_room_name=chat_room_name, deleted_at__isnull=True).exists():
             return Response({"error": "A room with this name already exists"}, status=status.HTTP_400_BAD_REQUEST)
 
+        retention_days = request.data.get('retention_days')
+        if retention_days is not None:
+            try:
+                retention_days = int(retention_days)
+                if retention_days < 1:
+                    raise ValueError
+            except (TypeError, ValueError):
+                return Response({"error": "retention_days must be a positive number of days"}, status=status.HTTP_400_BAD_REQUEST)
+
         # Create the room
-        room = Rooms.objects.create(chat_room_name=chat_room_name)
+        room = Rooms.objects.create(chat_room_name=chat_room_name, retention_days=retention_days)
         
         # Add the creator as a participant
         RoomParticipant.objects.create(room=room, user=request.user)
+        membership_cache.invalidate(room.room_id, request.user.id)
         
         return Response({
             "room_id": str(room.room_id),
@@ -134,11 +237,16 @@ def join_room(request):
         if not room_id:
             return Response({"error": "Room ID is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        room = Rooms.objects.filter(room_id=room_id).first()
+        room = Rooms.objects.filter(room_id=room_id, deleted_at__isnull=True).first()
         if not room:
             return Response({"error": "Room not found"}, status=status.HTTP_404_NOT_FOUND)
 
-        participant, created = RoomParticipant.objects.get_or_create(room=room, user=request.user)
+        # New members start with the existing history read
+        participant, created = RoomParticipant.objects.get_or_create(
+            room=room, user=request.user, defaults={"last_read_seq": room.last_seq}
+        )
+        if created:
+            membership_cache.invalidate(room.room_id, request.user.id)
         
         return Response({
             "message": f"{'Joined' if created else 'Already in'} room {room.chat_room_name}",
@@ -164,9 +272,12 @@ def delete_room(request, room_id):
     """
     Delete a chat room by its room ID.
     Only room creator or admin can delete.
+
+    The room disappears at once and connected clients are disconnected;
+    its messages are deleted in the background (see chat.purge).
     """
     try:
-        room = Rooms.objects.filter(room_id=room_id).first()
+        room = Rooms.objects.filter(room_id=room_id, deleted_at__isnull=True).first()
         if not room:
             return Response({"error": "Room not found"}, status=status.HTTP_404_NOT_FOUND)
 
@@ -175,13 +286,138 @@ def delete_room(request, room_id):
         # if first_participant.user != request.user:
         #     return Response({"error": "Only the room creator can delete this room"}, status=403)
 
-        room.delete()
+        purge = request_purge(room, request.user)
+
+        def notify():
+            membership_cache.invalidate(room.room_id)
+            async_to_sync(get_channel_layer().group_send)(
+                room_group_name(room.room_id),
+                {"type": "room_deleted", "room": room_group_name(room.room_id)}
+            )
+            purge_worker.wake()
+        transaction.on_commit(notify)
+
         return Response({
             "message": "Room deleted successfully",
             "deleted_room": {
                 "room_id": str(room_id),
+            },
+            "purge": {
+                "status": purge.status,
+                "status_url": f"/room/delete/{room.room_id}/status/"
             }
-        }, status=status.HTTP_200_OK)
+        }, status=status.HTTP_202_ACCEPTED)
     except Exception as e:
         print(f"Error deleting room: {str(e)}")
-        return Response({"error": "Error deleting room"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+        return Response({"error": "Error deleting room"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAdminUser])
+def get_chat_stats(request):
+    """
+    Return this process's chat subsystem counters. Staff only.
+    """
+    return Response({
+        "write_behind": message_queue.stats(),
+        "history_cache": history_cache.stats(),
+        "outbound": outbound_stats.snapshot(),
+        "read_state": read_tracker.stats(),
+        "membership_cache": membership_cache.stats(),
+        "auth_cache": auth_cache.stats(),
+        "auth_trace": auth_tracer.stats(),
+        "auth_hash_pool": hash_pool.stats(),
+        "token_revocation": revocations.stats(),
+        "rate_limit": rate_limiter.stats(),
+        "export": export_stats.stats(),
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@authentication_classes([JWTAuthentication])
+def get_room_online(request, room_id):
+    """
+    Return the number of users currently online in a room.
+    Only members of the room can see it.
+    """
+    try:
+        if not member_room(request, room_id):
+            return Response({"error": "Room not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        online = presence_tracker.online_count(room_group_name(room_id))
+        return Response({
+            "room_id": room_id,
+            "online": online
+        }, status=status.HTTP_200_OK)
+    except Exception as e:
+        print(f"Error fetching room presence: {str(e)}")
+        return Response({"error": "Error fetching room presence"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@authentication_classes([JWTAuthentication])
+def get_room_purge_status(request, room_id):
+    """
+    Report the progress of a deleted room's background purge.
+    Visible to the user who deleted the room and to staff.
+    """
+    try:
+        purge = RoomPurge.objects.filter(room_id=room_id).first()
+        if not purge or (purge.requested_by_id != request.user.id and not request.user.is_staff):
+            return Response({"error": "Purge not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response({
+            "room_id": str(purge.room_id),
+            "room_name": purge.chat_room_name,
+            "status": purge.status,
+            "messages_total": purge.messages_total,
+            "messages_deleted": purge.messages_deleted,
+            "participants_deleted": purge.participants_deleted,
+            "error": purge.error or None,
+            "created_at": purge.created_at.isoformat(),
+            "started_at": purge.started_at.isoformat() if purge.started_at else None,
+            "finished_at": purge.finished_at.isoformat() if purge.finished_at else None
+        }, status=status.HTTP_200_OK)
+    except Exception as e:
+        print(f"Error fetching purge status: {str(e)}")
+        return Response({"error": "Error fetching purge status"}, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(['GET'])
+@authentication_classes([JWTAuthentication])
+@throttle_classes([SearchRateThrottle])
+def search_room_messages(request, room_id):
+    """
+    Full-text search of a room's messages, newest first.
+    Query parameters: `q`, and optionally `cursor` (the `next_cursor` of
+    the previous page) and `limit`. Only members of the room can search it.
+    """
+    try:
+        query = request.query_params.get('q', '')
+        terms = search_terms(query)
+        if not terms:
+            return Response({"error": "Search query is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        before = None
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            before = decode_cursor(cursor)
+            if before is None:
+                return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+
+        room = member_room(request, room_id)
+        if not room:
+            return Response({"error": "Room not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        results = search_messages(room.pk, terms, before=before, limit=request.query_params.get('limit'))
+        return Response({
+            "room_id": str(room.room_id),
+            "query": query,
+            **results
+        }, status=status.HTTP_200_OK)
+    except SearchNotSupported as e:
+        return Response({"error": str(e)}, status=status.HTTP_501_NOT_IMPLEMENTED)
+    except Exception as e:
+        print(f"Error searching messages: {str(e)}")
+        return Response({"error": "Error searching messages"}, status=status.HTTP_400_BAD_REQUEST)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class UserauthConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'userAuth'
+
+    def ready(self):
+        # Registers the signal handlers that keep the auth cache fresh
+        from . import auth_cache  # noqa: F401
@@ -0,0 +1,188 @@
+"""
+Cache of verified access tokens and the users they belong to.
+
+Authenticating a request used to verify the token's signature and load the
+user from the database every time. Both results are now cached in process
+memory, in bounded LRU maps:
+
+* Verified claims per token, for `AUTH_CACHE_TTL` seconds but never past
+  the token's own `exp`.
+* A snapshot of the user's fields (no password), for `AUTH_CACHE_USER_TTL`
+  seconds. Each request gets its own User instance built from it, with the
+  other fields deferred, so saving it can't overwrite them.
+
+Tokens carry the user's `token_version` ("ver"); changing the password or
+disabling the account bumps it, which revokes every token issued before.
+Saving or deleting a user drops its snapshot in this process right away;
+other processes see the change once their snapshot expires.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.exceptions import AuthenticationFailed
+
+from .revocation import revocations
+from .tracing import NULL_TRACE
+
+User = get_user_model()
+
+AUTH_CACHE_ENABLED = getattr(settings, 'AUTH_CACHE_ENABLED', True)
+AUTH_CACHE_TTL = getattr(settings, 'AUTH_CACHE_TTL', 300)
+AUTH_CACHE_USER_TTL = getattr(settings, 'AUTH_CACHE_USER_TTL', 60)
+AUTH_CACHE_MAX_ENTRIES = getattr(settings, 'AUTH_CACHE_MAX_ENTRIES', 10_000)
+
+# Everything authentication and the views need; the password hash stays out.
+# In model field order, as User.from_db expects the values.
+USER_FIELDS = tuple(
+    field.attname for field in User._meta.concrete_fields
+    if field.attname in {
+        'id', 'email', 'username', 'first_name', 'last_name',
+        'is_active', 'is_staff', 'is_superuser', 'token_version',
+    }
+)
+
+
+class TTLCache:
+    """LRU map whose entries also expire at a wall-clock time."""
+
+    def __init__(self, max_entries=AUTH_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class AuthCache:
+    """Turn an access token into a User, from cache when possible."""
+
+    def __init__(self, enabled=AUTH_CACHE_ENABLED, ttl=AUTH_CACHE_TTL, user_ttl=AUTH_CACHE_USER_TTL):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.user_ttl = user_ttl
+        self.claims = TTLCache()
+        self.users = TTLCache()
+
+    def decode(self, token, trace=NULL_TRACE):
+        """
+        Verify an access token and return its claims. Raises
+        jwt.ExpiredSignatureError if it expired, AuthenticationFailed otherwise.
+        """
+        claims = self.claims.get(token) if self.enabled else None
+        if claims is not None:
+            trace.mark('decode', claims_cached=True)
+            return claims
+        try:
+            claims = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+        except jwt.ExpiredSignatureError:
+            raise
+        except jwt.InvalidTokenError:
+            raise AuthenticationFailed("Invalid token")
+
+        if claims.get("type") != "access":
+            raise AuthenticationFailed("Invalid token type")
+        if not claims.get("id"):
+            raise AuthenticationFailed("Invalid token payload")
+
+        if self.enabled:
+            expires_at = time.time() + self.ttl
+            if "exp" in claims:
+                expires_at = min(expires_at, claims["exp"])
+            self.claims.set(token, claims, expires_at)
+        trace.mark('decode', claims_cached=False)
+        return claims
+
+    def cached_user(self, token, trace=NULL_TRACE):
+        """Return the token's user if both are cached, else None. Never queries the database."""
+        if not self.enabled:
+            return None
+        claims = self.decode(token, trace)
+        if revocations.might_be_revoked(claims.get("jti")):
+            return None  # The exact check may need Redis
+        values = self.users.get(claims["id"])
+        if values is None:
+            return None
+        trace.mark('user', user_cached=True)
+        return self.check(claims, values)
+
+    def authenticate(self, token, trace=NULL_TRACE):
+        """Return the token's user, loading it from the database if needed."""
+        claims = self.decode(token, trace)
+        values = self.users.get(claims["id"]) if self.enabled else None
+        if values is not None:
+            trace.mark('user', user_cached=True)
+        else:
+            values = User.objects.filter(id=claims["id"]).values_list(*USER_FIELDS).first()
+            trace.mark('user', user_cached=False)
+            if values is None:
+                raise AuthenticationFailed("User not found")
+            if self.enabled:
+                self.users.set(claims["id"], values, time.time() + self.user_ttl)
+        return self.check(claims, values)
+
+    def check(self, claims, values):
+        user = User.from_db(User.objects.db, USER_FIELDS, values)
+        if not user.is_active:
+            raise AuthenticationFailed("User account is disabled")
+        if claims.get("ver", 0) != user.token_version:
+            raise AuthenticationFailed("Token has been revoked")
+        if revocations.is_revoked(claims.get("jti")):
+            raise AuthenticationFailed("Token has been revoked")
+        return user
+
+    def invalidate_user(self, user_id):
+        self.users.pop(user_id)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "claims": self.claims.stats(),
+            "users": self.users.stats(),
+        }
+
+
+auth_cache = AuthCache()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def drop_cached_user(sender, instance, **kwargs):
+    auth_cache.invalidate_user(instance.pk)
@@ -0,0 +1,181 @@
+"""
+Bounded worker pool for password hashing and the rest of the login work.
+
+Checking a password runs PBKDF2 for a few hundred milliseconds of CPU. Done
+inline, a burst of logins (every client reconnecting after an outage) ties
+up as many request threads and cores as there are logins, and every other
+endpoint waits behind them. Login, register and refresh now hand their
+credential work to this pool instead:
+
+* At most `AUTH_HASH_WORKERS` run at once, each on its own thread and
+  database connection; hashlib releases the GIL while hashing, so they
+  really run in parallel, up to that many cores.
+* At most `AUTH_HASH_MAX_QUEUE` more wait for a worker. Past that, requests
+  are turned away with 503 and a Retry-After estimate instead of queueing
+  without bound.
+* A request that waited `AUTH_HASH_TIMEOUT` seconds without a worker
+  picking it up is withdrawn and answered the same way.
+
+What the pool bounds is CPU and admission, not request threads. The three
+views are synchronous and wait on the pool's result, so each request in
+flight still holds its server thread (under ASGI, one of the threads Django
+runs sync views on) while a worker hashes. Those threads only wait, though:
+hashing can't take more than `AUTH_HASH_WORKERS` cores away from the rest of
+the API, and the queue limit caps how many requests wait at once.
+
+Queue wait and run times are kept per kind of work and shown in
+/chat/stats/.
+"""
+import concurrent.futures
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+AUTH_HASH_WORKERS = getattr(settings, 'AUTH_HASH_WORKERS', min(4, os.cpu_count() or 1))
+AUTH_HASH_MAX_QUEUE = getattr(settings, 'AUTH_HASH_MAX_QUEUE', 32)
+AUTH_HASH_TIMEOUT = getattr(settings, 'AUTH_HASH_TIMEOUT', 10)
+
+
+class AuthServiceBusy(APIException):
+    """The hashing pool is full; DRF answers 503 with a Retry-After header."""
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Too many sign-ins in progress, please try again shortly."
+    default_code = 'auth_busy'
+
+    def __init__(self, wait):
+        super().__init__()
+        self.wait = wait
+
+
+class KindStats:
+    """Counters and timings of one kind of work (login, register, refresh)."""
+
+    def __init__(self):
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.run_ms = 0.0
+        self.max_run_ms = 0.0
+
+    def record(self, wait_ms, run_ms):
+        self.completed += 1
+        self.wait_ms += wait_ms
+        self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        self.run_ms += run_ms
+        self.max_run_ms = max(self.max_run_ms, run_ms)
+
+    def as_dict(self):
+        return {
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait_ms": round(self.wait_ms / self.completed, 3) if self.completed else 0.0,
+            "max_wait_ms": round(self.max_wait_ms, 3),
+            "avg_run_ms": round(self.run_ms / self.completed, 3) if self.completed else 0.0,
+            "max_run_ms": round(self.max_run_ms, 3),
+        }
+
+
+class HashPool:
+    """Run blocking credential work on a few dedicated threads, refusing it when they're swamped."""
+
+    def __init__(self, workers=AUTH_HASH_WORKERS, max_queue=AUTH_HASH_MAX_QUEUE, timeout=AUTH_HASH_TIMEOUT):
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+        self.kinds = {}
+
+    @property
+    def executor(self):
+        # Created on first use, so management commands never start the threads
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix='auth-hash'
+                    )
+        return self._executor
+
+    def _kind(self, kind):
+        return self.kinds.setdefault(kind, KindStats())
+
+    def retry_after(self):
+        """Seconds until the queue has likely drained, from the average run time."""
+        runs = sum(stats.completed for stats in self.kinds.values())
+        avg_s = sum(stats.run_ms for stats in self.kinds.values()) / runs / 1000 if runs else 1.0
+        return max(1, math.ceil(avg_s * self.in_flight / self.workers))
+
+    def run(self, kind, fn, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs) on a pool thread and return its result (or
+        raise its exception). Raises AuthServiceBusy if the pool is full or
+        no worker picked the call up in time.
+        """
+        with self._lock:
+            stats = self._kind(kind)
+            if self.in_flight >= self.workers + self.max_queue:
+                stats.rejected += 1
+                raise AuthServiceBusy(self.retry_after())
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+
+        submitted = time.perf_counter()
+
+        def work():
+            started = time.perf_counter()
+            close_old_connections()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                close_old_connections()
+                finished = time.perf_counter()
+                with self._lock:
+                    stats.record((started - submitted) * 1000, (finished - started) * 1000)
+
+        try:
+            future = self.executor.submit(work)
+        except BaseException:
+            self._release()
+            raise
+        # Also runs for calls cancelled before they started
+        future.add_done_callback(lambda _: self._release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            if future.cancel():
+                with self._lock:
+                    stats.timed_out += 1
+                raise AuthServiceBusy(self.retry_after())
+            # Already running: it finishes in a few hundred milliseconds
+            return future.result()
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "queued": max(0, self.in_flight - self.workers),
+                "peak": self.peak,
+                "kinds": {kind: stats.as_dict() for kind, stats in self.kinds.items()},
+            }
+
+
+hash_pool = HashPool()
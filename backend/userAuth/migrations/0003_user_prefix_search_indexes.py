@@ -0,0 +1,40 @@
+from django.db import migrations
+
+# Indexes for case-insensitive prefix search (username__istartswith /
+# email__istartswith) in the user directory. Each matches the SQL Django
+# generates for the lookup on that database.
+SQLITE_FORWARD = [
+    'CREATE INDEX IF NOT EXISTS user_username_prefix_idx ON "userAuth_user" (username COLLATE NOCASE)',
+    'CREATE INDEX IF NOT EXISTS user_email_prefix_idx ON "userAuth_user" (email COLLATE NOCASE)',
+]
+
+POSTGRES_FORWARD = [
+    'CREATE INDEX IF NOT EXISTS user_username_prefix_idx ON "userAuth_user" (UPPER(username::text) text_pattern_ops)',
+    'CREATE INDEX IF NOT EXISTS user_email_prefix_idx ON "userAuth_user" (UPPER(email::text) text_pattern_ops)',
+]
+
+BACKWARD = [
+    "DROP INDEX IF EXISTS user_username_prefix_idx",
+    "DROP INDEX IF EXISTS user_email_prefix_idx",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userAuth', '0002_user_token_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            run({'sqlite': BACKWARD, 'postgresql': BACKWARD}),
+        ),
+    ]
@@ -29,11 +29,47 @@ class UserManager(BaseUserManager):
 class User(AbstractUser):
     username = models.CharField(max_length=150, unique=True)
     email = models.EmailField(unique=True)
+    # Carried in issued tokens ("ver"); bumping it invalidates every token of the user
+    token_version = models.PositiveIntegerField(default=0)
 
     objects = UserManager()
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username'] 
 
+    # Changes to these fields revoke the user's tokens
+    CREDENTIAL_FIELDS = ('password', 'is_active')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        user._remember_credentials()
+        return user
+
+    def _remember_credentials(self):
+        deferred = self.get_deferred_fields()
+        self._loaded_credentials = {
+            name: getattr(self, name) for name in self.CREDENTIAL_FIELDS if name not in deferred
+        }
+
+    def credentials_changed(self):
+        """True if the password was changed, or the account disabled, since loading."""
+        loaded = getattr(self, '_loaded_credentials', None)
+        if loaded is None:
+            return False  # New user
+        deferred = self.get_deferred_fields()
+        if 'password' not in deferred and self.password != loaded.get('password', self.password):
+            return True
+        return 'is_active' not in deferred and loaded.get('is_active') and not self.is_active
+
+    def save(self, *args, **kwargs):
+        if self.credentials_changed():
+            self.token_version += 1
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'token_version'}
+        super().save(*args, **kwargs)
+        self._remember_credentials()
+
     def __str__(self):
         return self.username
@@ -0,0 +1,345 @@
+"""
+Revocation of individual tokens by their `jti`.
+
+Every access and refresh token carries a random `jti`. Revoking one (the
+old refresh token when `refresh_token` rotates it, both tokens on logout)
+adds its jti to a store that is consulted on every refresh and every
+authenticated request, so the check has to be cheap:
+
+* A bloom filter in process memory answers "definitely not revoked" for
+  almost every token with a few bit lookups and no I/O.
+* Only tokens it flags are looked up in an exact set: in process memory by
+  default, or in Redis with `AUTH_REVOCATION_REDIS_URL`, where each jti is
+  a key that expires with its token.
+
+Refresh tokens are revoked as they are rotated. Clients that refresh
+concurrently with the same token (two tabs, or a retry after a lost
+response) would all but one be logged out, so for
+`AUTH_REFRESH_REUSE_SECONDS` after a rotation the same token gets back the
+pair it was exchanged for instead of an error. After that, or if the token
+was revoked by a logout, it is refused.
+
+Entries only matter until their token expires. The bloom filter can't
+forget single entries, so it is kept as two generations of
+`REFRESH_TOKEN_LIFETIME` each; the older one is dropped when a new one
+starts, by which time every token it covered has expired.
+
+With Redis, revocations are also appended to a stream that every process
+reads into its own bloom filter every `AUTH_REVOCATION_SYNC_MS`, so a token
+revoked by one process is refused by all of them within that delay. If
+Redis is unreachable, the revocations this process made are still known.
+Without Redis, other processes don't learn about revocations at all.
+"""
+import hashlib
+import json
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+
+from .tokens import REFRESH_TOKEN_LIFETIME
+
+logger = logging.getLogger(__name__)
+
+AUTH_REVOCATION_REDIS_URL = getattr(settings, 'AUTH_REVOCATION_REDIS_URL', None)
+# Revocations expected per generation; past it the false positive rate grows
+AUTH_REVOCATION_CAPACITY = getattr(settings, 'AUTH_REVOCATION_CAPACITY', 100_000)
+AUTH_REVOCATION_SYNC_MS = getattr(settings, 'AUTH_REVOCATION_SYNC_MS', 1000)
+AUTH_REFRESH_REUSE_SECONDS = getattr(settings, 'AUTH_REFRESH_REUSE_SECONDS', 10)
+FALSE_POSITIVE_RATE = 0.01
+
+
+class BloomFilter:
+    """Fixed-size set of strings that may report false positives, never false negatives."""
+
+    def __init__(self, capacity, error_rate=FALSE_POSITIVE_RATE):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, value):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+
+
+class GenerationalBloomFilter:
+    """Two bloom filters of `lifetime` seconds each; values are forgotten after one to two lifetimes."""
+
+    def __init__(self, capacity=AUTH_REVOCATION_CAPACITY, lifetime=REFRESH_TOKEN_LIFETIME.total_seconds()):
+        self.capacity = capacity
+        self.lifetime = lifetime
+        self.current = BloomFilter(capacity)
+        self.previous = None
+        self.started = time.time()
+
+    def rotate(self):
+        if time.time() - self.started >= self.lifetime:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity)
+            self.started = time.time()
+
+    def add(self, value):
+        self.rotate()
+        self.current.add(value)
+
+    def __contains__(self, value):
+        self.rotate()
+        return value in self.current or (self.previous is not None and value in self.previous)
+
+    def fill_ratio(self):
+        return round(int.from_bytes(self.current.bits, 'little').bit_count() / self.current.size, 4)
+
+
+class LocalRevocations:
+    """Exact set of jtis revoked by this process, each kept until its token expires."""
+
+    PRUNE_INTERVAL = 60
+
+    def __init__(self):
+        self._expiry = {}  # jti -> exp (unix seconds)
+        self._issued = {}  # rotated jti -> (pair issued for it, reusable until)
+        self._next_prune = time.time() + self.PRUNE_INTERVAL
+
+    def add(self, jti, exp):
+        """Record a revocation. Returns False if the jti was already revoked."""
+        now = time.time()
+        if now >= self._next_prune:
+            self._expiry = {key: value for key, value in self._expiry.items() if value > now}
+            self._issued = {key: value for key, value in self._issued.items() if value[1] > now}
+            self._next_prune = now + self.PRUNE_INTERVAL
+        if self._expiry.get(jti, 0) > now:
+            return False
+        self._expiry[jti] = exp
+        return True
+
+    def rotate(self, jti, exp, pair, reuse_seconds):
+        """
+        Revoke a refresh token exchanged for `pair`. Returns (True, pair) if
+        this call revoked it, else (False, the pair issued when it was
+        rotated, or None once that can no longer be reused).
+        """
+        if self.add(jti, exp):
+            if reuse_seconds > 0:
+                self._issued[jti] = (pair, time.time() + reuse_seconds)
+            return True, pair
+        issued, reusable_until = self._issued.get(jti, (None, 0))
+        return False, issued if reusable_until > time.time() else None
+
+    def __contains__(self, jti):
+        return self._expiry.get(jti, 0) > time.time()
+
+    def __len__(self):
+        return len(self._expiry)
+
+
+class RedisRevocations:
+    """Exact set of revoked jtis in Redis, one key per jti, plus a stream of revocations."""
+
+    STREAM = 'auth:revocations'
+
+    # Revokes and records the issued pair together, so a concurrent rotation
+    # either wins or finds the pair
+    ROTATE_SCRIPT = """
+    if redis.call('SET', KEYS[1], 1, 'NX', 'EXAT', ARGV[1]) then
+        if tonumber(ARGV[3]) > 0 then
+            redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+        end
+        return {1, ARGV[2]}
+    end
+    return {0, redis.call('GET', KEYS[2]) or ''}
+    """
+
+    def __init__(self, url, lifetime):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.rotate_script = self.client.register_script(self.ROTATE_SCRIPT)
+        self.lifetime_ms = int(lifetime * 1000)
+        self.last_id = '0-0'
+
+    def key(self, jti):
+        return f"auth:revoked:{jti}"
+
+    def issued_key(self, jti):
+        return f"auth:rotated:{jti}"
+
+    def publish(self, jti):
+        # Entries older than a refresh token's lifetime are trimmed
+        min_id = f"{int(time.time() * 1000) - self.lifetime_ms}-0"
+        self.client.xadd(self.STREAM, {'jti': jti}, minid=min_id, approximate=True)
+
+    def add(self, jti, exp):
+        """Record a revocation. Returns False if the jti was already revoked."""
+        created = self.client.set(self.key(jti), 1, nx=True, exat=int(math.ceil(exp)))
+        if created:
+            self.publish(jti)
+        return bool(created)
+
+    def rotate(self, jti, exp, pair, reuse_seconds):
+        """Like LocalRevocations.rotate, across every process."""
+        created, issued = self.rotate_script(
+            keys=[self.key(jti), self.issued_key(jti)],
+            args=[int(math.ceil(exp)), json.dumps(pair), int(math.ceil(reuse_seconds))]
+        )
+        if created:
+            self.publish(jti)
+            return True, pair
+        return False, tuple(json.loads(issued)) if issued else None
+
+    def __contains__(self, jti):
+        return bool(self.client.exists(self.key(jti)))
+
+    def read_new(self, count=10_000):
+        """Return the jtis appended to the stream since the last call."""
+        jtis = []
+        while True:
+            entries = self.client.xrange(self.STREAM, min=f"({self.last_id}", count=count)
+            for entry_id, fields in entries:
+                jtis.append(fields[b'jti'].decode('utf-8'))
+                self.last_id = entry_id.decode('ascii')
+            if len(entries) < count:
+                return jtis
+
+
+class RevocationStore:
+    """Revoke tokens by jti and tell whether one was revoked, mostly without I/O."""
+
+    def __init__(self, redis_url=AUTH_REVOCATION_REDIS_URL, sync_ms=AUTH_REVOCATION_SYNC_MS):
+        lifetime = REFRESH_TOKEN_LIFETIME.total_seconds()
+        self.bloom = GenerationalBloomFilter(lifetime=lifetime)
+        self.local = LocalRevocations()
+        self.shared = RedisRevocations(redis_url, lifetime) if redis_url else None
+        self.sync_interval = sync_ms / 1000
+        self._lock = threading.Lock()
+        self._syncer = None
+
+        # Counters
+        self.revoked = 0
+        self.reused = 0
+        self.checks = 0
+        self.bloom_hits = 0
+        self.rejected = 0
+        self.errors = 0
+
+    def revoke(self, jti, exp):
+        """
+        Revoke the token with this jti until `exp` (unix seconds). Returns
+        False if it had already been revoked, so concurrent rotations of the
+        same refresh token can't both succeed.
+        """
+        if not jti or exp <= time.time():
+            return True
+        with self._lock:
+            created = self.local.add(jti, exp)
+            self.bloom.add(jti)
+        if self.shared is not None:
+            try:
+                created = self.shared.add(jti, exp) and created
+            except Exception:
+                logger.exception("Token revocation could not be shared")
+                self.errors += 1
+        if created:
+            self.revoked += 1
+        return created
+
+    def rotate(self, jti, exp, pair, reuse_seconds=None):
+        """
+        Revoke a refresh token as it is exchanged for `pair` (access, refresh)
+        and return the pair to hand out: `pair` if this call revoked the token,
+        the pair of the rotation that did if it happened less than
+        `reuse_seconds` (default AUTH_REFRESH_REUSE_SECONDS) ago, else None.
+        """
+        if not jti or exp <= time.time():
+            return pair
+        if reuse_seconds is None:
+            reuse_seconds = AUTH_REFRESH_REUSE_SECONDS
+        with self._lock:
+            created, issued = self.local.rotate(jti, exp, pair, reuse_seconds)
+            self.bloom.add(jti)
+        if self.shared is not None:
+            try:
+                created, issued = self.shared.rotate(jti, exp, pair, reuse_seconds)
+            except Exception:
+                logger.exception("Token rotation could not be shared")
+                self.errors += 1
+        if created:
+            self.revoked += 1
+        elif issued is not None:
+            self.reused += 1
+        return issued
+
+    def might_be_revoked(self, jti):
+        """True if the jti needs an exact lookup; False means it is certainly not revoked."""
+        self.ensure_syncing()
+        return bool(jti) and jti in self.bloom
+
+    def is_revoked(self, jti):
+        self.checks += 1
+        if not self.might_be_revoked(jti):
+            return False
+        self.bloom_hits += 1
+        revoked = jti in self.local
+        if not revoked and self.shared is not None:
+            try:
+                revoked = jti in self.shared
+            except Exception:
+                logger.exception("Token revocation lookup failed, using this process's revocations")
+                self.errors += 1
+        if revoked:
+            self.rejected += 1
+        return revoked
+
+    def ensure_syncing(self):
+        """Start following the shared revocation stream, once, on first use."""
+        if self.shared is None or self._syncer is not None:
+            return
+        with self._lock:
+            if self._syncer is None:
+                self._syncer = threading.Thread(target=self._sync_loop, name='auth-revocation-sync', daemon=True)
+                self._syncer.start()
+
+    def sync(self):
+        jtis = self.shared.read_new()
+        with self._lock:
+            for jti in jtis:
+                self.bloom.add(jti)
+
+    def _sync_loop(self):
+        while True:
+            try:
+                self.sync()
+            except Exception:
+                logger.exception("Reading shared token revocations failed")
+                self.errors += 1
+            time.sleep(self.sync_interval)
+
+    def stats(self):
+        return {
+            "shared": self.shared is not None,
+            "revoked": self.revoked,
+            "reused": self.reused,
+            "local_entries": len(self.local),
+            "bloom_fill_ratio": self.bloom.fill_ratio(),
+            "checks": self.checks,
+            "bloom_hits": self.bloom_hits,
+            "rejected": self.rejected,
+            "errors": self.errors,
+        }
+
+
+revocations = RevocationStore()
@@ -1,3 +1,219 @@
-from django.test import TestCase
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from backend.ratelimit import LocalBuckets, RateLimiter, rate_limiter
+from chat.channels_middleware import JWTWebsocketMiddleware
+from chat.route import websocket_urlpatterns
+from userAuth.auth_cache import auth_cache
+from userAuth.hashing import AuthServiceBusy, HashPool, hash_pool
+from userAuth.models import User
+from userAuth.revocation import RevocationStore
+from userAuth.tokens import create_access_token
+
+
+class TokenVersionTests(TestCase):
+    """Cached tokens stop working once the user's token_version moves."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('a@example.com', 'alice', 'pw')
+
+    def setUp(self):
+        # The cache outlives each test's rolled-back transaction
+        auth_cache.invalidate_user(self.user.id)
+        self.client = APIClient()
+
+    def authorize(self):
+        token = create_access_token(self.user.id, self.user.token_version)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def assertRejected(self, detail):
+        # JWTAuthentication sends no WWW-Authenticate challenge, so DRF answers 403
+        response = self.client.get('/rooms/')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data['detail'], detail)
+
+    def test_password_change_invalidates_cached_token(self):
+        self.authorize()
+        self.assertEqual(self.client.get('/rooms/').status_code, 200)
+        self.assertEqual(self.client.get('/rooms/').status_code, 200)  # From the cache
+
+        self.user.set_password('new')
+        self.user.save()
+        self.assertRejected("Token has been revoked")
+
+        self.authorize()
+        self.assertEqual(self.client.get('/rooms/').status_code, 200)
+
+    def test_deactivation_invalidates_cached_token(self):
+        self.authorize()
+        self.assertEqual(self.client.get('/rooms/').status_code, 200)
+
+        self.user.is_active = False
+        self.user.save(update_fields=['is_active'])
+        self.assertRejected("User account is disabled")
+
+    @override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+    async def test_websocket_rejects_stale_token(self):
+        token = create_access_token(self.user.id, self.user.token_version)
+        self.user.set_password('new')
+        await self.user.asave()
+
+        communicator = WebsocketCommunicator(
+            JWTWebsocketMiddleware(URLRouter(websocket_urlpatterns)),
+            "/ws/chat/",
+            headers=[(b'cookie', f"access_token={token}".encode())],
+        )
+        connected, code = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4002)
+
+
+class RefreshRevocationTests(TestCase):
+    """Refresh tokens are rotated once, briefly reusable, and die at logout."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('a@example.com', 'alice', 'pw')
+
+    def setUp(self):
+        # The hashing pool's threads have their own connections, which can't
+        # see the test's transaction, so run its work inline. Every test logs
+        # in, more often than the login rate limit allows
+        for patcher in (
+            mock.patch.object(hash_pool, 'run', lambda kind, fn, *args, **kwargs: fn(*args, **kwargs)),
+            mock.patch.object(rate_limiter, 'local', LocalBuckets()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.client = APIClient()
+        response = self.client.post('/login/', {'email': 'a@example.com', 'password': 'pw'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.refresh = self.client.cookies['refresh_token'].value
+
+    def refresh_with(self, token):
+        self.client.cookies['refresh_token'] = token
+        return self.client.post('/refresh/')
+
+    def test_concurrent_refreshes_get_the_same_pair(self):
+        first = self.refresh_with(self.refresh)
+        self.assertEqual(first.status_code, 200)
+        rotated = first.cookies['refresh_token'].value
+        self.assertNotEqual(rotated, self.refresh)
+
+        second = self.refresh_with(self.refresh)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.cookies['refresh_token'].value, rotated)
+        self.assertEqual(second.cookies['access_token'].value, first.cookies['access_token'].value)
+
+    @mock.patch('userAuth.revocation.AUTH_REFRESH_REUSE_SECONDS', 0)
+    def test_rotated_refresh_token_is_revoked_without_reuse_window(self):
+        self.assertEqual(self.refresh_with(self.refresh).status_code, 200)
+        self.assertEqual(self.refresh_with(self.refresh).status_code, 401)
+
+    def test_reuse_window_expires(self):
+        store = RevocationStore(redis_url=None)
+        exp = time.time() + 3600
+        self.assertEqual(store.rotate('jti', exp, ('access', 'refresh'), reuse_seconds=10), ('access', 'refresh'))
+        self.assertEqual(store.rotate('jti', exp, ('other', 'pair'), reuse_seconds=10), ('access', 'refresh'))
+        with mock.patch('userAuth.revocation.time.time', return_value=time.time() + 11):
+            self.assertIsNone(store.rotate('jti', exp, ('other', 'pair'), reuse_seconds=10))
+        self.assertEqual((store.revoked, store.reused), (1, 1))
+
+    def test_logout_revokes_refresh_token(self):
+        self.assertEqual(self.client.post('/logout/').status_code, 200)
+        self.assertEqual(self.refresh_with(self.refresh).status_code, 401)
+
+    def test_logout_with_bad_access_token_still_revokes(self):
+        self.client.cookies['access_token'] = 'expired-or-revoked'
+        self.assertEqual(self.client.post('/logout/').status_code, 200)
+        self.assertEqual(self.refresh_with(self.refresh).status_code, 401)
+
+
+class LoginRateLimitTests(TestCase):
+    """Login attempts are limited per client IP, and per account from each IP."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('a@example.com', 'alice', 'pw')
+
+    def setUp(self):
+        for patcher in (
+            mock.patch.object(hash_pool, 'run', lambda kind, fn, *args, **kwargs: fn(*args, **kwargs)),
+            mock.patch('backend.ratelimit.rate_limiter', RateLimiter(limits={'login': (2, 60)}, redis_url=None)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def login(self, address, password='wrong'):
+        data = {'email': 'a@example.com', 'password': password}
+        return APIClient(REMOTE_ADDR=address).post('/login/', data, format='json')
+
+    def test_guesses_from_elsewhere_do_not_lock_the_owner_out(self):
+        for _ in range(2):
+            self.assertNotEqual(self.login('10.0.0.1').status_code, 429)
+        self.assertEqual(self.login('10.0.0.1').status_code, 429)
+
+        self.assertEqual(self.login('10.0.0.2', password='pw').status_code, 200)
+
+
+class HashPoolTests(TestCase):
+    """Credential work runs on a bounded pool; overflow is turned away with 503."""
+
+    def block(self, pool, count):
+        """Occupy `count` places in the pool; call the returned function to free them."""
+        release = threading.Event()
+        started = threading.Semaphore(0)
+
+        def wait():
+            started.release()
+            release.wait(5)
+
+        threads = [threading.Thread(target=pool.run, args=('login', wait)) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        started.acquire(timeout=5)  # The first one is running, the others are queued
+
+        def finish():
+            release.set()
+            for thread in threads:
+                thread.join(5)
+        self.addCleanup(finish)
+        return finish
+
+    def test_full_pool_refuses_work(self):
+        pool = HashPool(workers=1, max_queue=1, timeout=5)
+        finish = self.block(pool, 2)
+        while pool.in_flight < 2:
+            time.sleep(0.001)
+
+        with self.assertRaises(AuthServiceBusy) as busy:
+            pool.run('login', lambda: None)
+        self.assertGreaterEqual(busy.exception.wait, 1)
+        self.assertEqual(pool.stats()['kinds']['login']['rejected'], 1)
+
+        finish()
+        self.assertEqual(pool.run('login', lambda: 'ok'), 'ok')
+        self.assertEqual(pool.stats()['in_flight'], 0)
+
+    def test_work_not_started_in_time_is_withdrawn(self):
+        pool = HashPool(workers=1, max_queue=1, timeout=0.05)
+        self.block(pool, 1)
+
+        with self.assertRaises(AuthServiceBusy):
+            pool.run('login', lambda: None)
+        self.assertEqual(pool.stats()['kinds']['login']['timed_out'], 1)
+
+    def test_busy_pool_answers_503_with_retry_after(self):
+        with mock.patch.object(hash_pool, 'run', side_effect=AuthServiceBusy(7)), \
+                mock.patch.object(rate_limiter, 'local', LocalBuckets()):
+            response = APIClient().post('/login/', {'email': 'a@example.com', 'password': 'pw'}, format='json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
@@ -8,6 +8,8 @@ from datetime import datetime, timedelta, timezone
 from channels.db import database_sync_to_async
 from rest_framework.authentication import BaseAuthentication
 from jwt import decode
+from .auth_cache import auth_cache
+from .tracing import auth_tracer
 
 User = get_user_model()
 
@@ -24,71 +26,43 @@ class JWTAuthentication(BaseAuthentication):
         """
         Authenticate the request using access_token from httpOnly cookie
         """
-        # print("\n" + "=" * 60)
-        # print("🔐 JWT AUTHENTICATION ATTEMPT")
-        # print(f"📍 Path: {request.path}")
-        # print(f"🔧 Method: {request.method}")
-        
-        # Print all cookies
-        
-        # Print all headers
-        for key, value in request.headers.items():
-            # Don't print full authorization header for security
-            if key.lower() == 'authorization':
-                logger.info(f"   {key}: Bearer {value[7:27]}..." if len(value) > 7 else f"   {key}: {value}")
-            else:
-                logger.info(f"   {key}: {value}")
-        
+        # Sampled requests are timed per stage; the rest get a no-op trace
+        trace = auth_tracer.start('rest', request.path)
+
         # Try to get token from httpOnly cookie first
-        token = request.COOKIES.get('access_token')
-        
-        if token:
-            logger.info(f"Access token from cookie: {token[:30]}...")
-        else:
-            logger.info("No access_token cookie found")
-        
+        token = self.extract_token_from_cookie(request)
+        source = 'cookie'
+
         # Fallback to Authorization header (for backward compatibility or testing)
         if not token:
-            logger.info("🔍 Checking Authorization header...")
-            auth_header = request.headers.get('Authorization')
-            if auth_header and auth_header.startswith('Bearer '):
-                token = auth_header.split(' ')[1]
-            else:
-                logger.info("No Bearer token in Authorization header")
-        
+            token = self.extract_token_from_header(request)
+            source = 'header'
+        trace.mark('extract', source=source if token else None)
+
         # If no token found, return None (not authenticated)
         if not token:
-            logger.info("NO TOKEN FOUND - User not authenticated")
+            trace.finish('anonymous')
             return None
 
+        trace.note(token=token)
         try:
-            # Decode the token
-            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
-            # Verify token type
-            token_type = payload.get("type")
-            
-            if token_type != "access":
-                raise AuthenticationFailed("Invalid token type")
-
-            # Get user from database
-            user_id = payload.get("id")
-            
-            user = User.objects.get(id=user_id)
-          
+            # Verified claims and the user come from auth_cache when warm
+            user = auth_cache.authenticate(token, trace)
+            trace.finish('ok', user_id=user.pk)
             
             # Return tuple of (user, None)
             return (user, None)
 
         except jwt.ExpiredSignatureError:
+            trace.finish('expired')
             raise AuthenticationFailed("Access token expired")
 
-        except jwt.InvalidTokenError as e:
-            raise AuthenticationFailed("Invalid token")
-            
-        except User.DoesNotExist:
-            raise AuthenticationFailed("User not found")
+        except AuthenticationFailed as e:
+            trace.finish('rejected', reason=str(e.detail))
+            raise
         
         except Exception as e:
+            trace.finish('error')
             raise AuthenticationFailed(f"Authentication error: {str(e)}")
     
     
@@ -163,25 +137,6 @@ class JWTAuthentication(BaseAuthentication):
         Token should be passed via query string or connection headers.
         """
         try:
-            # Decode the token
-            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-            
-            # Verify token type
-            if payload.get("type") != "access":
-                raise AuthenticationFailed("Invalid token type")
-            
-            # Get user ID from payload
-            user_id = payload.get("id")
-            if not user_id:
-                raise AuthenticationFailed("Invalid token payload")
-            
-            # Fetch user from database
-            user = User.objects.get(id=user_id)
-            return user
-            
+            return auth_cache.authenticate(token)
         except jwt.ExpiredSignatureError:
-            raise AuthenticationFailed("Access token expired")
-        except jwt.InvalidTokenError as e:
-            raise AuthenticationFailed("Invalid token")
-        except User.DoesNotExist:
-            raise AuthenticationFailed("User not found")
\ No newline at end of file
+            raise AuthenticationFailed("Access token expired")
\ No newline at end of file
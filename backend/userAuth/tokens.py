@@ -1,3 +1,5 @@
+import uuid
+
 import jwt
 from datetime import datetime, timedelta, timezone
 from django.conf import settings
@@ -6,21 +8,27 @@ ACCESS_TOKEN_LIFETIME = timedelta(minutes=5)
 REFRESH_TOKEN_LIFETIME = timedelta(days=7)
 
 
-def create_access_token(user_id):
+def create_access_token(user_id, token_version=0):
     payload = {
         "id": user_id,
         "type": "access",
+        "ver": token_version,
         "exp": datetime.now(timezone.utc) + ACCESS_TOKEN_LIFETIME,
         "iat": datetime.now(timezone.utc),
+        # Lets this one token be revoked, see userAuth/revocation.py
+        "jti": uuid.uuid4().hex,
     }
     return jwt.encode(payload, settings.SECRET_KEY, algorithm="HS256")
 
 
-def create_refresh_token(user_id):
+def create_refresh_token(user_id, token_version=0):
     payload = {
         "id": user_id,
         "type": "refresh",
+        "ver": token_version,
         "exp": datetime.now(timezone.utc) + REFRESH_TOKEN_LIFETIME,
         "iat": datetime.now(timezone.utc),
+        # Lets this one token be revoked, see userAuth/revocation.py
+        "jti": uuid.uuid4().hex,
     }
     return jwt.encode(payload, settings.SECRET_KEY, algorithm="HS256")
@@ -0,0 +1,128 @@
+"""
+Sampled tracing of the authentication pipeline.
+
+A fraction (`AUTH_TRACE_SAMPLE_RATE`, 0 to 1) of authentications, REST and
+WebSocket, is timed stage by stage:
+
+* extract - finding the token in the cookie or Authorization header
+* decode  - verifying the token (or finding it in the auth cache)
+* user    - loading the user (or its cached snapshot)
+
+and logged as one JSON line on the `userAuth.trace` logger, e.g.
+
+    {"transport": "rest", "path": "/rooms/", "outcome": "ok", "user_id": 4,
+     "source": "cookie", "claims_cached": true, "user_cached": true,
+     "token": "9f2c61d0", "extract_ms": 0.004, "decode_ms": 0.002,
+     "user_ms": 0.011, "total_ms": 0.019}
+
+Traces never contain tokens, headers or query strings: tokens are reduced
+to a short hash that can only be used to correlate traces. Unsampled
+requests get a shared no-op trace, so with the rate at 0 tracing costs one
+comparison per request.
+"""
+import hashlib
+import json
+import logging
+import random
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger('userAuth.trace')
+
+AUTH_TRACE_SAMPLE_RATE = getattr(settings, 'AUTH_TRACE_SAMPLE_RATE', 0.0)
+
+
+def token_fingerprint(token):
+    """Short, non-reversible identifier of a token."""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:8]
+
+
+class NullTrace:
+    """Stands in for a trace on unsampled requests; does nothing."""
+
+    def mark(self, stage, **fields):
+        pass
+
+    def note(self, **fields):
+        pass
+
+    def finish(self, outcome, **fields):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class AuthTrace:
+    """Timings and outcome of one sampled authentication."""
+
+    def __init__(self, tracer, transport, path):
+        self.tracer = tracer
+        self.fields = {"transport": transport, "path": (path or '').split('?', 1)[0]}
+        self.started = self.last = time.perf_counter()
+
+    def mark(self, stage, **fields):
+        """Close a stage, recording the time since the previous one. The first timing of a stage is kept."""
+        now = time.perf_counter()
+        self.fields.setdefault(f"{stage}_ms", round((now - self.last) * 1000, 3))
+        self.last = now
+        for key, value in fields.items():
+            self.fields.setdefault(key, value)
+
+    def note(self, **fields):
+        for key, value in fields.items():
+            if key == 'token':
+                value = token_fingerprint(value)
+            self.fields[key] = value
+
+    def finish(self, outcome, **fields):
+        self.note(outcome=outcome, **fields)
+        self.fields["total_ms"] = round((time.perf_counter() - self.started) * 1000, 3)
+        self.tracer.record(self.fields)
+
+
+class AuthTracer:
+    """Decide which authentications to trace and collect their timings."""
+
+    STAGES = ('extract', 'decode', 'user', 'total')
+
+    def __init__(self, sample_rate=AUTH_TRACE_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.sampled = 0
+        self.outcomes = {}
+        self._count = dict.fromkeys(self.STAGES, 0)
+        self._total_ms = dict.fromkeys(self.STAGES, 0.0)
+        self._max_ms = dict.fromkeys(self.STAGES, 0.0)
+
+    def start(self, transport, path):
+        """Return a trace for this authentication, or the no-op one if it isn't sampled."""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return NULL_TRACE
+        return AuthTrace(self, transport, path)
+
+    def record(self, fields):
+        self.sampled += 1
+        self.outcomes[fields["outcome"]] = self.outcomes.get(fields["outcome"], 0) + 1
+        for stage in self.STAGES:
+            elapsed = fields.get(f"{stage}_ms")
+            if elapsed is not None:
+                self._count[stage] += 1
+                self._total_ms[stage] += elapsed
+                self._max_ms[stage] = max(self._max_ms[stage], elapsed)
+        logger.info("%s", json.dumps(fields, separators=(', ', ': ')))
+
+    def stats(self):
+        return {
+            "sample_rate": self.sample_rate,
+            "sampled": self.sampled,
+            "outcomes": dict(self.outcomes),
+            "avg_ms": {
+                stage: round(total / self._count[stage], 3) if self._count[stage] else 0.0
+                for stage, total in self._total_ms.items()
+            },
+            "max_ms": {stage: round(value, 3) for stage, value in self._max_ms.items()},
+        }
+
+
+auth_tracer = AuthTracer()
@@ -13,16 +13,26 @@ import jwt
 from django.conf import settings
 from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework import status
+from rest_framework.decorators import throttle_classes
+from backend.ratelimit import LoginRateThrottle, RegisterRateThrottle
+from .hashing import hash_pool, AuthServiceBusy
+from .revocation import revocations
 
 User = get_user_model()  
 import logging
 logger = logging.getLogger(__name__)
 
+def _create_user(serializer):
+    serializer.is_valid(raise_exception=True)
+    return serializer.save()
+
 @api_view(['POST'])
+@throttle_classes([RegisterRateThrottle])
 def register_user(request):
     serializer = UserSerializer(data=request.data)
-    serializer.is_valid(raise_exception=True)
-    user = serializer.save()
+    # Validation checks the password against the common-passwords list and
+    # create_user hashes it, so both run on the hashing pool
+    user = hash_pool.run('register', _create_user, serializer)
 
     return Response(
         {
@@ -35,14 +45,16 @@ def register_user(request):
 @api_view(["POST"])
 @authentication_classes([]) 
 @permission_classes([AllowAny]) 
+@throttle_classes([LoginRateThrottle])
 def login_user(request):
     serializer = LoginSerializer(data=request.data)
-    serializer.is_valid(raise_exception=True)
+    # authenticate() checks the password hash, off the request thread
+    hash_pool.run('login', serializer.is_valid, raise_exception=True)
 
     user = serializer.validated_data["user"]
 
-    access_token = create_access_token(user.id)
-    refresh_token = create_refresh_token(user.id)
+    access_token = create_access_token(user.id, user.token_version)
+    refresh_token = create_refresh_token(user.id, user.token_version)
 
     response = Response(
         {
@@ -127,13 +139,25 @@ def refresh_token(request):
             # logger.info("No user ID in token payload")
             # logger.info("=" * 60 + "\n")
             return Response({"detail": "Invalid token payload"}, status=400)
-            
-        user = User.objects.get(id=user_id)
+
+        user = hash_pool.run('refresh', User.objects.get, id=user_id)
         logger.info(f"User found: {user.email} (ID: {user_id})")
 
+        # Tokens issued before a password change or deactivation are void
+        if not user.is_active or payload.get("ver", 0) != user.token_version:
+            return Response({"detail": "Refresh token revoked"}, status=401)
+
         # Generate new tokens
-        new_access_token = create_access_token(user.id)
-        new_refresh_token = create_refresh_token(user.id)
+        new_access_token = create_access_token(user.id, user.token_version)
+        new_refresh_token = create_refresh_token(user.id, user.token_version)
+
+        # Each refresh token is rotated once; revoking it is also the check.
+        # Concurrent refreshes with the same token, within a few seconds, get
+        # the pair of the one that won. Logged out or older tokens get None
+        issued = revocations.rotate(payload.get("jti"), payload["exp"], (new_access_token, new_refresh_token))
+        if issued is None:
+            return Response({"detail": "Refresh token revoked"}, status=401)
+        new_access_token, new_refresh_token = issued
         
         # logger.info(f"New access token generated: {new_access_token[:30]}...")
         # logger.info(f"New refresh token generated: {new_refresh_token[:30]}...")
@@ -188,6 +212,9 @@ def refresh_token(request):
         # logger.info(f"Invalid refresh token: {str(e)}")
         # logger.info("=" * 60 + "\n")
         return Response({"detail": "Invalid refresh token"}, status=401)
+
+    except AuthServiceBusy:
+        raise
     
     except Exception as e:
         # logger.info(f"Unexpected error: {str(e)}")
@@ -196,11 +223,31 @@ def refresh_token(request):
         # logger.info("=" * 60 + "\n")
         return Response({"detail": "Server error"}, status=500)
 
+def _revoke_token(token):
+    if not token:
+        return
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+    except jwt.InvalidTokenError:
+        return  # Expired or forged: nothing to revoke
+    revocations.revoke(payload.get("jti"), payload["exp"])
+
 @api_view(['POST'])
+@authentication_classes([])
+@permission_classes([AllowAny])
 def logout_user(request):
     # logger.info("\n" + "=" * 60)
     # logger.info("logout request")
     
+    # No authentication: an expired or revoked access token must not stop
+    # the refresh token from being revoked. Read the cookies directly.
+    refresh = request.COOKIES.get("refresh_token")
+    access = request.COOKIES.get("access_token")
+
+    # Revoke both tokens, so copies of the cookies stop working too
+    _revoke_token(refresh)
+    _revoke_token(access)
+
     response = Response({"message": "Logged out"}, status=200)
     
     # Delete cookies with same settings
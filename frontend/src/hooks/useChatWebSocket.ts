@@ -15,6 +15,10 @@ export const useChatWebSocket = (selectedRoom?: {
   const isRefreshingRef = useRef(false);
   const reconnectAttemptsRef = useRef(0);
   const MAX_RECONNECT_ATTEMPTS = 3;
+  // Acknowledge received frames so the server can tell when we fall behind
+  // (see "Slow consumers" in the backend README)
+  const ACK_EVERY_FRAMES = 32;
+  const ACK_INTERVAL_MS = 1000;
 
   useEffect(() => {
     setMessages([]); 
@@ -76,6 +80,17 @@ export const useChatWebSocket = (selectedRoom?: {
       const socket = new WebSocket(socketUrl);
       socketRef.current = socket;
 
+      // Frames received on this connection, and how many the server knows of
+      let received = 0;
+      let acked = 0;
+      const sendAck = () => {
+        if (received > acked && socket.readyState === WebSocket.OPEN) {
+          socket.send(JSON.stringify({ type: "ack", received }));
+          acked = received;
+        }
+      };
+      const ackTimer = setInterval(sendAck, ACK_INTERVAL_MS);
+
       socket.onopen = () => {
         devLog("WebSocket connected successfully");
         setConnectionFailed(false);
@@ -83,6 +98,11 @@ export const useChatWebSocket = (selectedRoom?: {
       };
 
       socket.onmessage = (event) => {
+        received++;
+        if (received - acked >= ACK_EVERY_FRAMES) {
+          sendAck();
+        }
+
         try {
           const data = JSON.parse(event.data);
           
@@ -108,12 +128,19 @@ export const useChatWebSocket = (selectedRoom?: {
           reconnectAttempt: reconnectAttemptsRef.current
         });
 
+        clearInterval(ackTimer);
         socketRef.current = null;
 
         // Code 4001 = Token expired (from Django middleware)
         // Code 4000 = No token
         // Code 4002 = Auth failed
-        if (event.code === 4001) {
+        // Code 4008 = Fell too far behind; reconnecting fetches the history again
+        if (event.code === 4008) {
+          devWarn("WebSocket closed: slow consumer (4008), reconnecting");
+          reconnectTimeoutRef.current = setTimeout(() => {
+            connectWebSocket();
+          }, 1000);
+        } else if (event.code === 4001) {
           devLog("WebSocket closed: Token expired (4001)");
           
           if (reconnectAttemptsRef.current >= MAX_RECONNECT_ATTEMPTS) {